@@ -2,10 +2,10 @@ import gevent
 from gevent import monkey
 monkey.patch_all()
 import os
+import atexit
 import json
 import time
 
-import redis
 from flask import Flask, render_template, request, redirect, session, flash, jsonify, Response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -13,6 +13,17 @@ from datetime import datetime, timedelta, date, timezone
 
 from sqlalchemy import text as sa_text
 from model import db, User, TimeEntry, AlignmentSignal, UserProfile
+from services.rollup import rebuild_rollups
+from services.archive import archive_stale_entries, run_archive_sweeper
+from services.sse_broker import SSEBroker
+from services.llm_client import LLMClient
+from services.circuit_breaker import CircuitBreaker
+from services.categorize_queue import run_categorize_worker
+from services.jobs import JobRunner
+from services.note_buffer import flush_dirty, run_note_flusher
+from services.todos import migrate_json_todos
+from services.request_timing import TimedRedis, init_request_timing
+from services import metrics
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -23,25 +34,78 @@ from flask.cli import with_appcontext
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY')
 DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY')
+DEEPSEEK_BASE_URL = os.environ.get('DEEPSEEK_BASE_URL', 'https://api.deepseek.com')
+# Upper bound on concurrent DeepSeek calls per gevent worker (kept-alive connections).
+LLM_POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE', '64'))
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', '5'))
+LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', '45'))
+# Circuit breaker: open when >= ratio of calls in the window failed or exceeded the latency budget.
+LLM_BREAKER_FAILURE_RATIO = float(os.environ.get('LLM_BREAKER_FAILURE_RATIO', '0.5'))
+LLM_BREAKER_MIN_CALLS = int(os.environ.get('LLM_BREAKER_MIN_CALLS', '5'))
+LLM_BREAKER_WINDOW_SECONDS = int(os.environ.get('LLM_BREAKER_WINDOW_SECONDS', '60'))
+LLM_BREAKER_OPEN_SECONDS = int(os.environ.get('LLM_BREAKER_OPEN_SECONDS', '30'))
+LLM_SLOW_CALL_SECONDS = float(os.environ.get('LLM_SLOW_CALL_SECONDS', '20'))
 
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 REDIS_CHANNEL_PREFIX = os.environ.get('REDIS_CHANNEL_PREFIX', 'onyx:user')
 SSE_HEARTBEAT_SECONDS = int(os.environ.get('SSE_HEARTBEAT_SECONDS', '25'))
+SSE_REPLAY_MAXLEN = int(os.environ.get('SSE_REPLAY_MAXLEN', '200'))
+SSE_REPLAY_TTL_SECONDS = int(os.environ.get('SSE_REPLAY_TTL_SECONDS', '86400'))
+ARCHIVE_SWEEPER_ENABLED = os.environ.get('ARCHIVE_SWEEPER', '1') == '1'
 
 RATE_LIMIT_PER_MINUTE = 3
 RATE_LIMIT_PER_HOUR = 20
+AUDIT_CACHE_TTL_SECONDS = int(os.environ.get('AUDIT_CACHE_TTL_SECONDS', '1800'))
+AUDIT_TOKEN_BUDGET = int(os.environ.get('AUDIT_TOKEN_BUDGET', '6000'))
+CATEGORIZE_BATCH_SIZE = int(os.environ.get('CATEGORIZE_BATCH_SIZE', '50'))
+CATEGORIZE_CONCURRENCY = int(os.environ.get('CATEGORIZE_CONCURRENCY', '4'))
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', '8'))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', '3600'))
+# Write-behind for notes/todos autosaves: buffered in Redis, flushed to the DB this often (0 = write through).
+NOTES_FLUSH_SECONDS = int(os.environ.get('NOTES_FLUSH_SECONDS', '5'))
+# 同一条 SQL 在一个请求里执行这么多次就记一条 N+1 警告；0 关闭
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '10'))
+# 各 worker 把 services.metrics 的数值写到这个共享目录（建议 /dev/shm 下），/metrics 合并输出；空=只看本 worker
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_DUMP_SECONDS = int(os.environ.get('METRICS_DUMP_SECONDS', '5'))
+# /metrics 放行的来源：这些网段的直连请求，或带 `Authorization: Bearer <METRICS_TOKEN>` 的请求
+METRICS_ALLOW_CIDRS = os.environ.get('METRICS_ALLOW_CIDRS', '127.0.0.1/32,::1/128')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 # Store config values on the app for access by blueprints via current_app
 app.config['DEEPSEEK_API_KEY'] = DEEPSEEK_API_KEY
+app.config['LLM_POOL_SIZE'] = LLM_POOL_SIZE
+app.config['LLM_CONNECT_TIMEOUT'] = LLM_CONNECT_TIMEOUT
+app.config['LLM_READ_TIMEOUT'] = LLM_READ_TIMEOUT
+app.config['LLM_BREAKER_FAILURE_RATIO'] = LLM_BREAKER_FAILURE_RATIO
+app.config['LLM_BREAKER_MIN_CALLS'] = LLM_BREAKER_MIN_CALLS
+app.config['LLM_BREAKER_WINDOW_SECONDS'] = LLM_BREAKER_WINDOW_SECONDS
+app.config['LLM_BREAKER_OPEN_SECONDS'] = LLM_BREAKER_OPEN_SECONDS
+app.config['LLM_SLOW_CALL_SECONDS'] = LLM_SLOW_CALL_SECONDS
 app.config['REDIS_CHANNEL_PREFIX'] = REDIS_CHANNEL_PREFIX
 app.config['SSE_HEARTBEAT_SECONDS'] = SSE_HEARTBEAT_SECONDS
+app.config['SSE_REPLAY_MAXLEN'] = SSE_REPLAY_MAXLEN
+app.config['SSE_REPLAY_TTL_SECONDS'] = SSE_REPLAY_TTL_SECONDS
 app.config['RATE_LIMIT_PER_MINUTE'] = RATE_LIMIT_PER_MINUTE
 app.config['RATE_LIMIT_PER_HOUR'] = RATE_LIMIT_PER_HOUR
+app.config['AUDIT_CACHE_TTL_SECONDS'] = AUDIT_CACHE_TTL_SECONDS
+app.config['AUDIT_TOKEN_BUDGET'] = AUDIT_TOKEN_BUDGET
+app.config['CATEGORIZE_BATCH_SIZE'] = CATEGORIZE_BATCH_SIZE
+app.config['CATEGORIZE_CONCURRENCY'] = CATEGORIZE_CONCURRENCY
+app.config['JOB_CONCURRENCY'] = JOB_CONCURRENCY
+app.config['JOB_TTL_SECONDS'] = JOB_TTL_SECONDS
+app.config['ARCHIVE_SWEEPER'] = ARCHIVE_SWEEPER_ENABLED
+app.config['NOTES_FLUSH_SECONDS'] = NOTES_FLUSH_SECONDS
+app.config['N_PLUS_ONE_THRESHOLD'] = N_PLUS_ONE_THRESHOLD
+app.config['METRICS_DIR'] = METRICS_DIR
+app.config['METRICS_DUMP_SECONDS'] = METRICS_DUMP_SECONDS
+app.config['METRICS_ALLOW_CIDRS'] = METRICS_ALLOW_CIDRS
+app.config['METRICS_TOKEN'] = METRICS_TOKEN
 
 # --- Redis setup ---
 redis_client = None
 try:
-    redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    redis_client = TimedRedis.from_url(REDIS_URL, decode_responses=True)
     redis_client.ping()
 except Exception as redis_error:
     print(f"Redis init failed at {REDIS_URL}: {redis_error}")
@@ -49,6 +113,33 @@ except Exception as redis_error:
 
 app.redis_client = redis_client
 
+# One pattern subscription per worker, fanned out to that worker's SSE streams.
+app.sse_broker = SSEBroker(redis_client, REDIS_CHANNEL_PREFIX, logger=app.logger) if redis_client is not None else None
+
+# --- LLM client (one keep-alive connection pool per worker, breaker state shared in Redis) ---
+app.llm_client = LLMClient(
+    DEEPSEEK_API_KEY,
+    base_url=DEEPSEEK_BASE_URL,
+    pool_size=LLM_POOL_SIZE,
+    connect_timeout=LLM_CONNECT_TIMEOUT,
+    read_timeout=LLM_READ_TIMEOUT,
+    logger=app.logger,
+    breaker=CircuitBreaker(
+        'deepseek',
+        lambda: app.redis_client,
+        failure_ratio=LLM_BREAKER_FAILURE_RATIO,
+        min_calls=LLM_BREAKER_MIN_CALLS,
+        window_seconds=LLM_BREAKER_WINDOW_SECONDS,
+        open_seconds=LLM_BREAKER_OPEN_SECONDS,
+        slow_call_seconds=LLM_SLOW_CALL_SECONDS,
+        probe_ttl_seconds=int(LLM_CONNECT_TIMEOUT + LLM_READ_TIMEOUT) + 5,
+        logger=app.logger,
+    ),
+)
+
+# --- Background AI jobs (fixed greenlet pool per worker, records in Redis) ---
+app.job_runner = JobRunner(app, concurrency=JOB_CONCURRENCY, ttl_seconds=JOB_TTL_SECONDS)
+
 # --- Database setup ---
 database_url = os.environ.get('DATABASE_URL')
 if database_url and database_url.startswith("postgres://"):
@@ -61,6 +152,9 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 
 db.init_app(app)
 
+# 每个请求的 SQL / Redis / LLM 次数和耗时 -> Server-Timing 头 + access 日志
+init_request_timing(app)
+
 # --- Login manager ---
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -111,6 +205,103 @@ def ensure_user_columns():
         except Exception as exc:
             app.logger.info('Skipping adding user.pomodoro_state (likely a concurrent worker won the race): %s', exc)
 
+    if 'notebook_version' not in existing_cols:
+        try:
+            with engine.begin() as conn:
+                conn.execute(sa_text("ALTER TABLE \"user\" ADD COLUMN notebook_version INTEGER DEFAULT 0"))
+            app.logger.info('Added missing column user.notebook_version')
+        except Exception as exc:
+            app.logger.info('Skipping adding user.notebook_version (likely a concurrent worker won the race): %s', exc)
+
+
+ENTRY_COLUMNS = (
+    ('start_minute', 'INTEGER'),
+    ('end_minute', 'INTEGER'),
+    ('duration_minutes', 'INTEGER'),
+    ('categorized_desc', 'TEXT'),
+    ('category_source', 'VARCHAR(10)'),
+    ('labelled_at', 'TIMESTAMP'),
+)
+
+
+def ensure_entry_columns():
+    engine = db.engine
+    try:
+        inspector = db.inspect(engine)
+        existing_cols = {col['name'] for col in inspector.get_columns(TimeEntry.__tablename__)}
+    except Exception as exc:
+        app.logger.warning('Schema inspection failed: %s', exc)
+        return
+
+    for name, ddl in ENTRY_COLUMNS:
+        if name in existing_cols:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(sa_text(f"ALTER TABLE {TimeEntry.__tablename__} ADD COLUMN {name} {ddl}"))
+            app.logger.info('Added missing column %s.%s', TimeEntry.__tablename__, name)
+        except Exception as exc:
+            app.logger.info('Skipping adding %s.%s (likely a concurrent worker won the race): %s',
+                            TimeEntry.__tablename__, name, exc)
+
+
+def ensure_indexes():
+    """Create indexes declared on the models that an existing database is missing.
+
+    db.create_all() only builds indexes together with a brand-new table, so
+    long-lived databases need this catch-up step. On PostgreSQL the indexes are
+    built with CREATE INDEX CONCURRENTLY (no write lock on `expenses`), and only
+    the worker holding a try-advisory-lock does the build; the others skip it.
+    """
+    engine = db.engine
+    indexes = sorted(TimeEntry.__table__.indexes, key=lambda ix: ix.name)
+
+    if engine.dialect.name == 'postgresql':
+        lock_id = 987654322
+        # CONCURRENTLY cannot run inside a transaction block.
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            acquired = conn.execute(sa_text("SELECT pg_try_advisory_lock(:lock_id)"), {"lock_id": lock_id}).scalar()
+            if not acquired:
+                app.logger.info('Skipping index bootstrap (another worker is building indexes)')
+                return
+            try:
+                # A failed CONCURRENTLY build leaves an INVALID index behind that
+                # IF NOT EXISTS would happily skip, so rebuild those explicitly.
+                rows = conn.execute(sa_text(
+                    "SELECT c.relname, i.indisvalid FROM pg_index i "
+                    "JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE i.indrelid = to_regclass(:table)"
+                ), {"table": TimeEntry.__tablename__}).all()
+                existing = {name: valid for name, valid in rows}
+                for index in indexes:
+                    if existing.get(index.name) is True:
+                        continue
+                    columns = ', '.join(col.name for col in index.columns)
+                    try:
+                        if index.name in existing:
+                            conn.execute(sa_text(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}'))
+                        conn.execute(sa_text(
+                            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} '
+                            f'ON {TimeEntry.__tablename__} ({columns})'
+                        ))
+                        app.logger.info('Created index %s', index.name)
+                    except Exception as exc:
+                        app.logger.warning('Creating index %s failed: %s', index.name, exc)
+            finally:
+                conn.execute(sa_text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": lock_id})
+        return
+
+    for index in indexes:
+        columns = ', '.join(col.name for col in index.columns)
+        try:
+            with engine.begin() as conn:
+                conn.execute(sa_text(
+                    f'CREATE INDEX IF NOT EXISTS {index.name} '
+                    f'ON {TimeEntry.__tablename__} ({columns})'
+                ))
+        except Exception as exc:
+            app.logger.warning('Creating index %s failed: %s', index.name, exc)
+
 
 def initialize_database():
     with app.app_context():
@@ -126,12 +317,57 @@ def initialize_database():
         else:
             db.create_all()
         ensure_user_columns()
+        ensure_entry_columns()
+        ensure_indexes()
+        migrate_json_todos(logger=app.logger)
 
 
 initialize_database()
 
+# --- Background archive sweep (each web worker runs one; the UPDATE is idempotent) ---
+# 不在 import 时起：flask CLI 命令和 categorize-worker 也会 import app。
+# 等本进程收到第一个请求再起，只有真正服务请求的 worker 会跑
+_archive_sweeper_started = False
+
+
+@app.before_request
+def _start_archive_sweeper():
+    global _archive_sweeper_started
+    if _archive_sweeper_started or not app.config.get('ARCHIVE_SWEEPER'):
+        return
+    _archive_sweeper_started = True
+    gevent.spawn(run_archive_sweeper, app)
+
+# --- Notes write-behind flusher (any worker can flush any user's buffer) ---
+if redis_client is not None and NOTES_FLUSH_SECONDS > 0:
+    gevent.spawn(run_note_flusher, app, NOTES_FLUSH_SECONDS)
+
+
+@atexit.register
+def _flush_notes_on_exit():
+    # 正常退出（gunicorn 发 SIGTERM 也会走到这里）时把本轮还没刷的缓冲写回
+    if app.redis_client is None or not app.config.get('NOTES_FLUSH_SECONDS'):
+        return
+    try:
+        flush_dirty(app)
+    except Exception as exc:
+        app.logger.warning('Note buffer flush on exit failed: %s', exc)
+
+
+# --- Metrics dump for the cross-worker /metrics view ---
+if METRICS_DIR:
+    gevent.spawn(metrics.run_dumper, METRICS_DIR, METRICS_DUMP_SECONDS, app.logger)
+
+    @atexit.register
+    def _retire_metrics_on_exit():
+        # 计数器并入 archive，gauge 不再算；被 kill -9 的由下一次 collect 按 pid 并入
+        try:
+            metrics.retire_dump(METRICS_DIR)
+        except Exception as exc:
+            app.logger.warning('Metrics retire on exit failed: %s', exc)
+
 # --- Register Blueprints ---
-from routes import auth_bp, main_bp, profile_bp, notes_bp, sse_bp, ai_bp, data_bp
+from routes import auth_bp, main_bp, profile_bp, notes_bp, sse_bp, ai_bp, data_bp, metrics_bp
 
 app.register_blueprint(auth_bp)
 app.register_blueprint(main_bp)
@@ -140,6 +376,7 @@ app.register_blueprint(notes_bp)
 app.register_blueprint(sse_bp)
 app.register_blueprint(ai_bp)
 app.register_blueprint(data_bp)
+app.register_blueprint(metrics_bp)
 
 # --- CLI command ---
 @app.cli.command("count-users")
@@ -151,6 +388,75 @@ def count_users():
     click.echo(f"--------------------------")
 
 
+@app.cli.command("backfill-entry-minutes")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows per transaction.")
+@with_appcontext
+def backfill_entry_minutes(batch_size):
+    """Fill start_minute/end_minute/duration_minutes for rows written before those columns existed."""
+    last_id = 0
+    updated = 0
+    while True:
+        batch = TimeEntry.query.filter(
+            TimeEntry.id > last_id,
+            TimeEntry.duration_minutes.is_(None),
+        ).order_by(TimeEntry.id).limit(batch_size).all()
+        if not batch:
+            break
+        for entry in batch:
+            entry.refresh_minutes()
+        last_id = batch[-1].id
+        db.session.commit()
+        db.session.expunge_all()
+        updated += len(batch)
+        click.echo(f" backfilled {updated} entries (last id {last_id})")
+    click.echo(f"Done. {updated} entries backfilled.")
+
+
+@app.cli.command("archive-sweep")
+@with_appcontext
+def archive_sweep():
+    """Archive every user's entries whose logical day has ended."""
+    archived = archive_stale_entries()
+    db.session.commit()
+    click.echo(f"Archived {archived} entries.")
+
+
+@app.cli.command("rebuild-rollups")
+@click.option("--user-id", type=int, default=None, help="Only rebuild this user's rollups.")
+@with_appcontext
+def rebuild_rollups_command(user_id):
+    """Recompute daily_rollup from expenses (repair after manual edits or bulk imports)."""
+    rows = rebuild_rollups(user_id=user_id)
+    scope = f"user {user_id}" if user_id is not None else "all users"
+    click.echo(f"Rebuilt {rows} rollup rows for {scope}.")
+
+
+@app.cli.command("flush-notes")
+@with_appcontext
+def flush_notes():
+    """Write every buffered notebook / quick-note / to-do save back to the database now."""
+    if app.redis_client is None:
+        raise click.ClickException("Redis is unavailable; there is no note buffer to flush.")
+    flushed = flush_dirty(app)
+    click.echo(f"Flushed {flushed} users.")
+
+
+@app.cli.command("categorize-worker")
+@click.option("--batch-size", type=int, default=None, help="Max entry ids popped per batch (default CATEGORIZE_BATCH_SIZE).")
+@click.option("--concurrency", type=int, default=None, help="Max users categorized at once (default CATEGORIZE_CONCURRENCY).")
+@click.option("--drain", is_flag=True, help="Exit once the queue is empty instead of waiting for new entries.")
+@with_appcontext
+def categorize_worker(batch_size, concurrency, drain):
+    """Consume the categorize queue: categorize new entries and push entries_categorized over SSE."""
+    if app.redis_client is None:
+        raise click.ClickException("Redis is unavailable; the categorize queue needs REDIS_URL.")
+    batch_size = batch_size or app.config['CATEGORIZE_BATCH_SIZE']
+    concurrency = concurrency or app.config['CATEGORIZE_CONCURRENCY']
+    click.echo(f"Categorize worker started (batch {batch_size}, concurrency {concurrency}).")
+    batches = run_categorize_worker(app, batch_size=batch_size, concurrency=concurrency, drain=drain)
+    click.echo(f"Done. {batches} batches processed.")
+
+
 if __name__ == '__main__':
     from gevent.pywsgi import WSGIServer
     http_server = WSGIServer(('127.0.0.1', 5000), app)
@@ -0,0 +1,138 @@
+"""Query plans and latency of the dashboard hot queries, without and with the
+composite indexes on `expenses`.
+
+    python benchmarks/bench_entry_indexes.py                      # temp SQLite
+    python benchmarks/bench_entry_indexes.py --rows 2000000 \\
+        --database-url postgresql://onyx:pw@localhost/onyx_bench  # scratch PG
+
+The target database is wiped and re-seeded, never point it at real data.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import text as sa_text
+
+from model import db, User, TimeEntry
+
+
+def build_app(database_url):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    db.init_app(app)
+    return app
+
+
+def seed(rows, users, days):
+    db.session.add_all(User(id=i, username=f'bench{i}', password='x') for i in range(1, users + 1))
+    db.session.commit()
+
+    now = datetime.now()
+    batch = []
+    for n in range(rows):
+        ts = now - timedelta(minutes=random.randint(0, days * 24 * 60))
+        active = ts.date() == now.date()
+        batch.append({
+            'desc': f'task {n % 50}',
+            'start_time': '10:00',
+            'end_time': '11:00',
+            'timestamp': ts,
+            'is_archived': not active,
+            'archive_date': ts.date(),
+            'user_id': random.randint(1, users),
+            'category': 'Uncategorized',
+        })
+        if len(batch) >= 10000:
+            db.session.execute(TimeEntry.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(TimeEntry.__table__.insert(), batch)
+    db.session.commit()
+
+
+def hot_queries(user_id):
+    today = date.today()
+    return {
+        'index/active': TimeEntry.query.filter_by(user_id=user_id, is_archived=False)
+                                       .order_by(TimeEntry.timestamp.desc()),
+        'history/week': TimeEntry.query.filter(
+            TimeEntry.user_id == user_id,
+            TimeEntry.is_archived == True,
+            TimeEntry.archive_date >= today - timedelta(days=6),
+            TimeEntry.archive_date <= today,
+        ).order_by(TimeEntry.archive_date.desc(), TimeEntry.timestamp.desc()),
+        'audit/today': TimeEntry.query.filter(
+            TimeEntry.user_id == user_id,
+            TimeEntry.archive_date == today,
+        ),
+    }
+
+
+def explain(query):
+    sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'postgresql':
+        rows = db.session.execute(sa_text('EXPLAIN ANALYZE ' + sql)).all()
+        return '\n'.join(f'    {row[0]}' for row in rows)
+    rows = db.session.execute(sa_text('EXPLAIN QUERY PLAN ' + sql)).all()
+    return '\n'.join(f'    {row[-1]}' for row in rows)
+
+
+def time_query(query, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        query.all()
+        samples.append((time.perf_counter() - t0) * 1000)
+        db.session.expire_all()
+    return statistics.median(samples), max(samples)
+
+
+def run_phase(label, users, repeat):
+    print(f'\n=== {label} ===')
+    for name, query in hot_queries(random.randint(1, users)).items():
+        p50, worst = time_query(query, repeat)
+        print(f'  {name:<14} p50={p50:8.2f} ms  max={worst:8.2f} ms')
+        print(explain(query))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = build_app(database_url)
+    random.seed(42)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        print(f'Seeding {args.rows} entries for {args.users} users on {db.engine.dialect.name} ...')
+        seed(args.rows, args.users, args.days)
+
+        indexes = list(TimeEntry.__table__.indexes)
+        for index in indexes:
+            index.drop(db.engine)
+        db.session.execute(sa_text('ANALYZE'))
+        run_phase('before: primary key only', args.users, args.repeat)
+
+        for index in indexes:
+            index.create(db.engine)
+        db.session.execute(sa_text('ANALYZE'))
+        run_phase('after: composite indexes', args.users, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Bytes fetched per request by `load_user` for a user with a large notebook,
+with every `user` column loaded eagerly versus the deferred text columns.
+
+    python benchmarks/bench_user_load.py                          # temp SQLite
+    python benchmarks/bench_user_load.py --notebook-kb 200 \\
+        --database-url postgresql://onyx:pw@localhost/onyx_bench  # scratch PG
+
+The target database is wiped and re-seeded, never point it at real data.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.orm import undefer
+
+from model import db, User
+
+LARGE_COLUMNS = ('notebook', 'quick_note', 'todos', 'pomodoro_state')
+
+# 每个请求在 load_user 之后还会读哪些大文本列
+REQUESTS = {
+    'sse connect / stats': (),
+    'pomodoro poll': ('pomodoro_state',),
+    'todos save': ('todos',),
+    'dashboard page': ('todos', 'notebook'),
+}
+
+
+def build_app(database_url):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    db.init_app(app)
+    return app
+
+
+def seed(notebook_kb, todo_count):
+    todos = [{'id': str(i), 'text': f'todo item {i} ' + 'x' * 80, 'done': i % 3 == 0}
+             for i in range(todo_count)]
+    db.session.add(User(
+        id=1, username='bench', password='x' * 60,
+        notebook=('Long-term goal. ' * 64 + '\n') * notebook_kb,
+        quick_note='',
+        todos=json.dumps(todos),
+        pomodoro_state=json.dumps({'status': 'idle', 'phase': 'focus', 'remaining': 1500}),
+    ))
+    db.session.commit()
+
+
+class FetchCounter:
+    """把 ORM 发出的每条 SELECT 原样重跑一遍，累加结果行里每个值的字节数"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    def fetched_bytes(self):
+        total = 0
+        with db.engine.connect() as conn:
+            for statement, parameters in self.statements:
+                for row in conn.exec_driver_sql(statement, parameters):
+                    total += sum(len(str(value).encode('utf-8')) for value in row if value is not None)
+        return total
+
+
+def simulate(columns, eager):
+    """一次请求：load_user + 读 columns，返回 (查询数, 取回字节数, 耗时 ms)"""
+    db.session.expunge_all()
+    counter = FetchCounter()
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        t0 = time.perf_counter()
+        options = [undefer(getattr(User, name)) for name in LARGE_COLUMNS] if eager else []
+        user = db.session.get(User, 1, options=options)
+        for name in columns:
+            getattr(user, name)
+        elapsed = (time.perf_counter() - t0) * 1000
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+    return len(counter.statements), counter.fetched_bytes(), elapsed
+
+
+def run_phase(label, eager, repeat):
+    print(f'\n=== {label} ===')
+    for name, columns in REQUESTS.items():
+        samples = [simulate(columns, eager) for _ in range(repeat)]
+        queries, fetched, _ms = samples[0]
+        p50 = statistics.median(ms for _q, _b, ms in samples)
+        print(f'  {name:<20} queries={queries}  bytes={fetched:>9,}  p50={p50:7.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notebook-kb', type=int, default=50)
+    parser.add_argument('--todos', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = build_app(database_url)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        print(f'Seeding one user with a {args.notebook_kb} KB notebook and {args.todos} to-dos '
+              f'on {db.engine.dialect.name} ...')
+        seed(args.notebook_kb, args.todos)
+
+        run_phase('before: every user column loaded', eager=True, repeat=args.repeat)
+        run_phase('after: large text columns deferred', eager=False, repeat=args.repeat)
+
+
+if __name__ == '__main__':
+    main()
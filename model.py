@@ -2,6 +2,7 @@ from datetime import datetime
 
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import deferred
 
 
 db = SQLAlchemy()
@@ -13,21 +14,40 @@ class User(UserMixin, db.Model):
     password = db.Column(db.String(255), nullable=False)
     time_entries = db.relationship('TimeEntry', backref='user', lazy=True)
 
-    quick_note = db.Column(db.Text, default="")
-    notebook = db.Column(db.Text, default="")
+    # 大文本列都是 deferred：每个请求都会 load_user，但绝大多数接口用不到它们，
+    # 第一次访问属性时才单独查一次
+    quick_note = deferred(db.Column(db.Text, default=""))
+    notebook = deferred(db.Column(db.Text, default=""))
+    # 每次保存 +1；增量补丁带着 base 版本号提交，版本不对就 409
+    notebook_version = db.Column(db.Integer, default=0)
 
-    # To-Do checklist stored as a JSON array of {id, text, done}.
-    todos = db.Column(db.Text, default="[]")
+    # 旧版待办：{id, text, done} 的 JSON 数组。现在每条待办是 todo 表的一行，
+    # 启动时 services.todos.migrate_json_todos 把这里剩下的搬过去并清成 '[]'
+    todos = deferred(db.Column(db.Text, default="[]"))
 
     streak = db.Column(db.Integer, default=0)
     last_check_in = db.Column(db.String(20), default=None)
 
-    pomodoro_state = db.Column(db.Text, default=None)
+    pomodoro_state = deferred(db.Column(db.Text, default=None))
 
     profile = db.relationship('UserProfile', uselist=False, back_populates='user',
                               cascade='all, delete-orphan')
 
 
+class Todo(db.Model):
+    # 一条待办一行：勾选 / 改字 / 删除只动这一行。按 (user_id, position) 排序，
+    # position 相同（并发追加）时再按 id
+    __table_args__ = (
+        db.Index('ix_todo_user_position', 'user_id', 'position'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    text = db.Column(db.String(500), nullable=False)
+    done = db.Column(db.Boolean, nullable=False, default=False)
+
+
 class UserProfile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True,
@@ -72,6 +92,12 @@ class UserProfile(db.Model):
 class TimeEntry(db.Model):
     # 表名保留历史名 'expenses'：生产库已有数据且项目没有迁移框架，只重命名代码层的类名
     __tablename__ = 'expenses'
+    # 热路径都是 "某用户 + 活跃/某逻辑日，按 timestamp 排序"。
+    # 已有库不会被 create_all 补索引，启动时由 app.ensure_indexes() 幂等补建。
+    __table_args__ = (
+        db.Index('ix_expenses_user_archived_ts', 'user_id', 'is_archived', 'timestamp'),
+        db.Index('ix_expenses_user_archive_date_ts', 'user_id', 'archive_date', 'timestamp'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     desc = db.Column(db.String, nullable=False)
@@ -84,6 +110,52 @@ class TimeEntry(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
 
     category = db.Column(db.String(50), default="Uncategorized")
+    # 打分类时的 desc 快照；desc 之后被改过就和这里对不上，/api/visualize 会重新分类
+    categorized_desc = db.Column(db.String, nullable=True)
+    # 分类来源：'local' 是本地模型自己猜的（不再拿来训练模型），'llm'；NULL 是老数据
+    category_source = db.Column(db.String(10), nullable=True)
+    # 最近一次打上/改掉分类的时间，由 _stamp_labelled_at 在写入时填；本地分类模型按它补学
+    labelled_at = db.Column(db.DateTime, nullable=True)
+
+    # start_time/end_time 的整数镜像（当天第几分钟），写入时由 _fill_entry_minutes 填充，
+    # 统计直接 SUM(duration_minutes)，热路径不再解析字符串。老数据用 flask backfill-entry-minutes 回填。
+    start_minute = db.Column(db.Integer, nullable=True)
+    end_minute = db.Column(db.Integer, nullable=True)
+    duration_minutes = db.Column(db.Integer, nullable=True)
+
+    def refresh_minutes(self):
+        from services.stats import parse_clock_minutes, span_minutes
+        self.start_minute = parse_clock_minutes(self.start_time)
+        self.end_minute = parse_clock_minutes(self.end_time)
+        self.duration_minutes = span_minutes(self.start_minute, self.end_minute)
+
+
+@db.event.listens_for(TimeEntry, 'before_insert')
+@db.event.listens_for(TimeEntry, 'before_update')
+def _fill_entry_minutes(mapper, connection, target):
+    target.refresh_minutes()
+
+
+@db.event.listens_for(TimeEntry, 'before_insert')
+@db.event.listens_for(TimeEntry, 'before_update')
+def _stamp_labelled_at(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in ('category', 'categorized_desc', 'category_source')):
+        target.labelled_at = datetime.now()
+
+
+class DailyRollup(db.Model):
+    # 每用户、每逻辑日、每分类的汇总。由 services/rollup 在 flush 时随 TimeEntry 增删改同事务维护，
+    # flask rebuild-rollups 可从 expenses 全量重建。
+    __tablename__ = 'daily_rollup'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    logical_date = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(50), primary_key=True)
+
+    total_minutes = db.Column(db.Integer, nullable=False, default=0)
+    deep_minutes = db.Column(db.Integer, nullable=False, default=0)
+    entry_count = db.Column(db.Integer, nullable=False, default=0)
 
 
 class AlignmentSignal(db.Model):
@@ -5,8 +5,9 @@ from routes.notes import bp as notes_bp
 from routes.sse import bp as sse_bp
 from routes.ai import bp as ai_bp
 from routes.data import bp as data_bp
+from routes.metrics import bp as metrics_bp
 
 __all__ = [
     'auth_bp', 'main_bp', 'profile_bp', 'notes_bp',
-    'sse_bp', 'ai_bp', 'data_bp',
+    'sse_bp', 'ai_bp', 'data_bp', 'metrics_bp',
 ]
@@ -3,8 +3,7 @@ import time as time_module
 from datetime import datetime, timedelta, date
 
 import gevent
-import requests
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, Response, request, jsonify, session, stream_with_context
 from flask import current_app
 from flask_login import login_required, current_user
 from sqlalchemy import or_
@@ -12,18 +11,70 @@ from sqlalchemy import or_
 from model import db, TimeEntry, AlignmentSignal
 
 from routes.common import (
-    get_logical_date, load_todos, todos_to_text,
-    load_user_profile, _check_rate_limit,
+    get_logical_date, todos_to_text,
+    load_user_profile, _check_rate_limit, format_sse, notes_redis,
+)
+from services.audit import (
+    NO_ACTIVITY_LINE, TONE_TEMPERATURE, audit_failure, parse_ai_json, score_audit,
+    audit_cache_key, load_cached_audit, store_cached_audit,
+)
+from services.categorize import categorize_entries, category_totals, needs_category_filter
+from services.categorize_queue import enqueue_entries
+from services.jobs import JobQueueFull, public_job
+from services.note_buffer import read_fields
+from services.todos import list_todos
+from services.prompts import (
+    budget_audit_inputs, build_profile_section, get_audit_prompt, get_weekly_audit_prompt,
 )
-from services.prompts import get_audit_prompt, get_weekly_audit_prompt
-from services.stats import calculate_duration
 
 bp = Blueprint('ai', __name__)
 
+# 流式审计（/api/ai/audit 且 body 带 stream: true）下发的 SSE 事件
+AUDIT_EVENT_PROGRESS = 'progress'
+AUDIT_EVENT_DELTA = 'delta'
+AUDIT_EVENT_RESULT = 'result'
+AUDIT_PROGRESS_INTERVAL = 0.5
+
 
 @bp.route('/api/ai/audit', methods=['POST'])
 @login_required
 def ai_audit():
+    data = request.get_json() or {}
+    user_tone = data.get('tone', 'strict')
+    client_time = data.get('client_time')
+
+    logical_date = get_logical_date(datetime.now())
+    today_logs = TimeEntry.query.filter(
+        TimeEntry.user_id == current_user.id,
+        or_(
+            TimeEntry.archive_date == logical_date,
+            TimeEntry.is_archived == False
+        )
+    ).order_by(TimeEntry.timestamp, TimeEntry.id).all()
+
+    # 按时间先后排：超出 token 预算时 _fit_logs 保留的是列表末尾（最新）的记录
+    logs_data = [f"{log.start_time}-{log.end_time}: {log.desc}" for log in today_logs]
+    if not logs_data:
+        logs_data = [NO_ACTIVITY_LINE]
+
+    notebook = read_fields(notes_redis(), current_user, 'notebook')['notebook']
+    todos = list_todos(current_user.id)
+    quick_note = todos_to_text(todos)
+
+    profile = load_user_profile(current_user)
+
+    # 输入没变就直接返回上次的结果：不调模型，也不占限流额度和冷却时间
+    redis_client = getattr(current_app, 'redis_client', None)
+    cache_key = audit_cache_key(
+        current_user.id, user_tone, client_time, logs_data,
+        notebook, quick_note, build_profile_section(profile),
+    )
+    cached = load_cached_audit(redis_client, cache_key)
+    if cached is not None:
+        result = score_audit(cached, client_time, logs_data)
+        result['cached'] = True
+        return jsonify(result)
+
     if current_user.username != 'juncheng':
         limited, limit_msg = _check_rate_limit(current_user.id)
         if limited:
@@ -52,39 +103,22 @@ def ai_audit():
 
     session['last_audit_time'] = now.isoformat()
 
-    data = request.get_json() or {}
-    user_tone = data.get('tone', 'strict')
-    client_time = data.get('client_time')
-
-    logical_date = get_logical_date(datetime.now())
-    today_logs = TimeEntry.query.filter(
-        TimeEntry.user_id == current_user.id,
-        or_(
-            TimeEntry.archive_date == logical_date,
-            TimeEntry.is_archived == False
-        )
-    ).all()
-
-    logs_data = [f"{log.start_time}-{log.end_time}: {log.desc}" for log in today_logs]
-    if not logs_data:
-        logs_data = ["(No activity logged yet today)"]
-
-    notebook = current_user.notebook
-    quick_note = todos_to_text(load_todos(current_user))
-
-    profile = load_user_profile(current_user)
+    prompt_notebook, prompt_todos, prompt_logs, token_stats = budget_audit_inputs(
+        notebook, todos, logs_data, current_app.config.get('AUDIT_TOKEN_BUDGET', 6000),
+    )
+    current_app.logger.info(
+        'Audit prompt tokens user_id=%s %s', current_user.id,
+        ' '.join(f'{section}={sent}/{total}' for section, (total, sent) in token_stats.items()),
+    )
 
     system_prompt, user_prompt = get_audit_prompt(
-        notebook, quick_note, logs_data,
+        prompt_notebook, prompt_todos, prompt_logs,
         tone=user_tone,
         current_time=client_time,
         user_profile=profile,
     )
 
-    tone_temperature = {"gentle": 1.0, "roast": 0.8, "strict": 0.5}
-    audit_temperature = tone_temperature.get(user_tone, 0.5)
-
-    deepseek_api_key = current_app.config.get('DEEPSEEK_API_KEY')
+    audit_temperature = TONE_TEMPERATURE.get(user_tone, 0.5)
 
     payload = {
         "model": "deepseek-v4-flash",
@@ -98,72 +132,111 @@ def ai_audit():
         "response_format": {"type": "json_object"},
     }
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {deepseek_api_key}"
-    }
+    cache_ttl = current_app.config.get('AUDIT_CACHE_TTL_SECONDS', 0)
 
-    try:
-        response = requests.post(
-            "https://api.deepseek.com/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=45
+    if data.get('stream'):
+        return Response(
+            stream_with_context(_stream_audit(payload, client_time, logs_data, cache_key, cache_ttl)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
         )
-        response.raise_for_status()
 
-        full_res = response.json()
-        raw_content = full_res['choices'][0]['message']['content']
+    audit_args = (payload, client_time, logs_data, cache_key, cache_ttl)
 
-        clean_json = raw_content.replace("```json", "").replace("```", "").strip()
-        ai_data = json.loads(clean_json)
+    if data.get('async'):
+        # 立即返回任务 id，结果通过 job_finished SSE 事件或 GET /api/jobs/<id> 拿
+        try:
+            job = current_app.job_runner.submit(current_user.id, 'audit', _run_audit, *audit_args)
+        except JobQueueFull:
+            return jsonify({
+                "score": 0,
+                "status": "red",
+                "insight": "Audit queue is full.",
+                "warning": "Too many scans in flight. Try again shortly.",
+            }), 503
+        return jsonify(public_job(job)), 202
 
-        rubric = ai_data.get('rubric', {}).get('dimensions', [])
-        weighted_score = 0
-        if rubric:
-            for dim in rubric:
-                raw_total = sum(p.get('score', 0) for p in dim.get('points', []))
-                weighted_score += (raw_total / 20.0) * 100 * dim.get('weight', 0.25)
-        final_score = round(weighted_score)
+    return jsonify(_run_audit(*audit_args))
 
-        status = ai_data.get('status', 'green')
-        try:
-            hour = int(client_time.split(' ')[1].split(':')[0]) if client_time else 12
-        except Exception:
-            hour = datetime.now().hour
-        if hour >= 1 and hour < 6 and logs_data and logs_data[0] != "(No activity logged yet today)":
-            status = 'red'
-        elif final_score >= 70:
-            status = 'green'
-        elif final_score >= 40:
-            status = 'yellow'
-        else:
-            status = 'red'
 
-        return jsonify({
-            "score": final_score,
-            "status": status,
-            "insight": ai_data.get('insight', ''),
-            "warning": ai_data.get('warning', 'None'),
-            "rubric": rubric,
-        })
+def _run_audit(payload, client_time, logs_data, cache_key, cache_ttl):
+    """调模型 + 打分；失败时返回红灯结构而不是抛异常（同步和后台任务共用）"""
+    try:
+        raw_content = current_app.llm_client.chat(payload, call='audit')
+        ai_data = parse_ai_json(raw_content)
+        store_cached_audit(current_app.redis_client, cache_key, ai_data, cache_ttl)
+        return score_audit(ai_data, client_time, logs_data)
 
     except Exception as e:
         print(f"DeepSeek Error: {str(e)}")
-        return jsonify({
-            "score": 0,
-            "status": "red",
-            "insight": "DeepSeek Connection Failed",
-            "warning": f"Technical details: {str(e)}"
-        })
+        return audit_failure(e)
+
+
+def _stream_audit(payload, client_time, logs_data, cache_key, cache_ttl):
+    """把上游的流式输出转成 SSE 帧：思考阶段只报进度，正文逐块转发，最后一帧是打分结果"""
+    yield format_sse(AUDIT_EVENT_PROGRESS, {'phase': 'connecting'})
+    reasoning_chars = 0
+    content_parts = []
+    last_progress = 0.0
+    try:
+        for kind, text in current_app.llm_client.chat_stream(payload, call='audit_stream'):
+            if kind == 'content':
+                content_parts.append(text)
+                yield format_sse(AUDIT_EVENT_DELTA, {'text': text})
+                continue
+            reasoning_chars += len(text)
+            now = time_module.monotonic()
+            # 思考内容本身不下发，只节流地告诉前端"模型还在想"
+            if now - last_progress >= AUDIT_PROGRESS_INTERVAL:
+                last_progress = now
+                yield format_sse(AUDIT_EVENT_PROGRESS, {'phase': 'thinking', 'chars': reasoning_chars})
+
+        ai_data = parse_ai_json(''.join(content_parts))
+        store_cached_audit(current_app.redis_client, cache_key, ai_data, cache_ttl)
+        result = score_audit(ai_data, client_time, logs_data)
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        print(f"DeepSeek Error: {str(e)}")
+        result = audit_failure(e)
+    yield format_sse(AUDIT_EVENT_RESULT, result)
 
 
 @bp.route('/api/visualize', methods=['POST'])
 @login_required
 def visualize_data():
-    active_items = TimeEntry.query.filter_by(user_id=current_user.id, is_archived=False).all()
+    pending_items = TimeEntry.query.filter(
+        TimeEntry.user_id == current_user.id,
+        TimeEntry.is_archived == False,
+        needs_category_filter(),
+    ).all()
 
-    if not active_items:
+    # 分类由 categorize-worker 在写入时完成，这里只读已存分类；
+    # 漏掉的（老数据、改过 desc、任务失败）顺手重新入队。没有 Redis 时才退回同步分类。
+    queued = 0
+    redis_client = getattr(current_app, 'redis_client', None)
+    if pending_items and redis_client is not None:
+        enqueue_entries(redis_client, [item.id for item in pending_items], logger=current_app.logger)
+        queued = len(pending_items)
+    elif pending_items and (request.get_json(silent=True) or {}).get('async'):
+        try:
+            job = current_app.job_runner.submit(
+                current_user.id, 'visualize', _run_categorize,
+                current_user.id, [item.id for item in pending_items],
+            )
+        except JobQueueFull:
+            return jsonify({"error": "Taxonomy queue is full"}), 503
+        return jsonify(public_job(job)), 202
+    elif pending_items:
+        try:
+            categorize_entries(current_user.id, pending_items, current_app.llm_client, logger=current_app.logger)
+        except Exception as e:
+            print(f"AI/Network Error: {e}")
+            return jsonify({"error": "Taxonomy Engine Failed"}), 500
+
+    stats = category_totals(current_user.id)
+
+    if not stats:
         return jsonify({
             "labels": ["No Data Yet"],
             "data": [0],
@@ -171,89 +244,39 @@ def visualize_data():
             "message": "No data to analyze"
         }), 200
 
-    existing_tags = []
-    try:
-        recent_tags_query = db.session.query(TimeEntry.category).filter(
-            TimeEntry.user_id == current_user.id,
-            TimeEntry.category != "Uncategorized",
-            TimeEntry.category != None
-        ).distinct().limit(20).all()
-        existing_tags = [row[0] for row in recent_tags_query if row[0]]
-    except Exception:
-        pass
-
-    tags_context = ", ".join(existing_tags) if existing_tags else "None yet"
-
-    entries_text = "\n".join([f"ID_{item.id}: [{item.start_time}-{item.end_time}] {item.desc}" for item in active_items])
-
-    prompt = f"""
-    You are a data taxonomy engine. Group the following logs into 3-6 high-level categories.
-    
-    [Context Memory]
-    Existing Tags: {tags_context}
-    (Prioritize using these tags if they fit. Create new ones only if necessary.)
-    
-    [Rules]
-    1. Categories must be concise (1-2 words, e.g., "Coding", "Deep Work").
-    2. Every entry must have exactly ONE category.
-    3. Return ONLY valid JSON mapping Entry IDs to Categories.
-    
-    [Input Data]
-    {entries_text}
-    
-    [Output Format]
-    {{ "ID_1": "Coding", "ID_2": "Break" }}
-    """
-
-    deepseek_api_key = current_app.config.get('DEEPSEEK_API_KEY')
-
-    try:
-        payload = {
-            "model": "deepseek-v4-flash",
-            "messages": [
-                {"role": "system", "content": "Output strictly JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.1,
-            "stream": False,
-            "thinking": {"type": "disabled"}
-        }
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {deepseek_api_key}"
-        }
-
-        response = requests.post("https://api.deepseek.com/chat/completions", headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-
-        ai_content = response.json()['choices'][0]['message']['content']
-        clean_json = ai_content.replace("```json", "").replace("```", "").strip()
-        mapping = json.loads(clean_json)
-
-    except Exception as e:
-        print(f"AI/Network Error: {e}")
-        return jsonify({"error": "Taxonomy Engine Failed"}), 500
-
-    stats = {}
-
-    for item in active_items:
-        key = f"ID_{item.id}"
-        category = mapping.get(key, "Uncategorized")
-
-        item.category = category
-
-        duration = calculate_duration(item.start_time, item.end_time)
-        stats[category] = stats.get(category, 0) + duration
-
-    db.session.commit()
-
     return jsonify({
         "labels": list(stats.keys()),
         "data": list(stats.values()),
-        "total_minutes": sum(stats.values())
+        "total_minutes": sum(stats.values()),
+        "pending": queued,
     })
 
 
+def _run_categorize(user_id, entry_ids):
+    """后台任务版的同步分类（没有 Redis 队列时用），结果是图表数据"""
+    entries = TimeEntry.query.filter(
+        TimeEntry.id.in_(entry_ids),
+        TimeEntry.user_id == user_id,
+        needs_category_filter(),
+    ).all()
+    categorize_entries(user_id, entries, current_app.llm_client, logger=current_app.logger)
+    stats = category_totals(user_id)
+    return {
+        "labels": list(stats.keys()),
+        "data": list(stats.values()),
+        "total_minutes": sum(stats.values()),
+    }
+
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    job = current_app.job_runner.get(job_id)
+    if job is None or job.get('user_id') != current_user.id:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(public_job(job))
+
+
 @bp.route('/api/insights/weekly', methods=['POST'])
 @login_required
 def generate_weekly_insight():
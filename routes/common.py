@@ -1,21 +1,40 @@
 import json
 import re as _re
 from datetime import datetime, timedelta
-from flask import current_app
+from flask import current_app, has_app_context
 from model import db, UserProfile
+from services import metrics
+from services.note_buffer import read_fields
 
 # --- Event constants ---
 EVENT_ENTRY_CREATED = 'entry_created'
 EVENT_ENTRY_DELETED = 'entry_deleted'
 EVENT_NOTEBOOK_UPDATED = 'notebook_updated'
 EVENT_TODOS_UPDATED = 'todos_updated'
+EVENT_TODO_CREATED = 'todo_created'
+EVENT_TODO_UPDATED = 'todo_updated'
+EVENT_TODO_DELETED = 'todo_deleted'
+EVENT_POMODORO_UPDATED = 'pomodoro_updated'
+EVENT_ENTRIES_CATEGORIZED = 'entries_categorized'
+EVENT_JOB_FINISHED = 'job_finished'
 EVENT_HEARTBEAT = 'heartbeat'
+# 断线重连时 Last-Event-ID 已经不在 Redis Stream 里（被裁剪/过期），客户端需要整页刷新
+EVENT_RESYNC = 'resync'
 
 EVENT_PAYLOAD_SCHEMA = {
     EVENT_ENTRY_CREATED: ('id', 'desc', 'start_time', 'end_time', 'timestamp'),
     EVENT_ENTRY_DELETED: ('id',),
-    EVENT_NOTEBOOK_UPDATED: ('type', 'content', 'saved_at'),
+    # 笔记本增量保存只广播 patch（+ 版本号）；全文保存和 quick_note 仍带 content
+    EVENT_NOTEBOOK_UPDATED: ('type', 'version', 'base_version', 'patch', 'content', 'saved_at'),
     EVENT_TODOS_UPDATED: ('todos', 'saved_at'),
+    # 单条待办的增改删只广播这一条
+    EVENT_TODO_CREATED: ('id', 'text', 'done', 'position', 'saved_at'),
+    EVENT_TODO_UPDATED: ('id', 'text', 'done', 'position', 'saved_at'),
+    EVENT_TODO_DELETED: ('id', 'saved_at'),
+    # 只在开始/暂停/换阶段时推送；source 是发起保存的标签页，它自己收到后忽略
+    EVENT_POMODORO_UPDATED: ('remaining_seconds', 'phase', 'cycle_count', 'running', 'paused_at', 'source'),
+    EVENT_ENTRIES_CATEGORIZED: ('entries',),
+    EVENT_JOB_FINISHED: ('id', 'kind', 'status', 'result', 'error'),
 }
 
 SSE_EVENT_NAMES = set(EVENT_PAYLOAD_SCHEMA.keys())
@@ -42,6 +61,10 @@ def user_event_channel(user_id):
     return f"{current_app.config.get('REDIS_CHANNEL_PREFIX', 'onyx:user')}:{user_id}"
 
 
+def user_event_stream(user_id):
+    return f"{user_event_channel(user_id)}:stream"
+
+
 def publish_user_event(user_id, event_name, payload):
     if event_name not in SSE_EVENT_NAMES:
         current_app.logger.warning('SSE publish skipped: unknown event=%s', event_name)
@@ -58,6 +81,21 @@ def publish_user_event(user_id, event_name, payload):
         'sent_at': datetime.utcnow().isoformat() + 'Z',
     }
 
+    # 先写入有上限的 per-user Stream 拿到事件 id，再带着 id 广播；
+    # 重连的客户端用 Last-Event-ID 从 Stream 里补齐错过的事件
+    try:
+        stream_key = user_event_stream(user_id)
+        with redis_client.pipeline() as pipe:
+            pipe.xadd(stream_key, {
+                'event': event_name,
+                'data': json.dumps(payload),
+                'sent_at': message['sent_at'],
+            }, maxlen=current_app.config.get('SSE_REPLAY_MAXLEN', 200), approximate=True)
+            pipe.expire(stream_key, current_app.config.get('SSE_REPLAY_TTL_SECONDS', 86400))
+            message['id'] = pipe.execute()[0]
+    except Exception as e:
+        current_app.logger.warning('SSE replay log append failed event=%s user_id=%s error=%s', event_name, user_id, str(e))
+
     try:
         channel = user_event_channel(user_id)
         redis_client.publish(channel, json.dumps(message))
@@ -67,14 +105,24 @@ def publish_user_event(user_id, event_name, payload):
         return False
 
 
-def format_sse(event_name, data):
-    return f"event: {event_name}\ndata: {json.dumps(data)}\n\n"
+def format_sse(event_name, data, event_id=None):
+    id_line = f"id: {event_id}\n" if event_id else ""
+    return f"{id_line}event: {event_name}\ndata: {json.dumps(data)}\n\n"
 
 
 # --- To-Do helpers ---
 
+def notes_redis():
+    """笔记/待办写缓冲用的 Redis；没有 Redis 或 NOTES_FLUSH_SECONDS=0 时返回 None（直接写库）"""
+    if not current_app.config.get('NOTES_FLUSH_SECONDS'):
+        return None
+    return getattr(current_app, 'redis_client', None)
+
+
 def load_todos(user):
-    raw = user.todos or "[]"
+    """解析旧版 user.todos JSON（只剩迁移在用，见 services.todos.migrate_json_todos）"""
+    redis_client = notes_redis() if has_app_context() else None
+    raw = read_fields(redis_client, user, 'todos')['todos'] or "[]"
     try:
         items = json.loads(raw)
     except (ValueError, TypeError):
@@ -217,8 +265,10 @@ def _check_rate_limit(user_id):
             minute_count, hour_count, _, _ = pipe.execute()
 
         if minute_count > rate_limit_per_minute:
+            metrics.inc('audit_rate_limited', window='minute')
             return True, f"Rate limit: {rate_limit_per_minute}/minute. Slow down."
         if hour_count > rate_limit_per_hour:
+            metrics.inc('audit_rate_limited', window='hour')
             return True, f"Rate limit: {rate_limit_per_hour}/hour. Try again later."
         return False, ""
     except Exception:
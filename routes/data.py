@@ -1,10 +1,12 @@
 import json
 import time
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
 from flask_login import login_required, current_user
 from model import db, TimeEntry, AlignmentSignal
-from services.stats import calculate_stats_from_logs, calculate_duration
+from routes.common import publish_user_event, EVENT_POMODORO_UPDATED
+from services.pomodoro import load_state, normalize_state, save_state
+from services.stats import sum_entry_stats
 
 bp = Blueprint('data', __name__)
 
@@ -12,13 +14,14 @@ bp = Blueprint('data', __name__)
 @bp.route('/api/stats', methods=['GET'])
 @login_required
 def get_stats():
-    active_items = TimeEntry.query.filter_by(user_id=current_user.id, is_archived=False).all()
-    total_h, deep_h = calculate_stats_from_logs(active_items)
-    total_minutes = sum(calculate_duration(item.start_time, item.end_time) for item in active_items)
+    total_minutes, deep_minutes = sum_entry_stats(
+        TimeEntry.user_id == current_user.id,
+        TimeEntry.is_archived == False,
+    )
     return jsonify({
         "total_minutes": total_minutes,
-        "total_hours": total_h,
-        "deep_hours": deep_h,
+        "total_hours": round(total_minutes / 60, 1),
+        "deep_hours": round(deep_minutes / 60, 1),
     })
 
 
@@ -52,27 +55,20 @@ def pomodoro_save():
         data = request.get_json(silent=True) or json.loads(request.get_data(as_text=True) or '{}')
     except (ValueError, TypeError):
         data = {}
-    state = {
-        'remaining_seconds': int(data.get('remaining_seconds', 1500)),
-        'phase': data.get('phase', 'WORK'),
-        'cycle_count': int(data.get('cycle_count', 0)),
-        'running': bool(data.get('running', False)),
-        'paused_at': time.time(),
-    }
-    current_user.pomodoro_state = json.dumps(state)
-    db.session.commit()
+    state = normalize_state(data)
+    redis_client = getattr(current_app, 'redis_client', None)
+    # 计时中的 tick 只写 Redis；开始/暂停/换阶段才写库并推给其它设备
+    if save_state(redis_client, current_user, state, logger=current_app.logger):
+        payload = dict(state, source=str(data.get('source') or '')[:64])
+        publish_user_event(current_user.id, EVENT_POMODORO_UPDATED, payload)
     return jsonify({'status': 'success'})
 
 
 @bp.route('/api/pomodoro', methods=['GET'])
 @login_required
 def pomodoro_load():
-    raw = current_user.pomodoro_state
-    if not raw:
-        return jsonify({'state': None, 'server_now': time.time()})
-    try:
-        state = json.loads(raw)
-    except (ValueError, TypeError):
+    state = load_state(getattr(current_app, 'redis_client', None), current_user)
+    if state is None:
         return jsonify({'state': None, 'server_now': time.time()})
     state['server_now'] = time.time()
     return jsonify({'state': state, 'server_now': state['server_now']})
@@ -3,19 +3,23 @@ from datetime import datetime, timedelta, date
 from collections import OrderedDict
 from itertools import groupby
 
-from flask import Blueprint, render_template, request, redirect, jsonify
+from flask import Blueprint, current_app, render_template, request, redirect, jsonify
 from flask_login import login_required, current_user
-from model import db, User, TimeEntry, AlignmentSignal
+from model import db, User, TimeEntry, DailyRollup
 
 from routes.common import (
     serialize_entry, is_ajax_request, publish_user_event,
     EVENT_ENTRY_CREATED, EVENT_ENTRY_DELETED,
-    load_todos, migrate_quick_note_to_todos, get_logical_date,
-    load_user_profile,
+    migrate_quick_note_to_todos, get_logical_date,
+    load_user_profile, notes_redis,
 )
-from services.stats import calculate_stats_from_logs
+from services.dashboard import build_snapshot
 from services.streak import update_user_streak
-from services.history_helper import build_day_stats
+from services.history_helper import build_day_stats, build_day_stats_from_rollups
+from services.archive import archive_all_active
+from services.categorize_queue import enqueue_entries
+from services.note_buffer import read_fields, save_fields
+from services.todos import clear_todos, list_todos, replace_todos
 
 bp = Blueprint('main', __name__)
 
@@ -45,6 +49,7 @@ def index():
 
             payload = serialize_entry(item)
             publish_user_event(current_user.id, EVENT_ENTRY_CREATED, payload)
+            enqueue_entries(current_app.redis_client, [item.id], logger=current_app.logger)
 
             if is_ajax_request(request):
                 return jsonify({'status': 'success', 'entry': payload})
@@ -55,45 +60,18 @@ def index():
             return f'Error: {str(e)}'
 
     else:
-        now = datetime.now()
-        current_logical_date = get_logical_date(now)
+        snapshot = build_snapshot(current_user, get_logical_date(datetime.now()),
+                                  getattr(current_app, 'redis_client', None))
+        # 跨天记录的归档由后台 sweep（services/archive.py）在 06:00 统一完成，页面加载不再写库
 
-        active_items = TimeEntry.query.filter_by(user_id=current_user.id, is_archived=False).all()
-
-        items_to_archive = False
-        for item in active_items:
-            item_logical_date = get_logical_date(item.timestamp)
-
-            if item_logical_date < current_logical_date:
-                item.is_archived = True
-                item.archive_date = item_logical_date
-                items_to_archive = True
-
-        if items_to_archive:
-            db.session.commit()
-
-        old_streak = current_user.streak
-        update_user_streak(current_user, current_logical_date)
-        streak_incremented = current_user.streak > old_streak
-        if current_user.streak != old_streak:
-            db.session.commit()
-
-        entries = TimeEntry.query.filter_by(user_id=current_user.id, is_archived=False).order_by(TimeEntry.timestamp.desc()).all()
-
-        total_h, deep_h = calculate_stats_from_logs(entries)
-
-        rlhf_count = AlignmentSignal.query.filter_by(user_id=current_user.id).count()
-
-        model_confidence = min(99, 75 + int(rlhf_count / 5))
-
-        todos = load_todos(current_user)
-        if not todos and (current_user.quick_note or '').strip():
-            todos = migrate_quick_note_to_todos(current_user.quick_note)
-            current_user.todos = json.dumps(todos)
-            current_user.quick_note = ""
+        notes = read_fields(notes_redis(), current_user, 'quick_note', 'notebook', 'notebook_version')
+        if not snapshot['todos'] and (notes['quick_note'] or '').strip():
+            replace_todos(current_user.id, migrate_quick_note_to_todos(notes['quick_note']))
             db.session.commit()
+            save_fields(notes_redis(), current_user, logger=current_app.logger, quick_note="")
+            snapshot['todos'] = list_todos(current_user.id)
 
-        profile = load_user_profile(current_user)
+        profile = snapshot['profile'] or load_user_profile(current_user)
         onboarding_needed = (
             profile.primary_goal == ''
             and json.loads(profile.interests or '[]') == []
@@ -101,34 +79,46 @@ def index():
 
         return render_template(
             'index.html',
-            entries=entries,
-            total_hours=total_h,
-            deep_hours=deep_h,
-            rlhf_count=rlhf_count,
-            model_confidence=model_confidence,
-            todos=todos,
-            todos_json=json.dumps(todos),
-            streak_incremented=streak_incremented,
-            streak=current_user.streak,
+            entries=snapshot['entries'],
+            total_hours=snapshot['stats']['total_hours'],
+            deep_hours=snapshot['stats']['deep_hours'],
+            rlhf_count=snapshot['rlhf_count'],
+            model_confidence=snapshot['model_confidence'],
+            todos=snapshot['todos'],
+            todos_json=json.dumps(snapshot['todos']),
+            notebook=notes['notebook'],
+            notebook_version=notes['notebook_version'],
+            streak_incremented=snapshot['streak_incremented'],
+            streak=snapshot['streak'],
             onboarding_needed=onboarding_needed,
+            # 前端从这里取统计 / 图表 / 番茄钟，首屏不再另外请求
+            dashboard=_snapshot_json(snapshot),
         )
 
 
+def _snapshot_json(snapshot):
+    data = {k: v for k, v in snapshot.items() if k not in ('entries', 'profile')}
+    data['entries'] = [serialize_entry(entry) for entry in snapshot['entries']]
+    return data
+
+
+@bp.route('/api/dashboard', methods=['GET'])
+@login_required
+def dashboard_snapshot():
+    snapshot = build_snapshot(current_user, get_logical_date(datetime.now()),
+                              getattr(current_app, 'redis_client', None))
+    return jsonify(_snapshot_json(snapshot))
+
+
 @bp.route('/end_day', methods=['POST'])
 @login_required
 def end_day():
-    active_items = TimeEntry.query.filter_by(user_id=current_user.id, is_archived=False).all()
-
     current_logical_date = get_logical_date(datetime.now())
+    archive_all_active(current_user.id, current_logical_date)
 
-    for item in active_items:
-        item.is_archived = True
-        item.archive_date = current_logical_date
-
-    current_user.quick_note = ""
-    current_user.todos = "[]"
-
+    clear_todos(current_user.id)
     db.session.commit()
+    save_fields(notes_redis(), current_user, logger=current_app.logger, quick_note="")
     return redirect('/')
 
 
@@ -181,13 +171,23 @@ def history():
         TimeEntry.timestamp.desc()
     ).all()
 
+    # 每日统计读汇总表（每天每分类一行），而不是在 Python 里重算每一条记录
+    rollups_by_day = {}
+    for row in DailyRollup.query.filter(
+        DailyRollup.user_id == current_user.id,
+        DailyRollup.logical_date >= start_date,
+        DailyRollup.logical_date <= end_date,
+    ).all():
+        rollups_by_day.setdefault(row.logical_date, []).append(row)
+
     grouped_history = OrderedDict()
 
     for archive_date, group in groupby(items, key=lambda x: x.archive_date):
         day_items = list(group)
+        day_rollups = rollups_by_day.get(archive_date)
         grouped_history[archive_date] = {
             'items': day_items,
-            'stats': build_day_stats(day_items),
+            'stats': build_day_stats_from_rollups(day_rollups) if day_rollups else build_day_stats(day_items),
         }
 
     total_entries = len(items)
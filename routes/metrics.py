@@ -0,0 +1,45 @@
+import hmac
+import ipaddress
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from services import metrics
+
+bp = Blueprint('metrics', __name__)
+
+
+def _has_token(req):
+    token = current_app.config.get('METRICS_TOKEN')
+    return bool(token) and hmac.compare_digest(req.headers.get('Authorization', ''), f'Bearer {token}')
+
+
+def _from_allowed_addr(req):
+    # 经 Nginx 转发的请求 remote_addr 是代理自己的地址：带了 X-Forwarded-For 就是外面转进来的
+    if 'X-Forwarded-For' in req.headers:
+        return False
+    try:
+        addr = ipaddress.ip_address(req.remote_addr or '')
+    except ValueError:
+        return False
+    for cidr in current_app.config.get('METRICS_ALLOW_CIDRS', '').split(','):
+        cidr = cidr.strip()
+        if not cidr:
+            continue
+        try:
+            if addr in ipaddress.ip_network(cidr, strict=False):
+                return True
+        except ValueError:
+            current_app.logger.warning('Ignoring invalid METRICS_ALLOW_CIDRS entry: %s', cidr)
+    return False
+
+
+@bp.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not (_has_token(request) or _from_allowed_addr(request)):
+        abort(404)
+    # 配了 METRICS_DIR 时合并所有 gunicorn worker，否则只有处理这次请求的 worker
+    directory = current_app.config.get('METRICS_DIR') or None
+    max_age = metrics.STALE_AFTER_DUMPS * current_app.config.get('METRICS_DUMP_SECONDS', 5)
+    counters, gauges, kinds = metrics.collect(directory, max_age_seconds=max_age)
+    return Response(metrics.render_prometheus(counters, gauges, kinds),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
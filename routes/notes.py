@@ -1,49 +1,161 @@
-import json
 from datetime import datetime
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
 from flask_login import login_required, current_user
 
 from routes.common import (
-    sanitize_todos, publish_user_event,
+    sanitize_todos, publish_user_event, notes_redis,
     EVENT_NOTEBOOK_UPDATED, EVENT_TODOS_UPDATED,
+    EVENT_TODO_CREATED, EVENT_TODO_UPDATED, EVENT_TODO_DELETED,
+)
+from model import db
+from services.note_buffer import patch_notebook, read_fields, save_fields
+from services.text_patch import PatchError
+from services.todos import (
+    MAX_TODOS, TodoLimitReached, add_todo, clean_text, delete_todo,
+    list_todos, replace_todos, serialize_todo, update_todo,
 )
 
 bp = Blueprint('notes', __name__)
 
 
+@bp.route('/api/notes', methods=['GET'])
+@login_required
+def get_notes():
+    """当前笔记本全文 + 版本号；客户端错过补丁事件时用来重新对齐"""
+    state = read_fields(notes_redis(), current_user, 'notebook', 'notebook_version')
+    return jsonify({"notebook": state['notebook'], "version": state['notebook_version']})
+
+
 @bp.route('/api/notes', methods=['POST'])
 @login_required
 def save_notes():
-    data = request.json
+    data = request.get_json() or {}
     note_type = data.get('type')
-    content = data.get('content')
 
+    if note_type != 'quick_note' and 'patch' in data:
+        return _patch_notebook(data)
+
+    content = data.get('content')
+    payload = {'type': note_type, 'content': content}
     if (note_type == 'quick_note'):
-        current_user.quick_note = content
+        save_fields(notes_redis(), current_user, logger=current_app.logger, quick_note=content)
     else:
-        current_user.notebook = content
+        # 全文覆盖（旧客户端）：同样推进版本号，让别的标签页的补丁基线失效
+        payload['version'] = save_fields(notes_redis(), current_user, logger=current_app.logger,
+                                         notebook=content)
+
+    saved_at = datetime.now().strftime("%H:%M:%S")
+    payload['saved_at'] = saved_at
+    publish_user_event(current_user.id, EVENT_NOTEBOOK_UPDATED, payload)
+    response = {"status": "success", "saved_at": saved_at}
+    if 'version' in payload:
+        response['version'] = payload['version']
+    return jsonify(response)
+
+
+def _patch_notebook(data):
+    """{type: 'notebook', base_version, patch: [{pos, del, ins}, ...]}；
+    base_version 不是最新版本就 409，并带回最新全文让客户端 rebase"""
+    base_version = data.get('base_version')
+    if not isinstance(base_version, int) or isinstance(base_version, bool):
+        return jsonify({"status": "error", "message": "base_version must be an integer"}), 400
+
+    patch = data.get('patch')
+    try:
+        ok, version, notebook = patch_notebook(notes_redis(), current_user, base_version, patch)
+    except PatchError as exc:
+        return jsonify({"status": "error", "message": f"Invalid patch: {exc}"}), 400
+    if not ok:
+        return jsonify({
+            "status": "conflict",
+            "message": "Notebook changed since base_version",
+            "version": version,
+            "notebook": notebook,
+        }), 409
 
-    from model import db
-    db.session.commit()
     saved_at = datetime.now().strftime("%H:%M:%S")
     publish_user_event(current_user.id, EVENT_NOTEBOOK_UPDATED, {
-        'type': note_type,
-        'content': content,
+        'type': 'notebook',
+        'version': version,
+        'base_version': base_version,
+        'patch': patch,
         'saved_at': saved_at,
     })
-    return jsonify({"status": "success", "saved_at": saved_at})
+    return jsonify({"status": "success", "saved_at": saved_at, "version": version})
+
+
+def _todo_event(event_name, payload):
+    saved_at = datetime.now().strftime("%H:%M:%S")
+    publish_user_event(current_user.id, event_name, dict(payload, saved_at=saved_at))
+    return saved_at
+
+
+@bp.route('/api/todos', methods=['GET'])
+@login_required
+def get_todos():
+    return jsonify({"todos": list_todos(current_user.id)})
 
 
 @bp.route('/api/todos', methods=['POST'])
 @login_required
-def save_todos():
-    data = request.json or {}
-    todos = sanitize_todos(data.get('todos', []))
+def create_todo():
+    data = request.get_json() or {}
+    if 'todos' in data:
+        return _replace_todos(data)
+
+    text = clean_text(data.get('text'))
+    if text is None:
+        return jsonify({"status": "error", "message": "text is required"}), 400
+    try:
+        todo = serialize_todo(add_todo(current_user.id, text, done=bool(data.get('done', False))))
+    except TodoLimitReached:
+        return jsonify({"status": "error", "message": f"At most {MAX_TODOS} tasks"}), 400
+
+    saved_at = _todo_event(EVENT_TODO_CREATED, todo)
+    return jsonify({"status": "success", "saved_at": saved_at, "todo": todo}), 201
+
+
+@bp.route('/api/todos/<int:todo_id>', methods=['PATCH'])
+@login_required
+def patch_todo(todo_id):
+    data = request.get_json() or {}
+    values = {}
+    if 'text' in data:
+        values['text'] = clean_text(data['text'])
+        if values['text'] is None:
+            return jsonify({"status": "error", "message": "text must not be empty"}), 400
+    if 'done' in data:
+        values['done'] = bool(data['done'])
+    if 'position' in data:
+        if not isinstance(data['position'], int) or isinstance(data['position'], bool):
+            return jsonify({"status": "error", "message": "position must be an integer"}), 400
+        values['position'] = data['position']
+    if not values:
+        return jsonify({"status": "error", "message": "Nothing to update"}), 400
+
+    todo = update_todo(current_user.id, todo_id, **values)
+    if todo is None:
+        return jsonify({"status": "error", "message": "Not found"}), 404
+    saved_at = _todo_event(EVENT_TODO_UPDATED, todo)
+    return jsonify({"status": "success", "saved_at": saved_at, "todo": todo})
+
+
+@bp.route('/api/todos/<int:todo_id>', methods=['DELETE'])
+@login_required
+def remove_todo(todo_id):
+    if not delete_todo(current_user.id, todo_id):
+        return jsonify({"status": "error", "message": "Not found"}), 404
+    saved_at = _todo_event(EVENT_TODO_DELETED, {'id': todo_id})
+    return jsonify({"status": "success", "saved_at": saved_at})
+
 
-    current_user.todos = json.dumps(todos)
-    from model import db
+def _replace_todos(data):
+    """旧的整表保存：{todos: [...]} 替换全部待办并广播整张列表"""
+    items = sanitize_todos(data.get('todos', []))
+    replace_todos(current_user.id, items)
     db.session.commit()
+    todos = list_todos(current_user.id)
 
     saved_at = datetime.now().strftime("%H:%M:%S")
     publish_user_event(current_user.id, EVENT_TODOS_UPDATED, {
@@ -1,72 +1,147 @@
 import json
+import re
 import time
 from datetime import datetime, timezone
 
-import gevent
-from flask import Blueprint, Response, stream_with_context
+from gevent.queue import Empty
+from flask import Blueprint, Response, request, stream_with_context
 from flask import current_app
 from flask_login import login_required, current_user
 
 from routes.common import (
-    format_sse, user_event_channel,
-    SSE_EVENT_NAMES, EVENT_HEARTBEAT,
+    format_sse, user_event_stream,
+    SSE_EVENT_NAMES, EVENT_HEARTBEAT, EVENT_RESYNC,
 )
+from services import metrics
+from services.sse_broker import OVERFLOW
 
 bp = Blueprint('sse', __name__)
 
 
+def _heartbeat_frame():
+    return format_sse(EVENT_HEARTBEAT, {'ts': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')})
+
+
+_STREAM_ID_RE = re.compile(r'^\d+-\d+$')
+
+
+def _stream_id_key(event_id):
+    ms, seq = event_id.split('-')
+    return int(ms), int(seq)
+
+
+def replay_missed_events(redis_client, user_id, last_event_id):
+    """Frames for every event after `last_event_id` in the user's Redis Stream.
+
+    Returns (frames, last_replayed_id). If the id has already been trimmed from
+    the stream the gap cannot be filled, so a single `resync` frame is returned
+    and the client reloads instead.
+    """
+    entries = redis_client.xrange(user_event_stream(user_id), min=last_event_id, max='+')
+    if not entries or entries[0][0] != last_event_id:
+        return [format_sse(EVENT_RESYNC, {'reason': 'history_unavailable'})], None
+
+    frames = []
+    for entry_id, fields in entries[1:]:
+        if fields.get('event') not in SSE_EVENT_NAMES:
+            continue
+        try:
+            data = json.loads(fields.get('data') or '{}')
+        except (ValueError, TypeError):
+            continue
+        frames.append(format_sse(fields['event'], data, event_id=entry_id))
+    return frames, entries[-1][0]
+
+
+def _record_delivery(payload):
+    """publish_user_event 打的 sent_at 到交给这个连接之间的延迟（跨 Redis pub/sub + broker 队列）"""
+    sent_at = payload.get('sent_at')
+    if not sent_at:
+        return
+    try:
+        sent = datetime.fromisoformat(sent_at.rstrip('Z')).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return
+    latency = (datetime.now(timezone.utc) - sent).total_seconds()
+    metrics.histogram('sse_delivery_seconds', max(latency, 0.0), event=payload.get('event'))
+
+
+def iter_stream_frames(queue, heartbeat_seconds, after_id=None):
+    """Block on the connection's queue; the get() timeout doubles as the heartbeat timer.
+
+    An idle connection therefore wakes up once per heartbeat interval instead of
+    polling, and any delivered event pushes the next heartbeat back. Events at
+    or before `after_id` were already sent by the replay and are skipped. The
+    frames end when the broker marks the queue as overflowed.
+    """
+    after_key = _stream_id_key(after_id) if after_id else None
+    next_heartbeat = time.monotonic() + heartbeat_seconds
+    while True:
+        try:
+            payload = queue.get(timeout=max(next_heartbeat - time.monotonic(), 0))
+        except Empty:
+            yield _heartbeat_frame()
+            next_heartbeat = time.monotonic() + heartbeat_seconds
+            continue
+
+        if payload is OVERFLOW:
+            # broker 清掉了这条流：结束响应，EventSource 带 Last-Event-ID 重连补齐
+            return
+        event_name = payload.get('event') if payload else None
+        if event_name not in SSE_EVENT_NAMES:
+            continue
+        event_id = payload.get('id')
+        if after_key and event_id and _stream_id_key(event_id) <= after_key:
+            continue
+        _record_delivery(payload)
+        yield format_sse(event_name, payload.get('data', {}), event_id=event_id)
+        next_heartbeat = time.monotonic() + heartbeat_seconds
+
+
 @bp.route('/api/events', methods=['GET'])
 @login_required
 def stream_events():
     user_id = current_user.id
-    channel = user_event_channel(user_id)
     sse_heartbeat_seconds = current_app.config.get('SSE_HEARTBEAT_SECONDS', 25)
     redis_client = getattr(current_app, 'redis_client', None)
+    broker = getattr(current_app, 'sse_broker', None)
+    last_event_id = (request.headers.get('Last-Event-ID') or '').strip()
+    if not _STREAM_ID_RE.match(last_event_id):
+        last_event_id = None
 
     @stream_with_context
     def event_stream():
-        pubsub = None
-        last_heartbeat = time.monotonic()
-        current_app.logger.info('SSE connect user_id=%s channel=%s', user_id, channel)
+        queue = None
         try:
-            if redis_client is None:
+            if redis_client is None or broker is None:
                 current_app.logger.warning('SSE stream unavailable: Redis unavailable user_id=%s', user_id)
                 yield format_sse(EVENT_HEARTBEAT, {'status': 'redis_unavailable'})
                 return
 
-            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
-            pubsub.subscribe(channel)
-
-            while True:
-                message = pubsub.get_message(timeout=1.0)
-                if message and message.get('type') == 'message':
-                    try:
-                        payload = json.loads(message.get('data') or '{}')
-                    except Exception:
-                        payload = {}
-
-                    event_name = payload.get('event')
-                    event_data = payload.get('data', {})
-                    if event_name in SSE_EVENT_NAMES:
-                        yield format_sse(event_name, event_data)
-                        last_heartbeat = time.monotonic()
-
-                if time.monotonic() - last_heartbeat >= sse_heartbeat_seconds:
-                    yield format_sse(EVENT_HEARTBEAT, {'ts': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')})
-                    last_heartbeat = time.monotonic()
-                gevent.sleep(0.01)
+            queue = broker.subscribe(user_id)
+            current_app.logger.info('SSE connect user_id=%s streams=%s', user_id, broker.stats()['streams'])
+
+            # 先订阅再回放：回放期间新到的事件留在队列里，按 id 去重
+            replayed_up_to = None
+            if last_event_id:
+                try:
+                    frames, replayed_up_to = replay_missed_events(redis_client, user_id, last_event_id)
+                except Exception as e:
+                    current_app.logger.warning('SSE replay failed user_id=%s error=%s', user_id, str(e))
+                    frames = [format_sse(EVENT_RESYNC, {'reason': 'replay_failed'})]
+                current_app.logger.info('SSE resume user_id=%s last_event_id=%s replayed=%s',
+                                        user_id, last_event_id, len(frames))
+                for frame in frames:
+                    yield frame
+            yield from iter_stream_frames(queue, sse_heartbeat_seconds, after_id=replayed_up_to)
         except GeneratorExit:
-            current_app.logger.info('SSE disconnect user_id=%s channel=%s reason=client_closed', user_id, channel)
+            current_app.logger.info('SSE disconnect user_id=%s reason=client_closed', user_id)
         except Exception as e:
             current_app.logger.exception('SSE stream error user_id=%s error=%s', user_id, str(e))
         finally:
-            if pubsub is not None:
-                try:
-                    pubsub.unsubscribe(channel)
-                    pubsub.close()
-                except Exception:
-                    pass
-            current_app.logger.info('SSE cleanup user_id=%s channel=%s', user_id, channel)
+            if queue is not None:
+                broker.unsubscribe(user_id, queue)
+            current_app.logger.info('SSE cleanup user_id=%s', user_id)
 
     response = Response(event_stream(), mimetype='text/event-stream')
     response.headers['Cache-Control'] = 'no-cache'
@@ -0,0 +1,80 @@
+"""Set-based archival of finished logical days.
+
+A logical day runs 06:00 -> 06:00, so every active entry stamped before the
+current day's 06:00 belongs to an earlier day and can be archived with one
+UPDATE instead of loading and checking each row in Python.
+"""
+from datetime import datetime, time, timedelta
+
+import gevent
+from sqlalchemy import Date, cast, func, update
+
+from model import db, TimeEntry
+
+LOGICAL_DAY_START = time(6, 0)
+
+
+def logical_day_boundary(now=None):
+    """当前逻辑日开始的时刻（今天或昨天的 06:00）"""
+    now = now or datetime.now()
+    boundary = datetime.combine(now.date(), LOGICAL_DAY_START)
+    if now < boundary:
+        boundary -= timedelta(days=1)
+    return boundary
+
+
+def logical_date_sql(timestamp_column):
+    """SQL 版 get_logical_date：timestamp 往前推 6 小时后取日期"""
+    if db.engine.dialect.name == 'sqlite':
+        return func.date(timestamp_column, '-6 hours')
+    return cast(timestamp_column - timedelta(hours=6), Date)
+
+
+def archive_stale_entries(user_id=None, now=None):
+    """归档逻辑日已经结束的活跃记录（不传 user_id 则处理所有用户），返回归档条数。
+    不提交：End Day 要和清空待办一起提交，sweeper / CLI 自己 commit"""
+    criteria = [
+        TimeEntry.is_archived == False,
+        TimeEntry.timestamp < logical_day_boundary(now),
+    ]
+    if user_id is not None:
+        criteria.append(TimeEntry.user_id == user_id)
+
+    result = db.session.execute(
+        update(TimeEntry)
+        .where(*criteria)
+        .values(
+            is_archived=True,
+            # 新记录写入时 archive_date 已经是逻辑日；只有老数据要按 timestamp 推算
+            archive_date=func.coalesce(TimeEntry.archive_date, logical_date_sql(TimeEntry.timestamp)),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def archive_all_active(user_id, logical_date):
+    """End Day：先把跨天遗留的记录归到各自的逻辑日，其余归到今天"""
+    archive_stale_entries(user_id=user_id)
+    result = db.session.execute(
+        update(TimeEntry)
+        .where(TimeEntry.user_id == user_id, TimeEntry.is_archived == False)
+        .values(is_archived=True, archive_date=logical_date)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def run_archive_sweeper(app, grace_seconds=5):
+    """后台 greenlet：启动时先补扫一次，之后每到逻辑日边界 (06:00) 归档所有用户"""
+    while True:
+        try:
+            with app.app_context():
+                archived = archive_stale_entries()
+                db.session.commit()
+                if archived:
+                    app.logger.info('Archive sweep archived %s entries', archived)
+        except Exception as exc:
+            app.logger.exception('Archive sweep failed: %s', exc)
+        next_boundary = logical_day_boundary() + timedelta(days=1)
+        gevent.sleep((next_boundary - datetime.now()).total_seconds() + grace_seconds)
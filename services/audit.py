@@ -0,0 +1,116 @@
+"""Neural Audit result handling shared by the blocking and streaming endpoints."""
+import hashlib
+import json
+from datetime import datetime
+
+from services import metrics
+from services.circuit_breaker import CircuitOpenError
+
+NO_ACTIVITY_LINE = "(No activity logged yet today)"
+
+TONE_TEMPERATURE = {"gentle": 1.0, "roast": 0.8, "strict": 0.5}
+
+
+def parse_ai_json(raw_content):
+    """去掉模型偶尔包上的 ```json 代码块标记后解析 JSON"""
+    clean_json = raw_content.replace("```json", "").replace("```", "").strip()
+    return json.loads(clean_json)
+
+
+def score_audit(ai_data, client_time, logs_data):
+    """rubric 加权打分 + 状态灯，返回给前端的最终结果"""
+    rubric = ai_data.get('rubric', {}).get('dimensions', [])
+    weighted_score = 0
+    if rubric:
+        for dim in rubric:
+            raw_total = sum(p.get('score', 0) for p in dim.get('points', []))
+            weighted_score += (raw_total / 20.0) * 100 * dim.get('weight', 0.25)
+    final_score = round(weighted_score)
+
+    status = ai_data.get('status', 'green')
+    try:
+        hour = int(client_time.split(' ')[1].split(':')[0]) if client_time else 12
+    except Exception:
+        hour = datetime.now().hour
+    if hour >= 1 and hour < 6 and logs_data and logs_data[0] != NO_ACTIVITY_LINE:
+        status = 'red'
+    elif final_score >= 70:
+        status = 'green'
+    elif final_score >= 40:
+        status = 'yellow'
+    else:
+        status = 'red'
+
+    return {
+        "score": final_score,
+        "status": status,
+        "insight": ai_data.get('insight', ''),
+        "warning": ai_data.get('warning', 'None'),
+        "rubric": rubric,
+    }
+
+
+def audit_failure(exc):
+    if isinstance(exc, CircuitOpenError):
+        # 上游故障期间快速失败，不再让用户等满超时
+        return {
+            "score": 0,
+            "status": "red",
+            "insight": "DeepSeek is degraded. Audit paused.",
+            "warning": f"Technical details: {str(exc)}"
+        }
+    return {
+        "score": 0,
+        "status": "red",
+        "insight": "DeepSeek Connection Failed",
+        "warning": f"Technical details: {str(exc)}"
+    }
+
+
+# --- Result cache ---
+# 同一天、同一小时内输入完全没变时重复点审计，直接复用上一次模型输出。
+# 缓存的是模型返回的原始 JSON，命中后仍按本次 client_time 重新打分。
+
+def _time_bucket(client_time):
+    """'2026-07-16 12:34 (Thursday)' -> '2026-07-16 12'；提示词里的时段规则按小时区分"""
+    text = str(client_time or '').strip()
+    try:
+        return datetime.strptime(text[:13], '%Y-%m-%d %H').strftime('%Y-%m-%d %H')
+    except ValueError:
+        return datetime.now().strftime('%Y-%m-%d %H')
+
+
+def audit_cache_key(user_id, tone, client_time, logs_data, notebook, quick_note, profile_text):
+    normalized = {
+        'tone': tone or 'strict',
+        'hour': _time_bucket(client_time),
+        'logs': [line.strip() for line in logs_data],
+        'notebook': (notebook or '').strip(),
+        'todos': (quick_note or '').strip(),
+        'profile': (profile_text or '').strip(),
+    }
+    digest = hashlib.sha256(
+        json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+    return f"audit:cache:{user_id}:{digest}"
+
+
+def load_cached_audit(redis_client, key):
+    """返回缓存的模型输出 dict；未命中或 Redis 不可用返回 None"""
+    if redis_client is None:
+        return None
+    try:
+        raw = redis_client.get(key)
+    except Exception:
+        return None
+    metrics.inc('audit_cache', result='hit' if raw else 'miss')
+    return json.loads(raw) if raw else None
+
+
+def store_cached_audit(redis_client, key, ai_data, ttl_seconds):
+    if redis_client is None or not ttl_seconds:
+        return
+    try:
+        redis_client.set(key, json.dumps(ai_data), ex=ttl_seconds)
+    except Exception:
+        pass
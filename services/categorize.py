@@ -0,0 +1,317 @@
+"""Entry categorization helpers.
+
+Most users log the same handful of activities every day, so before asking the
+LLM we try a small per-user classifier trained on the user's own labelled
+history: an exact lookup on the normalized description, then a token n-gram
+vote. Only entries it is not confident about go upstream.
+"""
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, not_, or_
+
+from model import db, TimeEntry
+from services import metrics
+from services.audit import parse_ai_json
+from services.stats import entry_minutes
+
+UNCATEGORIZED = "Uncategorized"
+SOURCE_LOCAL = 'local'
+SOURCE_LLM = 'llm'
+
+# 精确匹配：同一描述至少出现过 EXACT_MIN_SUPPORT 次，且多数分类占比够高
+EXACT_MIN_SUPPORT = 2
+EXACT_MIN_SHARE = 0.8
+# n-gram 投票：至少有一个特征在 NGRAM_MIN_SUPPORT 条记录里出现过，且头名分类占比够高才算有把握
+NGRAM_MIN_SUPPORT = 3
+NGRAM_MIN_SHARE = 0.85
+
+MODEL_CACHE_SIZE = 512
+MODEL_MAX_AGE_SECONDS = 3600
+# 补学时往回重叠的秒数，盖住“打上 labelled_at”到“提交”之间的时间
+LABEL_LAG_SECONDS = 120
+
+_TOKEN_RE = re.compile(r"[a-z]+|[\u4e00-\u9fff]")
+
+
+def needs_category_filter():
+    """还没分类、或分类之后 desc 被改过的记录。
+    categorized_desc 为空但已有分类的是加这一列之前分好的老数据，视为有效。"""
+    return or_(
+        TimeEntry.category == None,
+        TimeEntry.category == UNCATEGORIZED,
+        and_(TimeEntry.categorized_desc != None, TimeEntry.categorized_desc != TimeEntry.desc),
+    )
+
+
+def needs_category(entry):
+    """needs_category_filter 的 Python 版，给已经加载的记录用"""
+    return (
+        entry.category is None
+        or entry.category == UNCATEGORIZED
+        or (entry.categorized_desc is not None and entry.categorized_desc != entry.desc)
+    )
+
+
+def category_totals_from_entries(entries):
+    """category_totals 的 Python 版：记录已经在内存里时不必再 GROUP BY 一次。
+    分钟数和 stats 一样走 entry_minutes，还没回填 duration_minutes 的老数据也算进去"""
+    totals = {}
+    for entry in entries:
+        category = entry.category or UNCATEGORIZED
+        totals[category] = totals.get(category, 0) + (entry_minutes(entry) or 0)
+    return totals
+
+
+def category_totals(user_id):
+    """按已存分类汇总活跃记录的分钟数 -> {category: minutes}。
+    已回填的行直接 SUM(duration_minutes)；还没回填的老数据单独取出来走 entry_minutes，
+    和 /api/stats、/api/dashboard 的口径一致"""
+    category = func.coalesce(TimeEntry.category, UNCATEGORIZED)
+    active = (TimeEntry.user_id == user_id, TimeEntry.is_archived == False)
+    rows = db.session.query(category, func.sum(TimeEntry.duration_minutes)).filter(
+        *active, TimeEntry.duration_minutes.isnot(None),
+    ).group_by(category).all()
+    totals = {name: int(minutes) for name, minutes in rows}
+
+    legacy = db.session.query(
+        category.label('category'), TimeEntry.start_time, TimeEntry.end_time,
+    ).filter(*active, TimeEntry.duration_minutes.is_(None))
+    for row in legacy:
+        totals[row.category] = totals.get(row.category, 0) + (entry_minutes(row) or 0)
+    return totals
+
+
+def normalize_desc(desc):
+    """'LeetCode #42 (2h)' -> 'leetcode h'：小写，去掉数字和标点"""
+    return ' '.join(_TOKEN_RE.findall((desc or '').lower()))
+
+
+def _features(normalized):
+    tokens = normalized.split()
+    return set(tokens) | {f'{a} {b}' for a, b in zip(tokens, tokens[1:])}
+
+
+class CategoryModel:
+    """单个用户的 desc -> category 模型，可以逐条 learn() 增量更新"""
+
+    def __init__(self):
+        self.exact = defaultdict(Counter)      # normalized desc -> Counter(category)
+        self.features = defaultdict(Counter)   # token / bigram -> Counter(category)
+        self.rows = {}                         # entry id -> 学进去的 (normalized desc, category)
+        self.learned_through = None            # 下次补学从这个 labelled_at 往回 LABEL_LAG_SECONDS 开始
+        self.built_at = time.monotonic()
+        self.lock = threading.Lock()           # 同一用户的补学一次只跑一个
+
+    def learn(self, desc, category):
+        self._add(normalize_desc(desc), category, 1)
+
+    def _add(self, normalized, category, delta):
+        if not normalized or not category or category == UNCATEGORIZED:
+            return
+        for counters, key in [(self.exact, normalized)] + [(self.features, f) for f in _features(normalized)]:
+            counters[key][category] += delta
+            if counters[key][category] <= 0:
+                del counters[key][category]
+                if not counters[key]:
+                    del counters[key]
+
+    def update_row(self, entry_id, desc, category):
+        """记录 entry_id 现在的分类（category=None 表示不该再学它）；同一行只算一次，改了分类先减掉旧的"""
+        pair = (normalize_desc(desc), category) if category else None
+        previous = self.rows.get(entry_id)
+        if previous == pair:
+            return
+        if previous is not None:
+            self._add(*previous, -1)
+        if pair is None:
+            self.rows.pop(entry_id, None)
+        else:
+            self._add(*pair, 1)
+            self.rows[entry_id] = pair
+
+    def classify(self, desc):
+        """返回 (category, confidence)；没把握时返回 None"""
+        normalized = normalize_desc(desc)
+        if not normalized:
+            return None
+
+        counts = self.exact.get(normalized)
+        if counts:
+            category, top = counts.most_common(1)[0]
+            total = sum(counts.values())
+            if total >= EXACT_MIN_SUPPORT and top / total >= EXACT_MIN_SHARE:
+                return category, top / total
+
+        votes = Counter()
+        support = 0
+        for feature in _features(normalized):
+            dist = self.features.get(feature)
+            if not dist:
+                continue
+            # 每个特征按自己的分类分布投一票，避免高频词把票数撑大
+            feature_total = sum(dist.values())
+            # 按条数算支持度：一条 'piano practice' 有三个特征，但仍然只是一条记录
+            support = max(support, feature_total)
+            for category, n in dist.items():
+                votes[category] += n / feature_total
+        if not votes or support < NGRAM_MIN_SUPPORT:
+            return None
+        category, top = votes.most_common(1)[0]
+        share = top / sum(votes.values())
+        if share < NGRAM_MIN_SHARE:
+            return None
+        return category, share
+
+
+_models = OrderedDict()
+_models_lock = threading.Lock()
+
+
+def _labelled_rows(user_id, since):
+    """since=None：整体重建，取全部可学的已分类记录；
+    否则取 labelled_at 在 since 之后的记录（含被改成待分类/本地猜测的，要把旧的减掉）"""
+    query = db.session.query(
+        TimeEntry.id, TimeEntry.desc, TimeEntry.category, TimeEntry.categorized_desc, TimeEntry.category_source,
+    ).filter(TimeEntry.user_id == user_id)
+    if since is None:
+        query = query.filter(not_(needs_category_filter()))
+    else:
+        query = query.filter(TimeEntry.labelled_at >= since)
+    return query.order_by(TimeEntry.id)
+
+
+def _learnable_category(row):
+    # 本地模型自己猜的分类不回灌，否则一次猜测会越学越确定
+    if needs_category(row) or row.category_source == SOURCE_LOCAL:
+        return None
+    return row.category
+
+
+def get_user_model(user_id):
+    """取该用户的模型：进程内 LRU 缓存，按 labelled_at 补学新打上或改过分类的记录；超过一小时整体重建"""
+    with _models_lock:
+        model = _models.get(user_id)
+        if model is not None and time.monotonic() - model.built_at > MODEL_MAX_AGE_SECONDS:
+            model = None
+        if model is None:
+            model = CategoryModel()
+        _models[user_id] = model
+        _models.move_to_end(user_id)
+        while len(_models) > MODEL_CACHE_SIZE:
+            _models.popitem(last=False)
+
+    with model.lock:
+        started = datetime.now()
+        since = None
+        if model.learned_through is not None:
+            # 往回多看一段：labelled_at 是提交前在 Python 里打的，晚提交的记录不会被跳过
+            since = model.learned_through - timedelta(seconds=LABEL_LAG_SECONDS)
+        for row in _labelled_rows(user_id, since).yield_per(1000):
+            model.update_row(row.id, row.desc, _learnable_category(row))
+        model.learned_through = started
+    return model
+
+
+def forget_user_model(user_id=None):
+    with _models_lock:
+        if user_id is None:
+            _models.clear()
+        else:
+            _models.pop(user_id, None)
+
+
+def classify_locally(user_id, entries):
+    """用本地模型给能确定的记录直接打上分类，返回仍需交给 LLM 的记录"""
+    if not entries:
+        return []
+    model = get_user_model(user_id)
+    remaining = []
+    for entry in entries:
+        guess = model.classify(entry.desc)
+        if guess is None:
+            remaining.append(entry)
+            continue
+        entry.category = guess[0]
+        entry.categorized_desc = entry.desc
+        entry.category_source = SOURCE_LOCAL
+    metrics.inc('category_classifier', len(entries) - len(remaining), result='local')
+    metrics.inc('category_classifier', len(remaining), result='llm')
+    return remaining
+
+
+# --- LLM taxonomy ---
+
+def recent_tags(user_id, limit=20):
+    try:
+        rows = db.session.query(TimeEntry.category).filter(
+            TimeEntry.user_id == user_id,
+            TimeEntry.category != UNCATEGORIZED,
+            TimeEntry.category != None
+        ).distinct().limit(limit).all()
+    except Exception:
+        return []
+    return [row[0] for row in rows if row[0]]
+
+
+def build_taxonomy_prompt(entries, existing_tags):
+    tags_context = ", ".join(existing_tags) if existing_tags else "None yet"
+    entries_text = "\n".join([f"ID_{item.id}: [{item.start_time}-{item.end_time}] {item.desc}" for item in entries])
+
+    return f"""
+    You are a data taxonomy engine. Group the following logs into 3-6 high-level categories.
+    
+    [Context Memory]
+    Existing Tags: {tags_context}
+    (Prioritize using these tags if they fit. Create new ones only if necessary.)
+    
+    [Rules]
+    1. Categories must be concise (1-2 words, e.g., "Coding", "Deep Work").
+    2. Every entry must have exactly ONE category.
+    3. Return ONLY valid JSON mapping Entry IDs to Categories.
+    
+    [Input Data]
+    {entries_text}
+    
+    [Output Format]
+    {{ "ID_1": "Coding", "ID_2": "Break" }}
+    """
+
+
+def categorize_entries(user_id, entries, llm_client, logger=None):
+    """给一批记录打分类并提交：本地模型有把握的当场分掉（先 commit，别让事务挂着等 LLM），
+    剩下的一次性发给 LLM。LLM 失败时异常原样抛出，已经本地分好的不受影响。"""
+    if not entries:
+        return
+    llm_items = classify_locally(user_id, entries)
+    if len(llm_items) < len(entries):
+        if logger is not None:
+            logger.info('Categorized %s/%s entries locally for user_id=%s',
+                        len(entries) - len(llm_items), len(entries), user_id)
+        db.session.commit()
+    if not llm_items:
+        return
+
+    payload = {
+        "model": "deepseek-v4-flash",
+        "messages": [
+            {"role": "system", "content": "Output strictly JSON."},
+            {"role": "user", "content": build_taxonomy_prompt(llm_items, recent_tags(user_id))}
+        ],
+        "temperature": 0.1,
+        "stream": False,
+        "thinking": {"type": "disabled"}
+    }
+    mapping = parse_ai_json(llm_client.chat(payload, read_timeout=30, call='categorize'))
+
+    for item in llm_items:
+        category = mapping.get(f"ID_{item.id}", UNCATEGORIZED)
+        item.category = category
+        if category != UNCATEGORIZED:
+            item.categorized_desc = item.desc
+            item.category_source = SOURCE_LLM
+    # 不在这里直接喂模型：提交后 get_user_model 按 labelled_at 补学，同一行只算一次
+    db.session.commit()
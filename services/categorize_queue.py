@@ -0,0 +1,137 @@
+"""Write-time categorization queue.
+
+New entry ids are pushed onto a Redis list; `flask categorize-worker` pops
+them in batches, groups them per user and categorizes each user's batch in
+its own greenlet (bounded by a gevent Pool), then writes the categories back
+and tells the user's dashboards over SSE.
+
+Every id that is queued or being worked on also has a marker key
+`categorize:pending:<id>`, so re-enqueueing (e.g. from /api/visualize) never
+duplicates queue items. The markers carry a TTL: if a push fails halfway or a
+worker dies between popping an id and finishing it, the marker just expires
+and the next re-enqueue picks the entry up again. An id that outlives its
+marker while still queued may be queued twice; the worker only touches
+entries that still need a category, so the second copy is a no-op.
+"""
+import gevent
+from gevent.pool import Pool
+
+from model import db, TimeEntry
+from services import metrics
+from services.categorize import categorize_entries, needs_category_filter
+
+QUEUE_KEY = 'categorize:queue'
+# 排队 + 处理一批的上限；过期后同一个 id 可以重新入队
+PENDING_TTL_SECONDS = 15 * 60
+
+
+def pending_key(entry_id):
+    return f'categorize:pending:{entry_id}'
+
+
+def _release(redis_client, entry_ids):
+    if entry_ids:
+        redis_client.delete(*[pending_key(entry_id) for entry_id in entry_ids])
+
+
+def enqueue_entries(redis_client, entry_ids, logger=None):
+    """把还没排队的 id 推入队列，返回新入队的个数；Redis 出错只记日志"""
+    entry_ids = [int(i) for i in entry_ids]
+    if redis_client is None or not entry_ids:
+        return 0
+    try:
+        with redis_client.pipeline() as pipe:
+            for entry_id in entry_ids:
+                pipe.set(pending_key(entry_id), 1, ex=PENDING_TTL_SECONDS, nx=True)
+            claimed = pipe.execute()
+        fresh = [entry_id for entry_id, new in zip(entry_ids, claimed) if new]
+        if fresh:
+            try:
+                redis_client.rpush(QUEUE_KEY, *fresh)
+            except Exception:
+                # 没推进去就撤掉刚占的标记，不必等 TTL 过期才能重新入队
+                _release(redis_client, fresh)
+                raise
+        return len(fresh)
+    except Exception as exc:
+        if logger is not None:
+            logger.warning('Categorize enqueue failed ids=%s: %s', entry_ids, exc)
+        return 0
+
+
+def _pop_batch(redis_client, batch_size, poll_timeout):
+    item = redis_client.blpop(QUEUE_KEY, timeout=poll_timeout)
+    if item is None:
+        return []
+    ids = [int(item[1])]
+    if batch_size > 1:
+        ids += [int(x) for x in (redis_client.lpop(QUEUE_KEY, batch_size - 1) or [])]
+    return ids
+
+
+def _categorize_user(app, user_id, entry_ids):
+    from routes.common import publish_user_event, EVENT_ENTRIES_CATEGORIZED
+
+    with app.app_context():
+        try:
+            entries = TimeEntry.query.filter(
+                TimeEntry.id.in_(entry_ids),
+                TimeEntry.user_id == user_id,
+                needs_category_filter(),
+            ).all()
+            categorize_entries(user_id, entries, app.llm_client, logger=app.logger)
+            done = [{'id': e.id, 'category': e.category} for e in entries
+                    if e.categorized_desc is not None]
+            if done:
+                publish_user_event(user_id, EVENT_ENTRIES_CATEGORIZED, {'entries': done})
+            metrics.inc('categorize_jobs', outcome='ok')
+        except Exception as exc:
+            # 不重试：pending 标记删掉后，下次打开图表会把仍未分类的记录重新入队
+            db.session.rollback()
+            metrics.inc('categorize_jobs', outcome='error')
+            app.logger.warning('Categorize failed user_id=%s ids=%s: %s', user_id, entry_ids, exc)
+        finally:
+            db.session.remove()
+            try:
+                _release(app.redis_client, entry_ids)
+            except Exception:
+                pass  # 标记会自己过期
+
+
+def process_batch(app, entry_ids, pool):
+    """按用户分组，每个用户的一批交给 pool 里的一个 greenlet"""
+    with app.app_context():
+        rows = db.session.query(TimeEntry.id, TimeEntry.user_id).filter(TimeEntry.id.in_(entry_ids)).all()
+        db.session.remove()
+    by_user = {}
+    for entry_id, user_id in rows:
+        by_user.setdefault(user_id, []).append(entry_id)
+    missing = set(entry_ids) - {entry_id for entry_id, _u in rows}
+    if missing:
+        _release(app.redis_client, missing)
+    # pool 满时 spawn 会阻塞，天然限制同时在飞的 LLM 调用数
+    return [pool.spawn(_categorize_user, app, user_id, ids) for user_id, ids in by_user.items()]
+
+
+def run_categorize_worker(app, batch_size=50, concurrency=4, poll_timeout=5, drain=False):
+    """阻塞消费队列；drain=True 时队列读空就返回（一次性补跑/测试用）。返回处理的批次数"""
+    redis_client = app.redis_client
+    if redis_client is None:
+        raise RuntimeError('Redis is required for the categorize worker')
+    pool = Pool(concurrency)
+    batches = 0
+    while True:
+        try:
+            entry_ids = _pop_batch(redis_client, batch_size, poll_timeout)
+        except Exception as exc:
+            app.logger.warning('Categorize queue read failed: %s', exc)
+            gevent.sleep(poll_timeout)
+            continue
+        if not entry_ids:
+            if drain:
+                break
+            continue
+        batches += 1
+        process_batch(app, entry_ids, pool)
+    pool.join()
+    return batches
@@ -0,0 +1,165 @@
+"""Redis-backed circuit breaker for upstream LLM calls.
+
+Every worker records call outcomes into the same rolling window in Redis
+(10-second buckets under `breaker:<name>:w:<bucket>`), so when DeepSeek
+degrades all workers trip together instead of each one burning its own
+greenlets on 45-second timeouts. A call counts as failed when it raises or
+when it takes longer than the latency budget. LLMClient reports the time to
+first chunk for streamed calls, and reports 4xx responses (the request's
+fault, not upstream's) as successes.
+
+States:
+  closed     - calls go through; the window is checked after each failure.
+  open       - `breaker:<name>:open` holds the time it opened; calls fail fast.
+  half-open  - after `open_seconds`, one caller across all workers wins the
+               `breaker:<name>:probe` key and is let through. Success closes
+               the breaker and clears the window, failure re-opens it.
+
+Without Redis the breaker is a no-op.
+"""
+import time
+
+from services import metrics
+
+PERMIT_CLOSED = 'closed'
+PERMIT_PROBE = 'probe'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, redis_getter, failure_ratio=0.5, min_calls=5,
+                 window_seconds=60, bucket_seconds=10, open_seconds=30,
+                 slow_call_seconds=20, probe_ttl_seconds=60, logger=None):
+        self.name = name
+        self.redis_getter = redis_getter
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.probe_ttl_seconds = probe_ttl_seconds
+        self.logger = logger
+
+    # --- keys ---
+
+    def _open_key(self):
+        return f'breaker:{self.name}:open'
+
+    def _probe_key(self):
+        return f'breaker:{self.name}:probe'
+
+    def _bucket_key(self, bucket):
+        return f'breaker:{self.name}:w:{bucket}'
+
+    def _window_buckets(self, now):
+        current = int(now // self.bucket_seconds)
+        count = max(1, self.window_seconds // self.bucket_seconds)
+        return [current - i for i in range(count)]
+
+    def _set_state_gauge(self, state):
+        metrics.set_gauge('llm_circuit_open', 0 if state == 'closed' else 1, breaker=self.name)
+        metrics.set_gauge('llm_circuit_half_open', 1 if state == 'half_open' else 0, breaker=self.name)
+
+    def _warn(self, message, *args):
+        if self.logger is not None:
+            self.logger.warning(message, *args)
+
+    # --- public API ---
+
+    def allow(self):
+        """放行返回 permit（closed / probe），熔断中抛 CircuitOpenError。Redis 出错时放行"""
+        redis_client = self.redis_getter()
+        if redis_client is None:
+            return PERMIT_CLOSED
+        try:
+            opened_at = redis_client.get(self._open_key())
+            if opened_at is None:
+                self._set_state_gauge('closed')
+                return PERMIT_CLOSED
+            remaining = float(opened_at) + self.open_seconds - time.time()
+            if remaining <= 0 and redis_client.set(self._probe_key(), '1', nx=True, ex=self.probe_ttl_seconds):
+                self._set_state_gauge('half_open')
+                return PERMIT_PROBE
+        except Exception as exc:
+            self._warn('Circuit breaker %s check failed, allowing call: %s', self.name, exc)
+            return PERMIT_CLOSED
+
+        self._set_state_gauge('open' if remaining > 0 else 'half_open')
+        metrics.inc('llm_circuit_rejected', breaker=self.name)
+        raise CircuitOpenError(
+            f'{self.name} circuit open; retry in {max(1, int(remaining))}s'
+            if remaining > 0 else f'{self.name} circuit half-open; probe in flight'
+        )
+
+    def record(self, permit, ok, elapsed):
+        """记录一次调用结果；超过延迟预算的成功调用也算失败"""
+        redis_client = self.redis_getter()
+        if redis_client is None:
+            return
+        failed = (not ok) or elapsed > self.slow_call_seconds
+        try:
+            if permit == PERMIT_PROBE:
+                self._finish_probe(redis_client, failed)
+            else:
+                self._record_closed(redis_client, failed)
+        except Exception as exc:
+            self._warn('Circuit breaker %s record failed: %s', self.name, exc)
+
+    def release(self, permit):
+        """调用被取消（客户端断开等），不计入统计；探测名额让给下一个请求"""
+        if permit != PERMIT_PROBE:
+            return
+        redis_client = self.redis_getter()
+        if redis_client is None:
+            return
+        try:
+            redis_client.delete(self._probe_key())
+        except Exception as exc:
+            self._warn('Circuit breaker %s release failed: %s', self.name, exc)
+
+    # --- internals ---
+
+    def _finish_probe(self, redis_client, failed):
+        with redis_client.pipeline() as pipe:
+            if failed:
+                pipe.set(self._open_key(), repr(time.time()))
+            else:
+                pipe.delete(self._open_key(), *[self._bucket_key(b) for b in self._window_buckets(time.time())])
+            pipe.delete(self._probe_key())
+            pipe.execute()
+        self._set_state_gauge('open' if failed else 'closed')
+        if failed:
+            self._warn('Circuit breaker %s probe failed, staying open', self.name)
+        elif self.logger is not None:
+            self.logger.info('Circuit breaker %s closed after successful probe', self.name)
+
+    def _record_closed(self, redis_client, failed):
+        now = time.time()
+        buckets = self._window_buckets(now)
+        key = self._bucket_key(buckets[0])
+        with redis_client.pipeline() as pipe:
+            pipe.hincrby(key, 'calls', 1)
+            if failed:
+                pipe.hincrby(key, 'failures', 1)
+            pipe.expire(key, self.window_seconds + self.bucket_seconds)
+            pipe.execute()
+        if not failed:
+            return
+
+        with redis_client.pipeline() as pipe:
+            for bucket in buckets:
+                pipe.hgetall(self._bucket_key(bucket))
+            windows = pipe.execute()
+        calls = sum(int(w.get('calls', 0)) for w in windows if w)
+        failures = sum(int(w.get('failures', 0)) for w in windows if w)
+        if calls >= self.min_calls and failures / calls >= self.failure_ratio:
+            # NX：多个 worker 同时判定跳闸时只记第一次的时间
+            if redis_client.set(self._open_key(), repr(now), nx=True):
+                metrics.inc('llm_circuit_trips', breaker=self.name)
+                self._warn('Circuit breaker %s opened: %s/%s failed in the last %ss',
+                           self.name, failures, calls, self.window_seconds)
+            self._set_state_gauge('open')
@@ -0,0 +1,93 @@
+"""Dashboard snapshot: everything the first paint needs, assembled in one pass.
+
+The page used to make about eight queries while rendering: the streak commit,
+the entries, an AlignmentSignal count, the profile, the todos and each deferred
+text column separately. It then made three more round trips straight away
+(/api/stats, /api/pomodoro, /api/visualize). `build_snapshot` fetches the
+active entries once and derives stats and chart totals from them in Python. It
+gets the profile and the signal count from a single joined query, and the
+pomodoro state from Redis or one column load.
+
+`index()` renders from the snapshot and embeds it in the page, and
+`GET /api/dashboard` returns the same data as JSON.
+"""
+import time
+
+from sqlalchemy import func
+from sqlalchemy.orm.attributes import set_committed_value
+
+from model import db, AlignmentSignal, TimeEntry, User, UserProfile
+from services.categorize import category_totals_from_entries, needs_category
+from services.pomodoro import load_state
+from services.stats import entry_minutes, is_deep_work
+from services.streak import update_user_streak
+from services.todos import list_todos
+
+
+def _profile_and_signal_count(user):
+    """profile 和 AlignmentSignal 计数一条 SQL 取回（LEFT JOIN + 标量子查询）"""
+    signal_count = db.session.query(func.count(AlignmentSignal.id)).filter(
+        AlignmentSignal.user_id == user.id,
+    ).scalar_subquery()
+    profile, count = db.session.query(UserProfile, signal_count).select_from(User).outerjoin(
+        UserProfile, UserProfile.user_id == User.id,
+    ).filter(User.id == user.id).one()
+    if profile is not None:
+        # 填进关系属性，之后 user.profile 不再单独懒加载
+        set_committed_value(user, 'profile', profile)
+    return profile, count or 0
+
+
+def _stats(entries):
+    total_minutes = deep_minutes = 0
+    for entry in entries:
+        duration = entry_minutes(entry)
+        if duration is None:
+            continue
+        total_minutes += duration
+        if is_deep_work(entry.desc):
+            deep_minutes += duration
+    return {
+        'total_minutes': total_minutes,
+        'total_hours': round(total_minutes / 60, 1),
+        'deep_hours': round(deep_minutes / 60, 1),
+    }
+
+
+def _chart(entries):
+    """和 /api/visualize 同样的格式，只用已存的分类；pending 是还没分好类的条数"""
+    totals = category_totals_from_entries(entries)
+    return {
+        'labels': list(totals.keys()),
+        'data': list(totals.values()),
+        'total_minutes': sum(totals.values()),
+        'pending': sum(1 for entry in entries if needs_category(entry)),
+    }
+
+
+def build_snapshot(user, logical_date, redis_client=None):
+    """组装首页数据；entries / profile 是 ORM 对象（模板要用），转 JSON 时去掉。
+    当天第一次打开时顺带提交 streak"""
+    old_streak = user.streak
+    update_user_streak(user, logical_date)
+    if user.streak != old_streak:
+        db.session.commit()
+
+    entries = TimeEntry.query.filter_by(user_id=user.id, is_archived=False).order_by(
+        TimeEntry.timestamp.desc()
+    ).all()
+    profile, signal_count = _profile_and_signal_count(user)
+
+    return {
+        'entries': entries,
+        'stats': _stats(entries),
+        'chart': _chart(entries),
+        'todos': list_todos(user.id),
+        'streak': user.streak,
+        'streak_incremented': user.streak > old_streak,
+        'rlhf_count': signal_count,
+        'model_confidence': min(99, 75 + int(signal_count / 5)),
+        'profile': profile,
+        'pomodoro': {'state': load_state(redis_client, user), 'server_now': time.time()},
+    }
+
@@ -1,4 +1,4 @@
-from datetime import datetime
+from services.stats import parse_clock_minutes, span_minutes, entry_minutes
 
 
 def calculate_duration_minutes(start_str, end_str):
@@ -6,34 +6,10 @@ def calculate_duration_minutes(start_str, end_str):
     if not start_str or not end_str:
         return 0
 
-    start_str = str(start_str).strip()
-    end_str = str(end_str).strip()
-
-    formats = ["%H:%M", "%H:%M:%S"]
-
-    s = None
-    for fmt in formats:
-        try:
-            s = datetime.strptime(start_str, fmt)
-            break
-        except ValueError:
-            continue
-
-    e = None
-    for fmt in formats:
-        try:
-            e = datetime.strptime(end_str, fmt)
-            break
-        except ValueError:
-            continue
-
-    if s is None or e is None:
+    diff = span_minutes(parse_clock_minutes(start_str), parse_clock_minutes(end_str))
+    if diff is None:
         print(f"⚠️ PARSE FAILED: start={repr(start_str)}, end={repr(end_str)}")
         return 0
-
-    diff = (e - s).total_seconds() / 60.0
-    if diff < 0:
-        diff += 24 * 60
     return diff
 
 
@@ -43,11 +19,29 @@ def build_day_stats(items):
     category_min = {}
 
     for item in items:
-        dur = calculate_duration_minutes(item.start_time, item.end_time)
+        dur = entry_minutes(item) or 0
         total_min += dur
         cat = item.category or "Uncategorized"
         category_min[cat] = category_min.get(cat, 0) + dur
 
+    return _day_stats(total_min, category_min, len(items))
+
+
+def build_day_stats_from_rollups(rollups):
+    """同 build_day_stats，但输入是一天的 DailyRollup 行（每个分类一行）"""
+    total_min = 0.0
+    category_min = {}
+    entry_count = 0
+
+    for row in rollups:
+        total_min += row.total_minutes
+        category_min[row.category] = category_min.get(row.category, 0) + row.total_minutes
+        entry_count += row.entry_count
+
+    return _day_stats(total_min, category_min, entry_count)
+
+
+def _day_stats(total_min, category_min, entry_count):
     deep_work_min = category_min.get("Deep Work", 0)
     focus_pct = int(deep_work_min / total_min * 100) if total_min > 0 else 0
     top_cat = max(category_min, key=category_min.get) if category_min else "—"
@@ -58,6 +52,5 @@ def build_day_stats(items):
         'category_minutes': category_min,
         'focus_pct': focus_pct,
         'top_category': top_cat,
-        'entry_count': len(items),
+        'entry_count': entry_count,
     }
-
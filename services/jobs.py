@@ -0,0 +1,154 @@
+"""Background jobs for slow AI calls.
+
+The request that submits a job returns its id right away; the job itself runs
+in one of a fixed number of greenlets in the same worker, so a slow upstream
+holds neither a request slot nor a DB session. Job records live in Redis
+(`job:<id>`, with a TTL) so any worker can answer `GET /api/jobs/<id>`, and
+the finished job is pushed to the user's dashboards as a `job_finished` SSE
+event. Without Redis the records fall back to this process's memory, with
+the same TTL and a cap on how many are kept.
+"""
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+import gevent
+from gevent.queue import JoinableQueue, Full
+
+from services import metrics
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobRunner:
+    def __init__(self, app, concurrency=8, max_queued=1000, ttl_seconds=3600, max_local=1000):
+        self.app = app
+        self.concurrency = concurrency
+        self.ttl_seconds = ttl_seconds
+        self.max_local = max_local
+        self._queue = JoinableQueue(maxsize=max_queued)
+        self._workers = []
+        # job_id -> (过期时刻, job)，仅在没有 Redis（或写 Redis 失败）时使用；
+        # 和 Redis 一样按 ttl_seconds 过期，另外最多留 max_local 条，最久没更新的先丢
+        self._local = OrderedDict()
+
+    # --- storage ---
+
+    @staticmethod
+    def _key(job_id):
+        return f'job:{job_id}'
+
+    def _save(self, job):
+        redis_client = getattr(self.app, 'redis_client', None)
+        if redis_client is None:
+            self._save_local(job)
+            return
+        try:
+            redis_client.set(self._key(job['id']), json.dumps(job), ex=self.ttl_seconds)
+        except Exception as exc:
+            self.app.logger.warning('Saving job %s failed: %s', job['id'], exc)
+            self._save_local(job)
+
+    def _save_local(self, job):
+        now = time.monotonic()
+        self._local[job['id']] = (now + self.ttl_seconds, job)
+        self._local.move_to_end(job['id'])
+        # 按更新顺序排，过期的都在最前面
+        while self._local:
+            expires_at, _ = next(iter(self._local.values()))
+            if expires_at > now and len(self._local) <= self.max_local:
+                break
+            self._local.popitem(last=False)
+
+    def _get_local(self, job_id):
+        entry = self._local.get(job_id)
+        if entry is None:
+            return None
+        expires_at, job = entry
+        if expires_at <= time.monotonic():
+            del self._local[job_id]
+            return None
+        return job
+
+    def get(self, job_id):
+        redis_client = getattr(self.app, 'redis_client', None)
+        if redis_client is not None:
+            try:
+                raw = redis_client.get(self._key(job_id))
+                if raw:
+                    return json.loads(raw)
+            except Exception as exc:
+                self.app.logger.warning('Loading job %s failed: %s', job_id, exc)
+        return self._get_local(job_id)
+
+    # --- execution ---
+
+    def submit(self, user_id, kind, func, *args):
+        """登记任务并放进本进程的队列；func(*args) 的返回值（可 JSON 序列化）就是任务结果"""
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'user_id': user_id,
+            'status': JOB_QUEUED,
+            'created_at': time.time(),
+        }
+        try:
+            self._queue.put_nowait((job, func, args))
+        except Full:
+            metrics.inc('jobs', kind=kind, outcome='rejected')
+            raise JobQueueFull(kind)
+        self._save(job)
+        self._ensure_workers()
+        metrics.set_gauge('jobs_queued', self._queue.qsize())
+        return job
+
+    def _ensure_workers(self):
+        self._workers = [g for g in self._workers if not g.dead]
+        while len(self._workers) < self.concurrency:
+            self._workers.append(gevent.spawn(self._work))
+
+    def _work(self):
+        while True:
+            job, func, args = self._queue.get()
+            try:
+                self._run(job, func, args)
+            finally:
+                self._queue.task_done()
+                metrics.set_gauge('jobs_queued', self._queue.qsize())
+
+    def _run(self, job, func, args):
+        from routes.common import publish_user_event, EVENT_JOB_FINISHED
+
+        started = time.perf_counter()
+        with self.app.app_context():
+            job['status'] = JOB_RUNNING
+            self._save(job)
+            try:
+                job['result'] = func(*args)
+                job['status'] = JOB_DONE
+            except Exception as exc:
+                self.app.logger.warning('Job %s (%s) failed: %s', job['id'], job['kind'], exc)
+                job['status'] = JOB_ERROR
+                job['error'] = str(exc)
+            job['finished_at'] = time.time()
+            self._save(job)
+            metrics.inc('jobs', kind=job['kind'], outcome=job['status'])
+            metrics.observe('job_seconds', time.perf_counter() - started, kind=job['kind'])
+            publish_user_event(job['user_id'], EVENT_JOB_FINISHED, public_job(job))
+
+    def join(self, timeout=None):
+        """等本进程队列里的任务都跑完（测试/优雅退出用）"""
+        return self._queue.join(timeout=timeout)
+
+
+def public_job(job):
+    """返回给客户端的任务视图（不含 user_id 等内部字段）"""
+    return {key: job.get(key) for key in ('id', 'kind', 'status', 'result', 'error')}
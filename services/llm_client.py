@@ -0,0 +1,175 @@
+"""Shared DeepSeek HTTP client.
+
+One requests.Session per worker, so audits and categorization reuse pooled
+keep-alive connections instead of paying a TCP + TLS handshake on every call.
+The pool is sized to how many greenlets of one gevent worker may talk to
+DeepSeek at the same time; bursts beyond it still go through, the extra
+connections just are not kept.
+"""
+import json
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from services import metrics, request_timing
+
+DEFAULT_BASE_URL = 'https://api.deepseek.com'
+
+
+class LLMClient:
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL, pool_size=64,
+                 connect_timeout=5.0, read_timeout=45.0, logger=None, breaker=None):
+        self.api_key = api_key
+        self.breaker = breaker
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.logger = logger
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+    def _allow(self):
+        return self.breaker.allow() if self.breaker is not None else None
+
+    def _record(self, permit, outcome, elapsed):
+        if self.breaker is None:
+            return
+        if outcome == 'cancelled':
+            self.breaker.release(permit)
+        else:
+            # 4xx 是请求本身的问题（参数、鉴权），上游是好的，不算熔断失败
+            self.breaker.record(permit, outcome in ('ok', 'client_error'), elapsed)
+
+    @staticmethod
+    def _http_outcome(exc):
+        """raise_for_status 抛出的 HTTPError -> outcome；408/429 是上游忙，仍算失败"""
+        status = exc.response.status_code if exc.response is not None else None
+        if status is not None and 400 <= status < 500 and status not in (408, 429):
+            return 'client_error'
+        return 'error'
+
+    @staticmethod
+    def _record_prompt(payload, call):
+        chars = sum(len(m.get('content') or '') for m in payload.get('messages', []))
+        metrics.observe('llm_prompt_chars', chars, call=call)
+
+    @staticmethod
+    def _record_usage(usage, call):
+        """上游报告的 prompt token 数和其中命中前缀缓存的部分。
+        DeepSeek 用 prompt_cache_hit_tokens，OpenAI 兼容接口用 prompt_tokens_details.cached_tokens"""
+        if not usage:
+            return
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        cached = usage.get('prompt_cache_hit_tokens')
+        if cached is None:
+            cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+        metrics.inc('llm_prompt_tokens', prompt_tokens, call=call)
+        if cached is not None:
+            metrics.inc('llm_prompt_cached_tokens', cached, call=call)
+            if prompt_tokens:
+                metrics.observe('llm_prompt_cache_hit_ratio', cached / prompt_tokens, call=call)
+
+    def chat(self, payload, read_timeout=None, call='chat'):
+        """POST /chat/completions，返回 message.content；网络/HTTP 错误原样抛出，
+        熔断打开时直接抛 CircuitOpenError，不发请求"""
+        url = f'{self.base_url}/chat/completions'
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        permit = self._allow()
+        self._record_prompt(payload, call)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = self.session.post(
+                url,
+                headers={'Authorization': f'Bearer {self.api_key}'},
+                json=payload,
+                timeout=timeout,
+            )
+            response.raise_for_status()
+            body = response.json()
+            content = body['choices'][0]['message']['content']
+            self._record_usage(body.get('usage'), call)
+            outcome = 'ok'
+            return content
+        except requests.HTTPError as exc:
+            outcome = self._http_outcome(exc)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self._record(permit, outcome, elapsed)
+            metrics.histogram('llm_request_seconds', elapsed, call=call)
+            request_timing.record('llm', elapsed)
+            metrics.inc('llm_requests', call=call, outcome=outcome)
+            if self.logger is not None:
+                self.logger.info('LLM call=%s model=%s outcome=%s latency_ms=%.0f',
+                                 call, payload.get('model'), outcome, elapsed * 1000)
+
+    def chat_stream(self, payload, read_timeout=None, call='chat'):
+        """stream=true 版本的 chat：逐块产出 (kind, text)，kind 为 'reasoning' 或 'content'。
+
+        read_timeout 在流式模式下是两块数据之间的最大间隔，而不是整个回答的总时长。
+        """
+        url = f'{self.base_url}/chat/completions'
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        permit = self._allow()
+        self._record_prompt(payload, call)
+        started = time.perf_counter()
+        first_chunk_at = None
+        outcome = 'error'
+        response = None
+        try:
+            response = self.session.post(
+                url,
+                headers={'Authorization': f'Bearer {self.api_key}'},
+                json=dict(payload, stream=True, stream_options={'include_usage': True}),
+                timeout=timeout,
+                stream=True,
+            )
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                # include_usage 时最后一块只带 usage、choices 为空
+                self._record_usage(chunk.get('usage'), call)
+                choices = chunk.get('choices') or [{}]
+                delta = choices[0].get('delta') or {}
+                for kind, key in (('reasoning', 'reasoning_content'), ('content', 'content')):
+                    text = delta.get(key)
+                    if not text:
+                        continue
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                        metrics.histogram('llm_first_chunk_seconds', first_chunk_at - started, call=call)
+                    yield kind, text
+            outcome = 'ok'
+        except requests.HTTPError as exc:
+            outcome = self._http_outcome(exc)
+            raise
+        except GeneratorExit:
+            outcome = 'cancelled'
+            raise
+        finally:
+            if response is not None:
+                response.close()
+            elapsed = time.perf_counter() - started
+            # 流式回答的总时长取决于回答多长，熔断只看首块延迟；一块都没到才按总时长算
+            self._record(permit, outcome, first_chunk_at - started if first_chunk_at is not None else elapsed)
+            metrics.histogram('llm_request_seconds', elapsed, call=call)
+            request_timing.record('llm', elapsed)
+            metrics.inc('llm_requests', call=call, outcome=outcome)
+            if self.logger is not None:
+                ttfb = (first_chunk_at - started) * 1000 if first_chunk_at else -1
+                self.logger.info('LLM call=%s model=%s outcome=%s latency_ms=%.0f first_chunk_ms=%.0f',
+                                 call, payload.get('model'), outcome, elapsed * 1000, ttfb)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,326 @@
+"""Process-local counters, gauges and histograms.
+
+A deliberately tiny registry: code records values by name plus optional
+labels, and the values can be read back with snapshot(). Each gunicorn worker
+holds its own numbers. When METRICS_DIR is set, every worker periodically
+dump()s them into that shared directory and collect() merges all workers:
+counters and histograms are summed, and gauges come only from workers that
+are still alive (and whose file is fresh). When a worker exits, or a file
+turns out to belong to a dead pid, its counters are folded into
+`archive.json` under a file lock before the file is deleted. Totals therefore
+never go down when gunicorn recycles workers. render_prometheus() turns the
+result into the Prometheus text format served by /metrics.
+"""
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+import tempfile
+import threading
+import time
+import uuid
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_kinds = {}   # 指标名 -> 'counter' / 'gauge' / 'summary' / 'histogram'，只用于 # TYPE 行
+
+# 秒；从 5ms 的 Redis 往返到分钟级的 LLM 调用
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 多个 worker 的 gauge 默认相加（比如 SSE 连接数）；熔断状态本来就是 Redis 里共享的，取最大值
+GAUGE_MERGE = {'llm_circuit_open': max, 'llm_circuit_half_open': max}
+
+# 这么多个 dump 周期没更新的文件，gauge 不再算（worker 可能卡住或已被 kill -9）
+STALE_AFTER_DUMPS = 3
+
+# 已退出 worker 的计数器累计在这里，合计不会因为 worker 轮换而变小
+ARCHIVE_FILE = 'archive.json'
+_LOCK_FILE = '.lock'
+
+_dump_identity = None   # (pid, 文件名)
+_retired = False        # 本进程的数值已经并入 archive，之后不再写文件
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _kinds.setdefault(name, 'counter')
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """记录一次耗时之类的观测值，存成 <name>_count / <name>_sum 两个计数器"""
+    count_key, sum_key = _key(f'{name}_count', labels), _key(f'{name}_sum', labels)
+    with _lock:
+        _kinds.setdefault(name, 'summary')
+        _counters[count_key] = _counters.get(count_key, 0) + 1
+        _counters[sum_key] = _counters.get(sum_key, 0) + value
+
+
+def histogram(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """和 observe 一样记 <name>_count / <name>_sum，另外按桶累计 <name>_bucket{le=...}"""
+    count_key, sum_key = _key(f'{name}_count', labels), _key(f'{name}_sum', labels)
+    bounds = [(_key(f'{name}_bucket', dict(labels, le=_format_bound(bound))), value <= bound)
+              for bound in buckets]
+    bounds.append((_key(f'{name}_bucket', dict(labels, le='+Inf')), True))
+    with _lock:
+        _kinds[name] = 'histogram'
+        # 空桶也要输出（histogram_quantile 需要完整的桶），所以没落进去的记 0
+        for key, hit in bounds:
+            _counters[key] = _counters.get(key, 0) + (1 if hit else 0)
+        _counters[count_key] = _counters.get(count_key, 0) + 1
+        _counters[sum_key] = _counters.get(sum_key, 0) + value
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _kinds[name] = 'gauge'
+        _gauges[_key(name, labels)] = value
+
+
+def get(name, **labels):
+    key = _key(name, labels)
+    with _lock:
+        if key in _gauges:
+            return _gauges[key]
+        return _counters.get(key, 0)
+
+
+def snapshot():
+    """{'counters': {'name{a="b"}': value}, 'gauges': {...}}"""
+    def render(items):
+        out = {}
+        for (name, labels), value in items:
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+            out[f'{name}{{{label_str}}}' if label_str else name] = value
+        return out
+
+    with _lock:
+        return {'counters': render(_counters.items()), 'gauges': render(_gauges.items())}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _kinds.clear()
+
+
+# --- Cross-worker aggregation ---
+
+def _dump_filename():
+    global _dump_identity
+    pid = os.getpid()
+    if _dump_identity is None or _dump_identity[0] != pid:
+        # pid 会被复用：带上随机后缀，新 worker 不会覆盖旧 worker 的文件
+        _dump_identity = (pid, f'{pid}-{uuid.uuid4().hex[:8]}.json')
+    return _dump_identity[1]
+
+
+def _write_json(directory, filename, state):
+    # 临时文件 + rename，读的一方不会看到半个文件
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(directory, filename))
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def _dir_lock(directory):
+    """合并 archive 和读全部文件都在这把跨进程锁里做，不会一边并入一边重复计数"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, _LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _state():
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'counters': [[name, labels, value] for (name, labels), value in _counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in _gauges.items()],
+            'kinds': dict(_kinds),
+        }
+
+
+def dump(directory):
+    """把本进程的数值写到 directory/<pid>-<后缀>.json"""
+    if _retired:
+        return
+    os.makedirs(directory, exist_ok=True)
+    _write_json(directory, _dump_filename(), _state())
+
+
+def _label_key(name, labels):
+    return (name, tuple(tuple(pair) for pair in labels))
+
+
+def _fold_into_archive(directory, state):
+    """把一个 worker 的计数器加进 archive（调用方持有目录锁）"""
+    archive = _read_json(os.path.join(directory, ARCHIVE_FILE)) or {}
+    totals = {_label_key(name, labels): value for name, labels, value in archive.get('counters', [])}
+    for name, labels, value in state.get('counters', []):
+        key = _label_key(name, labels)
+        totals[key] = totals.get(key, 0) + value
+    _write_json(directory, ARCHIVE_FILE, {
+        'pid': None,
+        'counters': [[name, [list(pair) for pair in labels], value] for (name, labels), value in totals.items()],
+        'gauges': [],
+        'kinds': {**archive.get('kinds', {}), **state.get('kinds', {})},
+    })
+
+
+def retire_dump(directory):
+    """进程退出时调用：最新的计数器并入 archive，再删掉自己的文件；gauge 随之消失"""
+    global _retired
+    if _retired:
+        return
+    with _dir_lock(directory):
+        _fold_into_archive(directory, _state())
+        try:
+            os.remove(os.path.join(directory, _dump_filename()))
+        except FileNotFoundError:
+            pass
+        _retired = True
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect(directory=None, max_age_seconds=None):
+    """-> (counters, gauges, kinds)，键是 (name, labels) 元组。
+    没给目录时只看本进程；给了目录时先把本进程写进去再合并所有文件。
+    进程已经不在的文件（kill -9、没跑到 atexit）先并入 archive 再删；
+    计数器一直算，gauge 只算进程还活着、且 max_age_seconds 内更新过的文件"""
+    if directory is None:
+        with _lock:
+            return dict(_counters), dict(_gauges), dict(_kinds)
+
+    dump(directory)
+    now = time.time()
+    counters, gauge_values, kinds = {}, {}, {}
+    with _dir_lock(directory):
+        # 先把已经不在的进程并进 archive，再统一读：同一份计数不会既在 archive 又在原文件里
+        for filename, state in _worker_files(directory):
+            if not _pid_alive(state.get('pid')):
+                _fold_into_archive(directory, state)
+                os.remove(os.path.join(directory, filename))
+
+        archive = _read_json(os.path.join(directory, ARCHIVE_FILE))
+        states = [(None, archive)] if archive else []
+        states += _worker_files(directory)
+        for filename, state in states:
+            kinds.update(state.get('kinds', {}))
+            for name, labels, value in state.get('counters', []):
+                key = _label_key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            if filename is None:
+                continue
+            age = now - os.path.getmtime(os.path.join(directory, filename))
+            if max_age_seconds is None or age <= max_age_seconds:
+                for name, labels, value in state.get('gauges', []):
+                    gauge_values.setdefault(_label_key(name, labels), []).append(value)
+    gauges = {key: GAUGE_MERGE.get(key[0], sum)(values) for key, values in gauge_values.items()}
+    return counters, gauges, kinds
+
+
+def _worker_files(directory):
+    """[(文件名, state)]，不含 archive；读不了的文件跳过"""
+    out = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json') or filename == ARCHIVE_FILE:
+            continue
+        state = _read_json(os.path.join(directory, filename))
+        if state is not None:
+            out.append((filename, state))
+    return out
+
+
+def run_dumper(directory, interval_seconds, logger=None):
+    """后台循环：每 interval_seconds 把本进程的数值写到共享目录"""
+    while True:
+        time.sleep(interval_seconds)
+        try:
+            dump(directory)
+        except Exception as exc:
+            if logger is not None:
+                logger.warning('Metrics dump failed: %s', exc)
+
+
+# --- Prometheus text format ---
+
+_FAMILY_SUFFIXES = ('_bucket', '_count', '_sum')
+
+
+def _family(name, kinds):
+    for suffix in _FAMILY_SUFFIXES:
+        base = name[:-len(suffix)]
+        if name.endswith(suffix) and kinds.get(base) in ('histogram', 'summary'):
+            return base
+    return name
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return str(int(value) if isinstance(value, bool) else value)
+
+
+def _bucket_order(item):
+    (name, labels), _ = item
+    le = dict(labels).get('le')
+    if le is None:
+        return (name, labels, 0.0)
+    rest = tuple(pair for pair in labels if pair[0] != 'le')
+    return (name, rest, float('inf') if le == '+Inf' else float(le))
+
+
+def render_prometheus(counters, gauges, kinds, prefix='onyx_'):
+    """按 Prometheus 0.0.4 文本格式输出，每个指标族一行 # TYPE"""
+    families = {}
+    for item in list(counters.items()) + list(gauges.items()):
+        (name, _labels), _value = item
+        families.setdefault(_family(name, kinds), []).append(item)
+
+    lines = []
+    for family in sorted(families):
+        kind = kinds.get(family, 'untyped')
+        lines.append(f'# TYPE {prefix}{family} {kind}')
+        for (name, labels), value in sorted(families[family], key=_bucket_order):
+            label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+            series = f'{prefix}{name}{{{label_str}}}' if label_str else f'{prefix}{name}'
+            lines.append(f'{series} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
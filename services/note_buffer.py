@@ -0,0 +1,227 @@
+"""Write-behind buffer for notebook and quick-note autosaves.
+
+Every autosave writes the user's latest state into a Redis hash
+(`notes:buf:<user_id>`) and marks the user dirty (`notes:dirty`). A flusher
+greenlet in each web worker pops dirty users every NOTES_FLUSH_SECONDS and
+writes their hashes back to the `user` rows in one transaction, so a burst of
+keystrokes costs one UPDATE instead of one per debounce. Reads go through the
+hash first, which keeps the dashboard, the audit prompt and the notebook patch
+protocol on the acknowledged state before it reaches the database.
+
+The buffer lives in Redis, not in the worker: if a worker dies between two
+flushes, any other worker's flusher still finds its users in the dirty set.
+
+Without Redis (redis_client=None) every save is committed straight away.
+"""
+import gevent
+import redis
+from sqlalchemy import func, update
+
+from model import db, User
+from services import metrics
+from services.text_patch import apply_patch
+
+# 待办已经搬到 todo 表（单行更新），不再走缓冲
+BUFFER_FIELDS = ('notebook', 'notebook_version', 'quick_note')
+DIRTY_KEY = 'notes:dirty'
+# 远大于刷盘间隔：就算 flusher 全挂了一段时间，脏数据也还在
+BUFFER_TTL_SECONDS = 7 * 86400
+
+
+def buffer_key(user_id):
+    return f'notes:buf:{user_id}'
+
+
+def _db_value(user, field):
+    value = getattr(user, field)
+    if field == 'notebook_version':
+        return value or 0
+    return value if value is not None else ''
+
+
+def _coerce(field, value):
+    return int(value) if field == 'notebook_version' else value
+
+
+def read_fields(redis_client, user, *fields):
+    """取 user 的若干字段：Redis 缓冲里有就用缓冲的，没有才读库（deferred 列按需加载）"""
+    buffered = {}
+    if redis_client is not None:
+        try:
+            values = redis_client.hmget(buffer_key(user.id), *fields)
+            buffered = {f: v for f, v in zip(fields, values) if v is not None}
+        except Exception:
+            buffered = {}
+    return {
+        field: _coerce(field, buffered[field]) if field in buffered else _db_value(user, field)
+        for field in fields
+    }
+
+
+def _buffer(redis_client, user_id, values):
+    key = buffer_key(user_id)
+    with redis_client.pipeline() as pipe:
+        pipe.hset(key, mapping={f: str(v) for f, v in values.items()})
+        pipe.expire(key, BUFFER_TTL_SECONDS)
+        # 先写数据再标脏：flusher 先摘脏标记再读数据，这样不会漏掉并发的保存
+        pipe.sadd(DIRTY_KEY, user_id)
+        pipe.execute()
+    metrics.inc('notes_buffered_saves')
+
+
+def save_fields(redis_client, user, logger=None, **values):
+    """保存 quick_note / notebook（全文）。有 Redis 时只写缓冲，否则直接提交。
+    全文保存 notebook 时版本号 +1，返回新版本号（其它情况返回 None）"""
+    if redis_client is not None:
+        try:
+            if 'notebook' in values:
+                _seed_notebook(redis_client, user)
+                return _write_notebook(redis_client, user.id, values)
+            _buffer(redis_client, user.id, values)
+            return None
+        except Exception as exc:
+            if logger is not None:
+                logger.warning('Note buffer write failed user_id=%s, writing through: %s', user.id, exc)
+            _drop_buffer(redis_client, user.id)
+
+    for field, value in values.items():
+        setattr(user, field, value)
+    if 'notebook' in values:
+        user.notebook_version = func.coalesce(User.notebook_version, 0) + 1
+    db.session.commit()
+    return user.notebook_version if 'notebook' in values else None
+
+
+def _drop_buffer(redis_client, user_id):
+    # 直写数据库之后旧缓冲会遮住新值，能删就删
+    try:
+        redis_client.delete(buffer_key(user_id))
+        redis_client.srem(DIRTY_KEY, user_id)
+    except Exception:
+        pass
+
+
+def _seed_notebook(redis_client, user):
+    """缓冲里还没有笔记本时从库里补上（HSETNX：别的请求已经写过就不覆盖）"""
+    key = buffer_key(user.id)
+    text, version = redis_client.hmget(key, 'notebook', 'notebook_version')
+    if text is not None and version is not None:
+        return text, int(version)
+    with redis_client.pipeline() as pipe:
+        pipe.hsetnx(key, 'notebook', _db_value(user, 'notebook'))
+        pipe.hsetnx(key, 'notebook_version', _db_value(user, 'notebook_version'))
+        pipe.expire(key, BUFFER_TTL_SECONDS)
+        pipe.execute()
+    text, version = redis_client.hmget(key, 'notebook', 'notebook_version')
+    return text, int(version)
+
+
+def _write_notebook(redis_client, user_id, values, base_version=None):
+    """全文和版本号在同一个 MULTI 里写（WATCH 缓冲 hash）：读的一方不会看到新版本配旧全文。
+    给了 base_version 时只有当前版本还是它才写，否则返回 None，版本号不动；
+    成功返回新版本号。WATCH 期间 hash 被别的保存改过就重读再试"""
+    key = buffer_key(user_id)
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                version = int(pipe.hget(key, 'notebook_version') or 0)
+                if base_version is not None and version != base_version:
+                    return None
+                pipe.multi()
+                pipe.hset(key, mapping={**{f: str(v) for f, v in values.items()},
+                                        'notebook_version': str(version + 1)})
+                pipe.expire(key, BUFFER_TTL_SECONDS)
+                pipe.sadd(DIRTY_KEY, user_id)
+                pipe.execute()
+            except redis.WatchError:
+                continue
+            metrics.inc('notes_buffered_saves')
+            return version + 1
+
+
+def patch_notebook(redis_client, user, base_version, patch):
+    """基于 base_version 应用补丁。返回 (ok, version, notebook)：
+    成功时 notebook 为 None；版本冲突时 ok=False，带回最新版本和全文。
+    补丁本身不合法时抛 PatchError。"""
+    if redis_client is None:
+        return _patch_notebook_db(user, base_version, patch)
+
+    text, version = _seed_notebook(redis_client, user)
+    if version != base_version:
+        return False, version, text
+    notebook = apply_patch(text, patch)
+    new_version = _write_notebook(redis_client, user.id, {'notebook': notebook}, base_version)
+    if new_version is None:
+        text, version = _seed_notebook(redis_client, user)
+        return False, version, text
+    return True, new_version, None
+
+
+def _patch_notebook_db(user, base_version, patch):
+    version = user.notebook_version or 0
+    if version != base_version:
+        return False, version, user.notebook or ''
+    notebook = apply_patch(user.notebook or '', patch)
+    # 条件更新：并发的两个补丁只有一个能基于同一版本写进去
+    result = db.session.execute(
+        update(User)
+        .where(User.id == user.id,
+               func.coalesce(User.notebook_version, 0) == base_version)
+        .values(notebook=notebook, notebook_version=base_version + 1)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        db.session.expire(user)
+        return False, user.notebook_version or 0, user.notebook or ''
+    return True, base_version + 1, None
+
+
+# --- Flusher ---
+
+def flush_dirty(app, batch_size=500):
+    """把脏用户的缓冲写回 user 表，返回写回的用户数；写库失败时把这批用户放回脏集合"""
+    redis_client = app.redis_client
+    if redis_client is None:
+        return 0
+    flushed = 0
+    while True:
+        user_ids = redis_client.spop(DIRTY_KEY, batch_size) or []
+        if not user_ids:
+            break
+        with redis_client.pipeline() as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(buffer_key(user_id))
+            states = pipe.execute()
+
+        with app.app_context():
+            try:
+                for user_id, state in zip(user_ids, states):
+                    values = {f: _coerce(f, state[f]) for f in BUFFER_FIELDS if f in state}
+                    if values:
+                        db.session.execute(update(User).where(User.id == int(user_id)).values(**values))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                redis_client.sadd(DIRTY_KEY, *user_ids)
+                raise
+            finally:
+                db.session.remove()
+        flushed += len(user_ids)
+        if len(user_ids) < batch_size:
+            break
+    if flushed:
+        metrics.inc('notes_flushed_users', flushed)
+    return flushed
+
+
+def run_note_flusher(app, interval_seconds):
+    """后台 greenlet：每 interval_seconds 合并写回一次"""
+    while True:
+        gevent.sleep(interval_seconds)
+        try:
+            flushed = flush_dirty(app)
+            if flushed:
+                app.logger.info('Note buffer flushed %s users', flushed)
+        except Exception as exc:
+            app.logger.exception('Note buffer flush failed: %s', exc)
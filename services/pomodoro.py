@@ -0,0 +1,109 @@
+"""Live pomodoro state in Redis.
+
+While a timer runs, each open tab posts its state every few seconds. Those
+ticks only refresh a Redis hash (`pomodoro:<user_id>`, with a TTL). The
+`user.pomodoro_state` row is written only on a transition: start, pause, a
+phase or cycle change, or a manual reset. A tick carries no new information
+anyway. `remaining_seconds` together with `paused_at` already lets a reader
+extrapolate the clock, so the state saved at the last transition stays
+correct after the hash expires.
+
+Transitions are also pushed to the user's other devices as `pomodoro_updated`.
+
+Without Redis (redis_client=None) every save is committed straight away.
+"""
+import json
+import time
+
+from model import db
+from services import metrics
+
+# 只是热状态：过期后从 user.pomodoro_state 恢复
+LIVE_TTL_SECONDS = 6 * 3600
+# 客户端 setInterval 有抖动，剩余时间和推算值差这么多以内都算同一段计时
+DRIFT_TOLERANCE_SECONDS = 5
+
+
+def live_key(user_id):
+    return f'pomodoro:{user_id}'
+
+
+def normalize_state(data, now=None):
+    """把客户端提交的内容整理成存储格式，坏值回落到默认"""
+    data = data if isinstance(data, dict) else {}
+
+    def _int(name, default):
+        try:
+            return max(0, int(data.get(name, default)))
+        except (TypeError, ValueError):
+            return default
+
+    phase = data.get('phase')
+    return {
+        'remaining_seconds': _int('remaining_seconds', 1500),
+        'phase': phase if isinstance(phase, str) and phase else 'WORK',
+        'cycle_count': _int('cycle_count', 0),
+        'running': bool(data.get('running', False)),
+        'paused_at': time.time() if now is None else now,
+    }
+
+
+def _decode(raw):
+    if not raw:
+        return None
+    try:
+        state = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    return state if isinstance(state, dict) else None
+
+
+def _read_live(redis_client, user_id):
+    if redis_client is None:
+        return None
+    try:
+        return _decode(redis_client.get(live_key(user_id)))
+    except Exception:
+        return None
+
+
+def load_state(redis_client, user):
+    """先读 Redis 里的热状态，没有再读库（deferred 列按需加载）"""
+    return _read_live(redis_client, user.id) or _decode(user.pomodoro_state)
+
+
+def is_transition(previous, state):
+    """相对上一次保存是否是“状态变化”：开始/暂停、换阶段/轮次，或剩余时间被手动改过"""
+    if previous is None:
+        return True
+    for field in ('phase', 'cycle_count', 'running'):
+        if previous.get(field) != state[field]:
+            return True
+    expected = previous.get('remaining_seconds', 0)
+    if previous.get('running'):
+        expected -= state['paused_at'] - previous.get('paused_at', state['paused_at'])
+    return abs(expected - state['remaining_seconds']) > DRIFT_TOLERANCE_SECONDS
+
+
+def save_state(redis_client, user, state, logger=None):
+    """保存一次计时状态，返回是否是状态变化（调用方据此推送事件）。
+    只有状态变化才写库；普通的计时 tick 只刷新 Redis"""
+    previous = load_state(redis_client, user)
+    changed = is_transition(previous, state)
+    raw = json.dumps(state)
+
+    if redis_client is not None:
+        try:
+            redis_client.set(live_key(user.id), raw, ex=LIVE_TTL_SECONDS)
+        except Exception as exc:
+            if logger is not None:
+                logger.warning('Pomodoro live write failed user_id=%s, writing through: %s', user.id, exc)
+        else:
+            if not changed:
+                metrics.inc('pomodoro_live_ticks')
+                return False
+
+    user.pomodoro_state = raw
+    db.session.commit()
+    metrics.inc('pomodoro_persisted')
+    return changed
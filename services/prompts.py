@@ -1,11 +1,42 @@
 import datetime
+import hashlib
 import json
+import re
+from collections import Counter, OrderedDict
+
+from services import metrics
+
+
+_PROFILE_SECTION_CACHE = OrderedDict()
+_PROFILE_SECTION_CACHE_SIZE = 1024
 
 
 def build_profile_section(profile):
-    """Build a concise user-profile summary block for the system prompt."""
+    """Build a concise user-profile summary block for the system prompt.
+
+    Memoized on (user_id, updated_at): the profile only changes when the
+    settings page saves it, which bumps updated_at.
+    """
     if not profile:
         return ""
+    user_id = getattr(profile, 'user_id', None)
+    updated_at = getattr(profile, 'updated_at', None)
+    if user_id is None or updated_at is None:
+        return _render_profile_section(profile)
+
+    key = (user_id, updated_at)
+    section = _PROFILE_SECTION_CACHE.get(key)
+    if section is not None:
+        _PROFILE_SECTION_CACHE.move_to_end(key)
+        return section
+    section = _render_profile_section(profile)
+    _PROFILE_SECTION_CACHE[key] = section
+    while len(_PROFILE_SECTION_CACHE) > _PROFILE_SECTION_CACHE_SIZE:
+        _PROFILE_SECTION_CACHE.popitem(last=False)
+    return section
+
+
+def _render_profile_section(profile):
 
     lines = ["The user's personal profile (use this to calibrate all judgements):"]
     lines.append(f"  Rhythm: wakes ~{profile.typical_wakeup}, sleeps ~{profile.typical_bedtime}")
@@ -43,59 +74,21 @@ def build_profile_section(profile):
     return "\n".join(lines)
 
 
-def get_audit_prompt(notebook, quick_note, logs_data, tone="strict",
-                     current_time=None, user_profile=None):
-    """
-    Build the NEURAL AUDIT system + user prompts.
-    Returns: (system_prompt: str, user_prompt: str)
-    """
-    # ── 1. Pre-process user data ──
-    notebook_content = notebook if notebook and notebook.strip() else "No long-term goals set."
-    todo_content = quick_note if quick_note and quick_note.strip() else "No tasks on the to-do list yet."
-
-    if current_time and str(current_time).strip():
-        current_time_str = str(current_time).strip()
-    else:
-        current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M (%A)")
-
-    # ── 2. Persona ──
-    if tone == "roast":
-        persona = (
-            "You are the user's sharp-tongued, sarcastic personal secretary. "
-            "You tease and roast them about slacking and bad habits — biting "
-            "and witty, but every jab lands on a real point. Underneath the "
-            "snark you genuinely still want them to eat and sleep properly."
-        )
-    elif tone == "gentle":
-        persona = (
-            "You are the user's warm, devoted personal maid. You speak softly "
-            "and affectionately, fuss over their wellbeing, and gently encourage "
-            "them. Caring and nurturing, never harsh."
-        )
-    else:  # strict
-        persona = (
-            "You are the user's professional executive secretary. Polite, efficient, "
-            "and direct. You keep them on schedule, state things plainly, and hold "
-            "them accountable without insults."
-        )
-
-    # ── 3. Profile section ──
-    profile_section = build_profile_section(user_profile)
+# ═══════════════════════════════════════════════════════════════
+# NEURAL AUDIT
+# ═══════════════════════════════════════════════════════════════
+#
+# 提示词按"越不变越靠前"排列，方便上游做前缀缓存：
+#   system = 固定的评分细则（所有用户、所有语气逐字节相同）
+#            + 语气 persona（3 选 1）+ 用户画像（画像不改就不变）
+#   user   = 笔记本 / 待办 / 今日日志，最后才是每分钟都在变的当前时间
 
-    # ═══════════════════════════════════════════════════════════
-    # SYSTEM PROMPT — behavioural rules, rubric, format
-    # ═══════════════════════════════════════════════════════════
-    system = f"""You are Onyx, the user's neural-linked personal secretary.
+AUDIT_SYSTEM_PREFIX = """You are Onyx, the user's neural-linked personal secretary.
 Your purpose is to evaluate the user's daily productivity through a structured,
 multi-dimensional rubric — not with vague impressions, but with concrete,
 point-by-point evidence from their activity logs.
-
-[PERSONA]
-{persona}
-Speak directly TO the user, fully in character. Keep insights to 1-2 sentences.
-
-[USER PROFILE]
-{profile_section}
+Speak directly TO the user, fully in character as described in [PERSONA] below.
+Keep insights to 1-2 sentences.
 
 [SCORING PROTOCOL]
 Evaluate the day using the 4-DIMENSIONAL RUBRIC below.
@@ -300,70 +293,265 @@ OUTPUT FORMAT
 ═══════════════════════════════════════════════════
 Return ONLY a raw JSON object. No markdown fences, no backticks.
 
-{{
+{
   "status": "green" | "yellow" | "red",
   "insight": "<1-2 sentences in your persona voice>",
   "warning": "<single most urgent actionable reminder or 'None'>",
-  "rubric": {{
+  "rubric": {
     "dimensions": [
-      {{
+      {
         "name": "Task Completion",
         "weight": 0.30,
         "points": [
-          {{"label": "Completion Ratio",   "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Priority Alignment",  "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Unplanned Value",     "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Momentum",            "score": <0-5>, "note": "<1-line evidence>"}}
+          {"label": "Completion Ratio",   "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Priority Alignment",  "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Unplanned Value",     "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Momentum",            "score": <0-5>, "note": "<1-line evidence>"}
         ]
-      }},
-      {{
+      },
+      {
         "name": "Focus & Depth",
         "weight": 0.30,
         "points": [
-          {{"label": "Focus Sessions",      "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Goal Relevance",      "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Cognitive Load",      "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Context Switches",    "score": <0-5>, "note": "<1-line evidence>"}}
+          {"label": "Focus Sessions",      "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Goal Relevance",      "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Cognitive Load",      "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Context Switches",    "score": <0-5>, "note": "<1-line evidence>"}
         ]
-      }},
-      {{
+      },
+      {
         "name": "Time Discipline",
         "weight": 0.25,
         "points": [
-          {{"label": "Start Discipline",    "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Time Utilization",    "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Activity Spacing",    "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Procrastination Gap", "score": <0-5>, "note": "<1-line evidence>"}}
+          {"label": "Start Discipline",    "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Time Utilization",    "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Activity Spacing",    "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Procrastination Gap", "score": <0-5>, "note": "<1-line evidence>"}
         ]
-      }},
-      {{
+      },
+      {
         "name": "Wellness & Balance",
         "weight": 0.15,
         "points": [
-          {{"label": "Meal Adherence",      "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Break Hygiene",       "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Sleep Discipline",    "score": <0-5>, "note": "<1-line evidence>"}},
-          {{"label": "Physical Movement",   "score": <0-5>, "note": "<1-line evidence>"}}
+          {"label": "Meal Adherence",      "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Break Hygiene",       "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Sleep Discipline",    "score": <0-5>, "note": "<1-line evidence>"},
+          {"label": "Physical Movement",   "score": <0-5>, "note": "<1-line evidence>"}
         ]
-      }}
+      }
     ]
-  }}
-}}"""
+  }
+}"""
+
+AUDIT_PERSONAS = {
+    "roast": (
+        "You are the user's sharp-tongued, sarcastic personal secretary. "
+        "You tease and roast them about slacking and bad habits — biting "
+        "and witty, but every jab lands on a real point. Underneath the "
+        "snark you genuinely still want them to eat and sleep properly."
+    ),
+    "gentle": (
+        "You are the user's warm, devoted personal maid. You speak softly "
+        "and affectionately, fuss over their wellbeing, and gently encourage "
+        "them. Caring and nurturing, never harsh."
+    ),
+    "strict": (
+        "You are the user's professional executive secretary. Polite, efficient, "
+        "and direct. You keep them on schedule, state things plainly, and hold "
+        "them accountable without insults."
+    ),
+}
+
+
+# --- Token budget ---
+# 笔记本 / 待办 / 日志都是用户自己写的，长度没有上限。按优先级给每段分预算：
+# 日志最重要（只保留最近的），其次是没勾掉的待办，最后是笔记本。
+# 前面的段没用完的预算顺延给后面的段；超出的部分换成一行压缩摘要。
+
+AUDIT_SECTION_SHARES = (("logs", 0.5), ("todos", 0.2), ("notebook", 0.3))
+
+_CJK_RE = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+_LIST_ITEM_RE = re.compile(r"^(#|[-*•]|\d+[.)]|\[[ xX]\])")
+
+_CONDENSED_CACHE = OrderedDict()
+_CONDENSED_CACHE_SIZE = 1024
+
+
+def estimate_tokens(text):
+    """粗估 token 数：中日文约 1 字 1 token，其它约 4 字符 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _clip(text, limit):
+    """截到 limit 个 token 以内（二分找截断位置）"""
+    if estimate_tokens(text) <= limit:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) + 1 <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + "…"
+
+
+def _condensed(kind, source, limit, build):
+    """压缩摘要按 (kind, 原文哈希, 预算) 缓存：原文不变就不重新生成"""
+    key = (kind, hashlib.sha1(source.encode("utf-8")).hexdigest(), limit)
+    summary = _CONDENSED_CACHE.get(key)
+    if summary is not None:
+        _CONDENSED_CACHE.move_to_end(key)
+        return summary
+    summary = build(source, limit)
+    _CONDENSED_CACHE[key] = summary
+    while len(_CONDENSED_CACHE) > _CONDENSED_CACHE_SIZE:
+        _CONDENSED_CACHE.popitem(last=False)
+    return summary
+
+
+def _condense_logs(text, limit):
+    lines = text.split("\n")
+    first_start = lines[0].split("-", 1)[0]
+    last_end = lines[-1].split(": ", 1)[0].rsplit("-", 1)[-1]
+    counts = Counter(line.split(": ", 1)[-1].strip()[:40] for line in lines)
+    top = ", ".join(desc if n == 1 else f"{desc} x{n}" for desc, n in counts.most_common(5))
+    return _clip(f"(earlier today: {len(lines)} entries {first_start}-{last_end}; mostly {top})", limit)
+
+
+def _condense_notebook(text, limit):
+    """抽取式压缩：只留标题、列表项和每段第一行"""
+    picked = []
+    paragraph_start = True
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            paragraph_start = True
+            continue
+        if paragraph_start or _LIST_ITEM_RE.match(line):
+            picked.append(line[:200])
+        paragraph_start = False
+    note = f"\n(condensed from ~{estimate_tokens(text)} tokens)"
+    return _clip("\n".join(picked), max(1, limit - estimate_tokens(note))) + note
+
+
+def _fit_logs(logs_data, limit):
+    """从最新的一条往前装，装不下的更早记录合成一行摘要"""
+    kept = []
+    used = 0
+    for line in reversed(logs_data):
+        cost = estimate_tokens(line) + 2
+        if used + cost > limit:
+            break
+        kept.append(line)
+        used += cost
+    kept.reverse()
+    dropped = logs_data[:len(logs_data) - len(kept)]
+    if not dropped:
+        return kept
+    # 给摘要行腾出位置
+    summary_limit = max(16, limit // 5)
+    while kept and used + summary_limit > limit:
+        used -= estimate_tokens(kept[0]) + 2
+        dropped.append(kept.pop(0))
+    return [_condensed("logs", "\n".join(dropped), summary_limit, _condense_logs)] + kept
+
+
+def _fit_todos(todos, limit):
+    """没勾掉的排前面；装不下的只报个数"""
+    ordered = [t for t in todos if not t.get("done")] + [t for t in todos if t.get("done")]
+    lines = []
+    used = 0
+    for t in ordered:
+        line = f"{'[x]' if t.get('done') else '[ ]'} {t.get('text', '')}"
+        cost = estimate_tokens(line) + 1
+        if used + cost > limit - 16:
+            break
+        lines.append(line)
+        used += cost
+    rest = ordered[len(lines):]
+    if rest:
+        open_left = sum(1 for t in rest if not t.get("done"))
+        lines.append(f"(+{open_left} more open, {len(rest) - open_left} done tasks omitted)")
+    return "\n".join(lines)
 
-    # ═══════════════════════════════════════════════════════════
-    # USER PROMPT — pure data, no instructions
-    # ═══════════════════════════════════════════════════════════
-    user = f"""[CURRENT TIME]
-It is right now: {current_time_str}  (24-hour clock, the user's real local time).
-Anchor every time-based judgement to THIS time.
 
-[USER CONTEXT]
+def budget_audit_inputs(notebook, todos, logs_data, budget):
+    """把审计的三段用户输入压进 budget 个 token。
+
+    Returns: (notebook, todo_text, logs_data, stats)，stats 为
+    {section: (原始 token 数, 实际发送 token 数)}。
+    """
+    notebook = notebook or ""
+    todo_text = "\n".join(f"{'[x]' if t.get('done') else '[ ]'} {t.get('text', '')}" for t in todos)
+    sources = {
+        "logs": sum(estimate_tokens(line) + 2 for line in logs_data),
+        "todos": estimate_tokens(todo_text),
+        "notebook": estimate_tokens(notebook),
+    }
+    stats = {}
+    carry = 0
+    for section, share in AUDIT_SECTION_SHARES:
+        limit = int(budget * share) + carry
+        if sources[section] <= limit:
+            sent = sources[section]
+        elif section == "logs":
+            logs_data = _fit_logs(logs_data, limit)
+            sent = sum(estimate_tokens(line) + 2 for line in logs_data)
+        elif section == "todos":
+            todo_text = _fit_todos(todos, limit)
+            sent = estimate_tokens(todo_text)
+        else:
+            notebook = _condensed("notebook", notebook, limit, _condense_notebook)
+            sent = estimate_tokens(notebook)
+        carry = max(0, limit - sent)
+        stats[section] = (sources[section], sent)
+        metrics.observe("audit_prompt_tokens", sent, section=section)
+        if sent < sources[section]:
+            metrics.inc("audit_prompt_trimmed", section=section)
+    return notebook, todo_text, logs_data, stats
+
+
+def get_audit_prompt(notebook, quick_note, logs_data, tone="strict",
+                     current_time=None, user_profile=None):
+    """
+    Build the NEURAL AUDIT system + user prompts.
+    Returns: (system_prompt: str, user_prompt: str)
+    """
+    notebook_content = notebook if notebook and notebook.strip() else "No long-term goals set."
+    todo_content = quick_note if quick_note and quick_note.strip() else "No tasks on the to-do list yet."
+
+    if current_time and str(current_time).strip():
+        current_time_str = str(current_time).strip()
+    else:
+        current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M (%A)")
+
+    persona = AUDIT_PERSONAS.get(tone, AUDIT_PERSONAS["strict"])
+    profile_section = build_profile_section(user_profile)
+
+    system = AUDIT_SYSTEM_PREFIX + f"""
+
+[PERSONA]
+{persona}
+
+[USER PROFILE]
+{profile_section}"""
+
+    # USER PROMPT — pure data, no instructions
+    user = f"""[USER CONTEXT]
 Long-term Goals (Notebook): {notebook_content}
 Today's To-Do List:
 {todo_content}
 
 [TODAY'S ACTIVITY LOGS]  (start - end : description)
-{logs_data}"""
+{logs_data}
+
+[CURRENT TIME]
+It is right now: {current_time_str}  (24-hour clock, the user's real local time).
+Anchor every time-based judgement to THIS time."""
 
     return system, user
 
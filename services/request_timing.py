@@ -0,0 +1,188 @@
+"""Per-request cost accounting: SQL queries, Redis calls, upstream LLM calls.
+
+SQLAlchemy cursor events, the TimedRedis client and LLMClient all report into
+a RequestTiming object stored on flask.g. Work done outside a request
+(sweeper, flusher, categorize worker) is not counted. When the request ends:
+
+- a `Server-Timing` header carries the totals, so browser devtools show them
+  per request;
+- one `access ...` log line carries the same numbers as key=value pairs;
+- if one SQL statement ran N_PLUS_ONE_THRESHOLD times or more in the same
+  request, a warning names it. That is the signature of a lazy load inside a
+  loop.
+"""
+import time
+from collections import Counter
+
+import redis
+from flask import g, has_request_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+
+from services import metrics
+
+_STATEMENT_PREVIEW = 200
+
+
+class RequestTiming:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.statements = Counter()
+        self.redis_calls = 0
+        self.redis_seconds = 0.0
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def most_repeated(self):
+        """(statement, 次数)；没有查询时返回 (None, 0)"""
+        if not self.statements:
+            return None, 0
+        return self.statements.most_common(1)[0]
+
+    def server_timing(self):
+        parts = [
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"',
+            f'redis;dur={self.redis_seconds * 1000:.1f};desc="{self.redis_calls} calls"',
+        ]
+        if self.llm_calls:
+            parts.append(f'llm;dur={self.llm_seconds * 1000:.1f};desc="{self.llm_calls} calls"')
+        parts.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(parts)
+
+
+def current():
+    """当前请求的 RequestTiming；不在请求里（后台 greenlet、CLI）时返回 None"""
+    if not has_request_context():
+        return None
+    return g.get('request_timing')
+
+
+def record(kind, seconds):
+    """kind 是 'redis' 或 'llm'；SQL 由引擎事件自己记"""
+    timing = current()
+    if timing is None:
+        return
+    setattr(timing, f'{kind}_calls', getattr(timing, f'{kind}_calls') + 1)
+    setattr(timing, f'{kind}_seconds', getattr(timing, f'{kind}_seconds') + seconds)
+
+
+# --- SQLAlchemy ---
+
+# 开始时间挂在这条语句自己的 ExecutionContext 上：出错的语句不会留下什么，下一条也不会配错
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._request_timing_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _finish_statement(context, statement)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    # 失败的语句也到过数据库：照样计数计时
+    _finish_statement(exception_context.execution_context, exception_context.statement)
+
+
+def _finish_statement(context, statement):
+    started = getattr(context, '_request_timing_started', None)
+    if started is None:
+        return
+    context._request_timing_started = None
+    timing = current()
+    if timing is None:
+        return
+    timing.db_queries += 1
+    timing.db_seconds += time.perf_counter() - started
+    timing.statements[statement] += 1
+
+
+# --- Redis ---
+
+class TimedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            record('redis', time.perf_counter() - started)
+
+
+class TimedRedis(redis.Redis):
+    """redis.Redis that reports each command (a pipeline counts as one round trip)"""
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            record('redis', time.perf_counter() - started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# --- Flask hooks ---
+
+def init_request_timing(app):
+    @app.before_request
+    def _start_request_timing():
+        g.request_timing = RequestTiming()
+
+    @app.after_request
+    def _finish_request_timing(response):
+        timing = g.get('request_timing')
+        if timing is None:
+            return response
+        response.headers['Server-Timing'] = timing.server_timing()
+        where = (request.method, request.path, request.blueprint or '', request.endpoint or 'unknown',
+                 _user_id())
+        if response.is_streamed:
+            # 流式响应（SSE、审计）的主体在这之后才生成：等连接关闭再记，LLM 时间才算得进去
+            response.call_on_close(lambda: _report(app, timing, response.status_code, *where))
+        else:
+            _report(app, timing, response.status_code, *where)
+        return response
+
+
+def _user_id():
+    # 只看这次请求已经加载过的用户；不为了记日志去触发 user_loader 或刷新过期对象
+    user = g.get('_login_user')
+    if user is None or not user.is_authenticated:
+        return None
+    identity = inspect(user).identity
+    return identity[0] if identity else None
+
+
+def _report(app, timing, status, method, path, blueprint, endpoint, user_id):
+    elapsed = timing.elapsed()
+
+    metrics.inc('http_requests', endpoint=endpoint, status=status)
+    metrics.histogram('http_request_seconds', elapsed, blueprint=blueprint, endpoint=endpoint)
+    metrics.inc('http_db_queries', timing.db_queries, endpoint=endpoint)
+    metrics.inc('http_db_seconds', timing.db_seconds, endpoint=endpoint)
+
+    app.logger.info(
+        'access method=%s path=%s endpoint=%s status=%s user_id=%s duration_ms=%.1f '
+        'db_queries=%d db_ms=%.1f redis_calls=%d redis_ms=%.1f llm_calls=%d llm_ms=%.1f',
+        method, path, endpoint, status, user_id, elapsed * 1000,
+        timing.db_queries, timing.db_seconds * 1000, timing.redis_calls, timing.redis_seconds * 1000,
+        timing.llm_calls, timing.llm_seconds * 1000,
+    )
+
+    threshold = app.config.get('N_PLUS_ONE_THRESHOLD', 0)
+    statement, repeats = timing.most_repeated()
+    if threshold and repeats >= threshold:
+        metrics.inc('http_n_plus_one', endpoint=endpoint)
+        app.logger.warning(
+            'Possible N+1 endpoint=%s path=%s repeats=%d db_queries=%d statement=%s',
+            endpoint, path, repeats, timing.db_queries,
+            ' '.join(statement.split())[:_STATEMENT_PREVIEW],
+        )
@@ -0,0 +1,182 @@
+"""DailyRollup maintenance.
+
+Every flush that inserts, deletes or changes a TimeEntry turns into +/- deltas
+on the (user_id, logical_date, category) rollup rows, written with an upsert on
+the same connection, so the rollup commits or rolls back together with the
+entries themselves.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+from model import db, TimeEntry, DailyRollup
+from services.stats import is_deep_work, parse_clock_minutes, span_minutes
+
+# 影响汇总归属或数值的字段；其它字段（如 is_archived）变化不需要动汇总
+TRACKED_FIELDS = ('user_id', 'archive_date', 'timestamp', 'category', 'desc',
+                  'start_time', 'end_time', 'duration_minutes')
+
+
+def rollup_logical_date(archive_date, timestamp):
+    if archive_date is not None:
+        return archive_date
+    timestamp = timestamp or datetime.now()
+    return (timestamp - timedelta(hours=6)).date()
+
+
+def _contribution(values):
+    """TimeEntry 的一组字段值 -> (key, (total, deep, count))；无法归属时返回 None"""
+    if values['user_id'] is None:
+        return None
+    duration = values['duration_minutes']
+    if duration is None:
+        duration = span_minutes(parse_clock_minutes(values['start_time']),
+                                parse_clock_minutes(values['end_time'])) or 0
+    key = (
+        values['user_id'],
+        rollup_logical_date(values['archive_date'], values['timestamp']),
+        values['category'] or 'Uncategorized',
+    )
+    deep = duration if is_deep_work(values['desc']) else 0
+    return key, (duration, deep, 1)
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# active_history 让对已过期（刚 commit 过）的对象赋值时先加载旧值，
+# 否则 flush 时拿不到旧分类/旧时长，无法从原汇总行里减掉
+for _field in TRACKED_FIELDS:
+    event.listen(getattr(TimeEntry, _field), 'set', _load_old_value, active_history=True)
+
+
+def _current_values(entry):
+    return {field: getattr(entry, field) for field in TRACKED_FIELDS}
+
+
+def _committed_values(entry):
+    state = sa_inspect(entry)
+    values = {}
+    for field in TRACKED_FIELDS:
+        history = state.attrs[field].history
+        if history.deleted:
+            values[field] = history.deleted[0]
+        elif history.unchanged:
+            values[field] = history.unchanged[0]
+        else:
+            values[field] = getattr(entry, field)
+    return values
+
+
+def _accumulate(deltas, contribution, sign):
+    if contribution is None:
+        return
+    key, (total, deep, count) = contribution
+    acc = deltas.setdefault(key, [0, 0, 0])
+    acc[0] += sign * total
+    acc[1] += sign * deep
+    acc[2] += sign * count
+
+
+def _upsert_statement(dialect_name):
+    if dialect_name == 'postgresql':
+        return postgresql.insert(DailyRollup.__table__)
+    if dialect_name == 'sqlite':
+        return sqlite.insert(DailyRollup.__table__)
+    return None
+
+
+def apply_deltas(connection, deltas):
+    table = DailyRollup.__table__
+    insert = _upsert_statement(connection.dialect.name)
+
+    for (user_id, logical_date, category), (total, deep, count) in deltas.items():
+        if total == 0 and deep == 0 and count == 0:
+            continue
+        row = {
+            'user_id': user_id, 'logical_date': logical_date, 'category': category,
+            'total_minutes': total, 'deep_minutes': deep, 'entry_count': count,
+        }
+        key_clause = (
+            (table.c.user_id == user_id)
+            & (table.c.logical_date == logical_date)
+            & (table.c.category == category)
+        )
+        if insert is not None:
+            connection.execute(insert.values(**row).on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.logical_date, table.c.category],
+                set_={
+                    'total_minutes': table.c.total_minutes + total,
+                    'deep_minutes': table.c.deep_minutes + deep,
+                    'entry_count': table.c.entry_count + count,
+                },
+            ))
+        else:
+            updated = connection.execute(table.update().where(key_clause).values(
+                total_minutes=table.c.total_minutes + total,
+                deep_minutes=table.c.deep_minutes + deep,
+                entry_count=table.c.entry_count + count,
+            ))
+            if updated.rowcount == 0:
+                connection.execute(table.insert().values(**row))
+
+        if count < 0:
+            connection.execute(table.delete().where(key_clause & (table.c.entry_count <= 0)))
+
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_deleted(session, flush_context, instances):
+    # 被删除的记录在 flush 之后就读不到了，趁行还在时先记下要减掉的量
+    deltas = {}
+    for obj in session.deleted:
+        if isinstance(obj, TimeEntry):
+            _accumulate(deltas, _contribution(_committed_values(obj)), -1)
+    session.info['rollup_deltas'] = deltas
+
+
+@event.listens_for(db.session, 'after_flush')
+def _update_rollups(session, flush_context):
+    deltas = session.info.pop('rollup_deltas', None) or {}
+    for obj in session.new:
+        if isinstance(obj, TimeEntry):
+            _accumulate(deltas, _contribution(_current_values(obj)), +1)
+    for obj in session.dirty:
+        if not isinstance(obj, TimeEntry) or obj in session.deleted:
+            continue
+        state = sa_inspect(obj)
+        if not any(state.attrs[field].history.has_changes() for field in TRACKED_FIELDS):
+            continue
+        _accumulate(deltas, _contribution(_committed_values(obj)), -1)
+        _accumulate(deltas, _contribution(_current_values(obj)), +1)
+
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+def rebuild_rollups(user_id=None, batch_size=5000):
+    """从 expenses 全量重算汇总（可限定单个用户），返回写入的汇总行数"""
+    entries = db.session.query(
+        TimeEntry.user_id, TimeEntry.archive_date, TimeEntry.timestamp,
+        TimeEntry.category, TimeEntry.desc, TimeEntry.start_time,
+        TimeEntry.end_time, TimeEntry.duration_minutes,
+    ).filter(TimeEntry.user_id.isnot(None))
+    delete = DailyRollup.__table__.delete()
+    if user_id is not None:
+        entries = entries.filter(TimeEntry.user_id == user_id)
+        delete = delete.where(DailyRollup.user_id == user_id)
+
+    totals = {}
+    for row in entries.yield_per(batch_size):
+        _accumulate(totals, _contribution(row._asdict()), +1)
+
+    db.session.execute(delete)
+    if totals:
+        db.session.execute(DailyRollup.__table__.insert(), [
+            {'user_id': u, 'logical_date': d, 'category': c,
+             'total_minutes': total, 'deep_minutes': deep, 'entry_count': count}
+            for (u, d, c), (total, deep, count) in totals.items()
+        ])
+    db.session.commit()
+    return len(totals)
@@ -0,0 +1,160 @@
+"""Per-process fan-out of Redis pub/sub to SSE connections.
+
+Each worker holds ONE pattern subscription (`<prefix>:*`) in a background
+greenlet and pushes every message into the gevent queues of the local streams
+registered for that user, so the number of Redis connections no longer grows
+with the number of open dashboards.
+
+A stream whose queue fills up (a client reading too slowly) is not fed
+partially: its queue is emptied and replaced by the OVERFLOW marker, which
+ends the response. EventSource reconnects with Last-Event-ID and the missed
+events are replayed from the user's Redis Stream.
+"""
+import json
+import time
+
+import gevent
+from gevent.event import Event
+from gevent.queue import Empty, Full, Queue
+
+from services import metrics
+
+RECONNECT_BACKOFF_SECONDS = (0.5, 1, 2, 5, 10)
+# subscribe() 最多等这么久 PSUBSCRIBE 确认；Redis 连不上时不能把新连接一直挂着
+SUBSCRIBE_WAIT_SECONDS = 2
+
+# 溢出连接队列里的最后一项：流读到它就结束
+OVERFLOW = object()
+
+
+class SSEBroker:
+    def __init__(self, redis_client, channel_prefix, logger=None, queue_size=256):
+        self.redis_client = redis_client
+        self.channel_prefix = channel_prefix
+        self.logger = logger
+        self.queue_size = queue_size
+        self._subscribers = {}  # user_id (str) -> set[Queue]
+        self._greenlet = None
+        self._ready = Event()   # PSUBSCRIBE 已确认
+
+    # --- bookkeeping ---
+
+    def subscribe(self, user_id):
+        queue = Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(str(user_id), set()).add(queue)
+        self._update_gauges()
+        self._ensure_running()
+        if self.redis_client is not None:
+            # 订阅确认之前发布的事件收不到：等一下再让调用方开始读
+            self._ready.wait(SUBSCRIBE_WAIT_SECONDS)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        key = str(user_id)
+        queues = self._subscribers.get(key)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[key]
+        self._update_gauges()
+
+    def stats(self):
+        return {
+            'streams': sum(len(qs) for qs in self._subscribers.values()),
+            'users': len(self._subscribers),
+            'running': self.running,
+        }
+
+    @property
+    def running(self):
+        return self._greenlet is not None and not self._greenlet.dead
+
+    def _update_gauges(self):
+        stats = self.stats()
+        metrics.set_gauge('sse_connected_streams', stats['streams'])
+        metrics.set_gauge('sse_connected_users', stats['users'])
+
+    # --- Redis side ---
+
+    def _ensure_running(self):
+        if self.redis_client is None or self.running:
+            return
+        self._greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        attempt = 0
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis_client.pubsub()
+                pubsub.psubscribe(f'{self.channel_prefix}:*')
+                self._wait_subscribed(pubsub)
+                self._ready.set()
+                attempt = 0
+                self._consume(pubsub)
+            except Exception as exc:
+                metrics.inc('sse_broker_reconnects')
+                if self.logger:
+                    self.logger.warning('SSE broker subscription lost: %s', exc)
+            finally:
+                self._ready.clear()
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            gevent.sleep(RECONNECT_BACKOFF_SECONDS[min(attempt, len(RECONNECT_BACKOFF_SECONDS) - 1)])
+            attempt += 1
+
+    @staticmethod
+    def _wait_subscribed(pubsub):
+        deadline = time.monotonic() + SUBSCRIBE_WAIT_SECONDS
+        while True:
+            message = pubsub.get_message(timeout=max(deadline - time.monotonic(), 0))
+            if message and message.get('type') == 'psubscribe':
+                return
+            if time.monotonic() >= deadline:
+                raise TimeoutError('PSUBSCRIBE not confirmed')
+
+    def _consume(self, pubsub):
+        for message in pubsub.listen():
+            if message.get('type') != 'pmessage':
+                continue
+            self.dispatch(message.get('channel'), message.get('data'))
+
+    def dispatch(self, channel, raw):
+        """把一条频道消息（JSON 字符串）解码一次，分发给该用户所有本地连接"""
+        prefix = f'{self.channel_prefix}:'
+        if not channel or not channel.startswith(prefix):
+            return
+        user_id = channel[len(prefix):]
+        queues = self._subscribers.get(user_id)
+        if not queues:
+            return
+        try:
+            payload = json.loads(raw or '{}')
+        except (ValueError, TypeError):
+            return
+        for queue in list(queues):
+            try:
+                queue.put_nowait(payload)
+                metrics.inc('sse_messages_dispatched')
+            except Full:
+                self._overflow(user_id, queue)
+
+    def _overflow(self, user_id, queue):
+        """客户端读得太慢：不阻塞 broker，也不悄悄丢一部分事件，而是结束这条流让它重连补齐"""
+        self.unsubscribe(user_id, queue)
+        dropped = 1
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                break
+            dropped += 1
+        queue.put_nowait(OVERFLOW)
+        metrics.inc('sse_messages_dropped', dropped)
+        metrics.inc('sse_streams_overflowed')
+        if self.logger:
+            self.logger.warning('SSE stream overflowed user_id=%s dropped=%s, closing for replay',
+                                user_id, dropped)
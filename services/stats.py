@@ -1,11 +1,50 @@
 from datetime import datetime, timedelta
 
+from sqlalchemy import case, func, or_
+
+from model import db, TimeEntry
+
+DEEP_KEYWORDS = ('code', 'coding', 'study', 'math', 'cs', 'exam', 'quiz', 'write', 'algo', 'data', 'train', 'ai', 'implement', 'logic', 'work')
+
 def get_logical_date(dt):
     if (dt.hour < 6):
         return (dt - timedelta(days=1)).strftime('%Y-%m-%d')
     else:
         return dt.strftime('%Y-%m-%d')
 
+def parse_clock_minutes(value):
+    """把 "HH:MM" / "HH:MM:SS" 解析成当天第几分钟（0-1439），解析失败返回 None"""
+    if not value:
+        return None
+    value = str(value).strip()
+    for fmt in ("%H:%M", "%H:%M:%S"):
+        try:
+            t = datetime.strptime(value, fmt)
+            return t.hour * 60 + t.minute
+        except ValueError:
+            continue
+    return None
+
+def span_minutes(start_minute, end_minute):
+    """两个分钟数之间的时长，结束早于开始视为跨天 (23:00 -> 01:00)"""
+    if start_minute is None or end_minute is None:
+        return None
+    diff = end_minute - start_minute
+    if diff < 0:
+        diff += 24 * 60
+    return diff
+
+def entry_minutes(log):
+    """优先读写入时算好的 duration_minutes；老数据（尚未回填）才退回解析字符串"""
+    duration = getattr(log, 'duration_minutes', None)
+    if duration is not None:
+        return duration
+    return span_minutes(parse_clock_minutes(log.start_time), parse_clock_minutes(log.end_time))
+
+def is_deep_work(desc):
+    desc = (desc or '').lower()
+    return any(k in desc for k in DEEP_KEYWORDS)
+
 def calculate_stats_from_logs(logs_list):
     """
     纯计算函数：传入 log 对象列表，返回统计数据。
@@ -13,34 +52,32 @@ def calculate_stats_from_logs(logs_list):
     """
     total_minutes = 0
     deep_minutes = 0
-    deep_keywords = ['code', 'coding', 'study', 'math', 'cs', 'exam', 'quiz', 'write', 'algo', 'data', 'train', 'ai', 'implement', 'logic', 'work', 'study']
 
     for log in logs_list:
-        try:
-            t_start = datetime.strptime(log.start_time, "%H:%M")
-            t_end = datetime.strptime(log.end_time, "%H:%M")
-            
-            if t_end < t_start:
-                t_end += timedelta(days=1)
-                
-            duration = (t_end - t_start).total_seconds() / 60
-            total_minutes += duration
-            
-            if any(k in log.desc.lower() for k in deep_keywords):
-                deep_minutes += duration
-        except Exception:
+        duration = entry_minutes(log)
+        if duration is None:
             continue
-            
+        total_minutes += duration
+        if is_deep_work(log.desc):
+            deep_minutes += duration
+
     return round(total_minutes / 60, 1), round(deep_minutes / 60, 1)
 
 def calculate_duration(start_str, end_str):
-    try:
-        fmt = "%H:%M"
-        t1 = datetime.strptime(start_str, fmt)
-        t2 = datetime.strptime(end_str, fmt)
-        if t2 < t1: # 处理跨天 (23:00 -> 01:00)
-            t2 += timedelta(days=1)
-        delta = t2 - t1
-        return int(delta.total_seconds() / 60)
-    except:
-        return 0
\ No newline at end of file
+    duration = span_minutes(parse_clock_minutes(start_str), parse_clock_minutes(end_str))
+    return duration if duration is not None else 0
+
+def sum_entry_stats(*criteria):
+    """
+    calculate_stats_from_logs 的 SQL 版本：直接在库里 SUM(duration_minutes)，
+    不把 ORM 对象拉回 Python。返回 (total_minutes, deep_minutes)。
+    """
+    desc = func.lower(TimeEntry.desc)
+    is_deep = or_(*(desc.like(f'%{k}%') for k in DEEP_KEYWORDS))
+    duration = func.coalesce(TimeEntry.duration_minutes, 0)
+
+    total, deep = db.session.query(
+        func.coalesce(func.sum(duration), 0),
+        func.coalesce(func.sum(case((is_deep, duration), else_=0)), 0),
+    ).filter(*criteria).one()
+    return int(total), int(deep)
@@ -0,0 +1,38 @@
+"""Text patches for the versioned notebook sync.
+
+A patch is a list of splice ops `{"pos": int, "del": int, "ins": str}`,
+applied in order, each against the result of the previous one. Positions and
+lengths count UTF-16 code units, the same unit as JavaScript string indices,
+so the browser can compute them with plain `slice()`.
+"""
+
+MAX_PATCH_OPS = 100
+
+
+class PatchError(ValueError):
+    pass
+
+
+def apply_patch(text, ops):
+    """把 ops 依次应用到 text 上，返回新文本；格式不对或越界抛 PatchError"""
+    if not isinstance(ops, list) or not ops or len(ops) > MAX_PATCH_OPS:
+        raise PatchError('patch must be a non-empty list of at most %d ops' % MAX_PATCH_OPS)
+
+    buf = (text or '').encode('utf-16-le')
+    for op in ops:
+        if not isinstance(op, dict):
+            raise PatchError('patch op must be an object')
+        pos, delete, insert = op.get('pos'), op.get('del', 0), op.get('ins', '')
+        if (not isinstance(pos, int) or not isinstance(delete, int) or not isinstance(insert, str)
+                or isinstance(pos, bool) or isinstance(delete, bool)):
+            raise PatchError('patch op needs integer pos/del and string ins')
+        start, end = pos * 2, (pos + delete) * 2
+        if pos < 0 or delete < 0 or end > len(buf):
+            raise PatchError('patch op out of range')
+        buf = buf[:start] + insert.encode('utf-16-le', 'surrogatepass') + buf[end:]
+
+    try:
+        return buf.decode('utf-16-le')
+    except UnicodeDecodeError:
+        # 切在了代理对中间
+        raise PatchError('patch splits a surrogate pair')
@@ -0,0 +1,140 @@
+"""To-Do items, one row each in the `todo` table.
+
+Adding a task is a single INSERT ... SELECT that computes the position and
+checks the limit, run after locking the user's row. Toggling, editing or
+deleting a task touches only its own row (a single
+UPDATE ... RETURNING / DELETE), and the SSE events carry only that item, so the
+cost of a click no longer grows with the length of the list.
+
+Before this table existed the list was a JSON array in `user.todos`;
+`migrate_json_todos` moves whatever is still there into rows once.
+"""
+from sqlalchemy import delete, func, insert, literal, select, update
+
+from model import db, Todo, User
+
+MAX_TODOS = 200
+TEXT_MAX_LENGTH = 500
+
+
+class TodoLimitReached(Exception):
+    pass
+
+
+def clean_text(value):
+    """去掉首尾空白并截断；空字符串返回 None"""
+    text = str(value if value is not None else '').strip()[:TEXT_MAX_LENGTH]
+    return text or None
+
+
+def serialize_todo(todo):
+    return {
+        'id': todo.id,
+        'text': todo.text,
+        'done': bool(todo.done),
+        'position': todo.position,
+    }
+
+
+def list_todos(user_id):
+    rows = Todo.query.filter_by(user_id=user_id).order_by(Todo.position, Todo.id).all()
+    return [serialize_todo(t) for t in rows]
+
+
+def add_todo(user_id, text, done=False):
+    """追加到列表末尾；超过 MAX_TODOS 条抛 TodoLimitReached。
+    先锁住用户行（SELECT ... FOR UPDATE），同一用户的并发追加排队；
+    条数检查和 position 都在同一条 INSERT ... SELECT 里算，不会两边都读到旧的 max(position)"""
+    db.session.query(User.id).filter(User.id == user_id).with_for_update().one_or_none()
+    source = select(
+        literal(user_id), literal(text), literal(bool(done)),
+        func.coalesce(func.max(Todo.position) + 1, 0),
+    ).where(Todo.user_id == user_id).having(func.count(Todo.id) < MAX_TODOS)
+    row = db.session.execute(
+        insert(Todo)
+        .from_select(['user_id', 'text', 'done', 'position'], source)
+        .returning(Todo.id, Todo.text, Todo.done, Todo.position)
+    ).first()
+    db.session.commit()
+    if row is None:
+        raise TodoLimitReached(MAX_TODOS)
+    return row
+
+
+def update_todo(user_id, todo_id, **values):
+    """只改一行并用 RETURNING 拿回结果，不先 SELECT；不存在或不属于该用户返回 None"""
+    row = db.session.execute(
+        update(Todo)
+        .where(Todo.id == todo_id, Todo.user_id == user_id)
+        .values(**values)
+        .returning(Todo.id, Todo.text, Todo.done, Todo.position)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.session.commit()
+    return serialize_todo(row) if row is not None else None
+
+
+def delete_todo(user_id, todo_id):
+    result = db.session.execute(
+        delete(Todo)
+        .where(Todo.id == todo_id, Todo.user_id == user_id)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount > 0
+
+
+def clear_todos(user_id):
+    db.session.execute(
+        delete(Todo).where(Todo.user_id == user_id).execution_options(synchronize_session=False)
+    )
+
+
+def replace_todos(user_id, items):
+    """整表替换（批量保存接口 / quick_note 迁移用），调用方负责 commit"""
+    clear_todos(user_id)
+    rows = [Todo(user_id=user_id, text=item['text'], done=bool(item.get('done')), position=i)
+            for i, item in enumerate(items[:MAX_TODOS])]
+    db.session.add_all(rows)
+    return rows
+
+
+def migrate_json_todos(logger=None):
+    """把 user.todos 里的旧 JSON 搬进 todo 表，返回迁移的用户数。
+
+    每个用户用条件 UPDATE 把 JSON 清成 '[]'，只有抢到的那个 worker 插入行，
+    所以多个 worker 同时启动也不会重复迁移。写缓冲里还没刷盘的旧值优先。
+    """
+    from routes.common import load_todos, notes_redis
+    from services.note_buffer import buffer_key
+
+    redis_client = notes_redis()
+    candidates = db.session.query(User.id).filter(
+        User.todos != None, User.todos != '', User.todos != '[]',
+    ).all()
+    migrated = 0
+    for (user_id,) in candidates:
+        user = db.session.get(User, user_id)
+        raw = user.todos
+        items = load_todos(user)
+        claimed = db.session.execute(
+            update(User)
+            .where(User.id == user_id, User.todos == raw)
+            .values(todos='[]')
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            continue
+        if not Todo.query.filter_by(user_id=user_id).first():
+            replace_todos(user_id, items)
+        db.session.commit()
+        migrated += 1
+        if redis_client is not None:
+            try:
+                redis_client.hdel(buffer_key(user_id), 'todos')
+            except Exception:
+                pass
+    if migrated and logger is not None:
+        logger.info('Migrated JSON todos of %s users into the todo table', migrated)
+    return migrated
@@ -98,6 +98,23 @@ function buildEntryRow(entry) {
   return tr;
 }
 
+// Server-rendered snapshot (same shape as GET /api/dashboard). Each consumer
+// takes its part once on first paint; later refreshes hit the regular endpoints.
+let dashboardSnapshot;
+function takeSnapshotPart(key) {
+  if (dashboardSnapshot === undefined) {
+    dashboardSnapshot = null;
+    const el = document.getElementById('dashboard-data');
+    if (el) {
+      try { dashboardSnapshot = JSON.parse(el.textContent); } catch (e) { dashboardSnapshot = null; }
+    }
+  }
+  if (!dashboardSnapshot || !(key in dashboardSnapshot)) return null;
+  const part = dashboardSnapshot[key];
+  delete dashboardSnapshot[key];
+  return part;
+}
+
 // Refresh the live "Total Tracked" footer and Data Matrix cells from a
 // lightweight endpoint (no LLM). The chart itself is NOT refreshed here — that
 // stays manual/page-load only, since it hits a paid categorization API.
@@ -164,24 +181,22 @@ async function postFormJson(action, formData) {
   return response.json();
 }
 
-let applyingRemoteNotebook = false;
-
 function applyNotebookUpdate(payload) {
   if (!payload || !payload.type) return;
 
-  const isQuick = payload.type === 'quick_note';
-  const textarea = document.getElementById(isQuick ? 'quick_note_area' : 'notebook_area');
-  const statusSpan = document.getElementById(isQuick ? 'status-quick' : 'status-book');
+  if (payload.type !== 'quick_note') {
+    applyRemoteNotebook(payload);
+    return;
+  }
 
+  const textarea = document.getElementById('quick_note_area');
+  const statusSpan = document.getElementById('status-quick');
   if (!textarea) return;
 
   const incoming = payload.content || '';
   if (textarea.value !== incoming) {
-    applyingRemoteNotebook = true;
     textarea.value = incoming;
-    applyingRemoteNotebook = false;
   }
-  textarea.dataset.lastRemoteValue = incoming;
 
   if (statusSpan && payload.saved_at) {
     statusSpan.innerText = 'Saved ' + payload.saved_at;
@@ -279,11 +294,39 @@ function setupEventStream() {
     }
   });
 
+  ['todo_created', 'todo_updated', 'todo_deleted'].forEach((name) => {
+    source.addEventListener(name, (event) => {
+      try {
+        applyTodoChange(name, JSON.parse(event.data));
+      } catch (e) {
+        console.error('Failed to parse ' + name + ' event', e);
+      }
+    });
+  });
+
+  source.addEventListener('pomodoro_updated', (event) => {
+    try {
+      applyRemotePomodoro(JSON.parse(event.data));
+    } catch (e) {
+      console.error('Failed to parse pomodoro_updated event', e);
+    }
+  });
+
+  source.addEventListener('entries_categorized', () => {
+    // 后台 categorize-worker 写回了分类，让图表重新拉一次
+    window.dispatchEvent(new CustomEvent('onyx:categories-updated'));
+  });
+
   source.addEventListener('heartbeat', () => {
     const body = document.body;
     if (body) body.dataset.sseHeartbeatAt = String(Date.now());
   });
 
+  source.addEventListener('resync', () => {
+    // 断线期间错过的事件已被裁掉，无法逐条补发，直接整页刷新拿最新状态
+    window.location.reload();
+  });
+
   source.onerror = () => {
     // EventSource reconnects automatically; keep this non-fatal.
     console.warn('SSE connection interrupted; waiting for reconnect.');
@@ -353,23 +396,168 @@ function toggleRecording() {
 //  4. NOTEBOOK AUTOSAVE
 // ═══════════════════════════════════════════
 
-function saveNote(type, content, statusId) {
-  if (applyingRemoteNotebook) return;
+// 笔记本按版本号增量同步：只提交相对 base（服务器确认过的第 version 版）的补丁，
+// 服务器版本已前进时回 409 + 最新全文，本地改动 rebase 上去后重试。
+// 补丁位置按 JS 字符串下标（UTF-16）计，服务端用同样的单位。
+const notebookSync = {
+  version: 0,
+  base: '',
+  inflight: false,
+  dirty: false,
+};
+
+function isHighSurrogate(code) {
+  return code >= 0xd800 && code <= 0xdbff;
+}
+
+function diffText(before, after) {
+  // 单段替换：去掉公共前缀和后缀，剩下的就是补丁
+  if (before === after) return null;
+  const max = Math.min(before.length, after.length);
+  let start = 0;
+  while (start < max && before[start] === after[start]) start++;
+  if (start > 0 && isHighSurrogate(before.charCodeAt(start - 1))) start--;
+
+  let endBefore = before.length;
+  let endAfter = after.length;
+  while (endBefore > start && endAfter > start && before[endBefore - 1] === after[endAfter - 1]) {
+    endBefore--;
+    endAfter--;
+  }
+  if (endBefore < before.length && isHighSurrogate(before.charCodeAt(endBefore - 1))) {
+    endBefore++;
+    endAfter++;
+  }
+  return { pos: start, del: endBefore - start, ins: after.slice(start, endAfter) };
+}
+
+function applyOps(text, ops) {
+  return ops.reduce((acc, op) => acc.slice(0, op.pos) + op.ins + acc.slice(op.pos + op.del), text);
+}
+
+function rebaseOp(op, remoteOps) {
+  // 把本地补丁挪到远端补丁之后的坐标；两边改到同一段时返回 null
+  let rebased = op;
+  for (const remote of remoteOps) {
+    if (rebased.pos >= remote.pos + remote.del) {
+      rebased = { ...rebased, pos: rebased.pos + remote.ins.length - remote.del };
+    } else if (rebased.pos + rebased.del > remote.pos) {
+      return null;
+    }
+  }
+  return rebased;
+}
+
+function mapIndex(index, ops) {
+  return ops.reduce((i, op) => (i >= op.pos + op.del ? i + op.ins.length - op.del : Math.min(i, op.pos)), index);
+}
+
+function mergeRemoteNotebook(remoteOps, version) {
+  // 把远端的改动合进文本框，保留本地还没保存的改动和光标位置
+  const textarea = document.getElementById('notebook_area');
+  if (!textarea) return;
 
-  const statusSpan = document.getElementById(statusId);
+  const newBase = applyOps(notebookSync.base, remoteOps);
+  const local = diffText(notebookSync.base, textarea.value);
+  const rebased = local ? rebaseOp(local, remoteOps) : null;
+  notebookSync.base = newBase;
+  notebookSync.version = version;
+
+  if (local && !rebased) {
+    // 改到了同一段：保留本地版本，下次保存时覆盖
+    notebookSync.dirty = true;
+    return;
+  }
+  const merged = rebased ? applyOps(newBase, [rebased]) : newBase;
+  if (textarea.value !== merged) {
+    const shift = rebased ? remoteOps : [diffText(textarea.value, merged)].filter(Boolean);
+    const selStart = mapIndex(textarea.selectionStart, shift);
+    const selEnd = mapIndex(textarea.selectionEnd, shift);
+    textarea.value = merged;
+    textarea.setSelectionRange(selStart, selEnd);
+  }
+  if (rebased) notebookSync.dirty = true;
+}
+
+function resetNotebookBase(text, version) {
+  const remote = diffText(notebookSync.base, text);
+  mergeRemoteNotebook(remote ? [remote] : [], version);
+}
+
+function resyncNotebook() {
+  return fetch('/api/notes', { headers: { Accept: 'application/json' } })
+    .then((r) => r.json())
+    .then((data) => resetNotebookBase(data.notebook || '', data.version || 0))
+    .catch((e) => console.error('Notebook resync failed', e));
+}
+
+function applyRemoteNotebook(payload) {
+  // 保存请求在飞时忽略：自己的回声由响应处理，别人的并发补丁会让本次保存拿到 409
+  if (notebookSync.inflight || payload.version == null) return;
+  if (payload.version <= notebookSync.version) return;
+
+  if (Array.isArray(payload.patch)) {
+    if (payload.base_version !== notebookSync.version) {
+      resyncNotebook().then(flushNotebook);
+      return;
+    }
+    mergeRemoteNotebook(payload.patch, payload.version);
+  } else {
+    resetNotebookBase(payload.content || '', payload.version);
+  }
+
+  const statusSpan = document.getElementById('status-book');
+  if (statusSpan && payload.saved_at) {
+    statusSpan.innerText = 'Saved ' + payload.saved_at;
+  }
+  flushNotebook();
+}
+
+function flushNotebook() {
+  if (notebookSync.dirty && !notebookSync.inflight) saveNotebook();
+}
+
+function saveNotebook() {
+  const textarea = document.getElementById('notebook_area');
+  if (!textarea) return;
+  if (notebookSync.inflight) {
+    notebookSync.dirty = true;
+    return;
+  }
+  notebookSync.dirty = false;
+
+  const text = textarea.value;
+  const op = diffText(notebookSync.base, text);
+  if (!op) return;
+
+  const statusSpan = document.getElementById('status-book');
   if (statusSpan) statusSpan.innerText = 'Saving...';
+  notebookSync.inflight = true;
 
   fetch('/api/notes', {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ type, content }),
+    body: JSON.stringify({ type: 'notebook', base_version: notebookSync.version, patch: [op] }),
   })
-    .then((r) => r.json())
-    .then((data) => {
+    .then(async (r) => {
+      const data = await r.json();
+      if (r.status === 409) {
+        notebookSync.inflight = false;
+        resetNotebookBase(data.notebook || '', data.version || 0);
+        notebookSync.dirty = true;
+        return;
+      }
+      if (!r.ok) throw new Error(data.message || 'Save failed');
+      notebookSync.base = text;
+      notebookSync.version = data.version;
       if (statusSpan) statusSpan.innerText = 'Saved ' + data.saved_at;
     })
     .catch(() => {
       if (statusSpan) statusSpan.innerText = 'Error!';
+    })
+    .finally(() => {
+      notebookSync.inflight = false;
+      flushNotebook();
     });
 }
 
@@ -382,14 +570,9 @@ document.addEventListener('DOMContentLoaded', () => {
   const bookInput = document.getElementById('notebook_area');
 
   if (bookInput) {
-    bookInput.addEventListener(
-      'input',
-      debounce(function () {
-        if (applyingRemoteNotebook) return;
-        if (this.value === (this.dataset.lastRemoteValue || '')) return;
-        saveNote('notebook', this.value, 'status-book');
-      }, 1000)
-    );
+    notebookSync.base = bookInput.value;
+    notebookSync.version = parseInt(bookInput.dataset.version || '0', 10);
+    bookInput.addEventListener('input', debounce(saveNotebook, 1000));
   }
 });
 
@@ -399,32 +582,58 @@ document.addEventListener('DOMContentLoaded', () => {
 // ═══════════════════════════════════════════
 
 let todoState = [];
-let applyingRemoteTodos = false;
 
-function makeTodoId() {
-  return 't' + Date.now().toString(36) + Math.floor(Math.random() * 1e4).toString(36);
+// 每条待办单独增改删（POST / PATCH / DELETE /api/todos），SSE 也只推变化的那一条。
+// 新建的待办在服务器返回真实 id 之前用 tmp- 开头的临时 id。
+function makeTempTodoId() {
+  return 'tmp-' + Date.now().toString(36) + Math.floor(Math.random() * 1e4).toString(36);
 }
 
-function saveTodos() {
-  if (applyingRemoteTodos) return;
+function normalizeTodo(t) {
+  return {
+    id: String(t.id),
+    text: String(t.text || ''),
+    done: !!t.done,
+    position: Number(t.position || 0),
+  };
+}
 
+function sortTodos() {
+  todoState.sort((a, b) => a.position - b.position || Number(a.id) - Number(b.id));
+}
+
+function setTodoStatus(text) {
   const statusSpan = document.getElementById('status-quick');
-  if (statusSpan) statusSpan.innerText = 'Saving...';
+  if (statusSpan) statusSpan.innerText = text;
+}
 
-  fetch('/api/todos', {
-    method: 'POST',
+function sendTodoRequest(method, url, body) {
+  setTodoStatus('Saving...');
+  return fetch(url, {
+    method,
     headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ todos: todoState }),
+    body: body ? JSON.stringify(body) : undefined,
   })
-    .then((r) => r.json())
-    .then((data) => {
-      if (statusSpan) statusSpan.innerText = 'Saved ' + data.saved_at;
+    .then(async (r) => {
+      const data = await r.json();
+      if (!r.ok) throw new Error(data.message || 'Request failed');
+      setTodoStatus('Saved ' + data.saved_at);
+      return data;
     })
-    .catch(() => {
-      if (statusSpan) statusSpan.innerText = 'Error!';
+    .catch((e) => {
+      setTodoStatus('Error!');
+      throw e;
     });
 }
 
+function upsertTodo(todo) {
+  const item = normalizeTodo(todo);
+  const index = todoState.findIndex((t) => t.id === item.id);
+  if (index === -1) todoState.push(item);
+  else todoState[index] = item;
+  sortTodos();
+}
+
 function renderTodos() {
   const list = document.getElementById('todo-list');
   const empty = document.getElementById('todo-empty');
@@ -473,24 +682,43 @@ function renderTodos() {
 
 function toggleTodo(id) {
   const todo = todoState.find((t) => t.id === id);
-  if (!todo) return;
+  if (!todo || id.startsWith('tmp-')) return;
   todo.done = !todo.done;
   renderTodos();
-  saveTodos();
+  sendTodoRequest('PATCH', '/api/todos/' + id, { done: todo.done })
+    .then((data) => { upsertTodo(data.todo); renderTodos(); })
+    .catch(() => { todo.done = !todo.done; renderTodos(); });
 }
 
 function deleteTodo(id) {
+  if (id.startsWith('tmp-')) return;
+  const removed = todoState.find((t) => t.id === id);
   todoState = todoState.filter((t) => t.id !== id);
   renderTodos();
-  saveTodos();
+  sendTodoRequest('DELETE', '/api/todos/' + id).catch(() => {
+    if (removed) upsertTodo(removed);
+    renderTodos();
+  });
 }
 
 function addTodo(text) {
   const trimmed = (text || '').trim();
   if (!trimmed) return;
-  todoState.push({ id: makeTodoId(), text: trimmed.slice(0, 500), done: false });
+  const tempId = makeTempTodoId();
+  const last = todoState[todoState.length - 1];
+  todoState.push({ id: tempId, text: trimmed.slice(0, 500), done: false, position: last ? last.position + 1 : 0 });
   renderTodos();
-  saveTodos();
+  sendTodoRequest('POST', '/api/todos', { text: trimmed })
+    .then((data) => {
+      // SSE 的 todo_created 可能比响应先到，这时真实 id 已经在列表里了
+      todoState = todoState.filter((t) => t.id !== tempId);
+      upsertTodo(data.todo);
+      renderTodos();
+    })
+    .catch(() => {
+      todoState = todoState.filter((t) => t.id !== tempId);
+      renderTodos();
+    });
 }
 
 function editTodo(id, labelEl) {
@@ -504,18 +732,23 @@ function editTodo(id, labelEl) {
   input.value = todo.text;
 
   const commit = () => {
-    const val = input.value.trim();
-    if (val) {
-      todo.text = val.slice(0, 500);
+    const val = input.value.trim().slice(0, 500);
+    if (!val || val === todo.text || id.startsWith('tmp-')) {
+      renderTodos();
+      return;
     }
+    const previous = todo.text;
+    todo.text = val;
     renderTodos();
-    saveTodos();
+    sendTodoRequest('PATCH', '/api/todos/' + id, { text: val })
+      .then((data) => { upsertTodo(data.todo); renderTodos(); })
+      .catch(() => { todo.text = previous; renderTodos(); });
   };
 
   input.addEventListener('blur', commit);
   input.addEventListener('keydown', (e) => {
     if (e.key === 'Enter') { e.preventDefault(); input.blur(); }
-    else if (e.key === 'Escape') { renderTodos(); }
+    else if (e.key === 'Escape') { input.removeEventListener('blur', commit); renderTodos(); }
   });
 
   labelEl.replaceWith(input);
@@ -524,18 +757,23 @@ function editTodo(id, labelEl) {
 }
 
 function applyTodosUpdate(payload) {
+  // 整表替换（旧的批量保存接口）
   if (!payload || !Array.isArray(payload.todos)) return;
-  applyingRemoteTodos = true;
-  todoState = payload.todos.map((t) => ({
-    id: String(t.id),
-    text: String(t.text || ''),
-    done: !!t.done,
-  }));
+  todoState = payload.todos.map(normalizeTodo);
+  sortTodos();
   renderTodos();
-  applyingRemoteTodos = false;
+  if (payload.saved_at) setTodoStatus('Saved ' + payload.saved_at);
+}
 
-  const statusSpan = document.getElementById('status-quick');
-  if (statusSpan && payload.saved_at) statusSpan.innerText = 'Saved ' + payload.saved_at;
+function applyTodoChange(eventName, payload) {
+  if (!payload || payload.id == null) return;
+  if (eventName === 'todo_deleted') {
+    todoState = todoState.filter((t) => t.id !== String(payload.id));
+  } else {
+    upsertTodo(payload);
+  }
+  renderTodos();
+  if (payload.saved_at) setTodoStatus('Saved ' + payload.saved_at);
 }
 
 function setupTodoList() {
@@ -544,11 +782,8 @@ function setupTodoList() {
     try {
       const parsed = JSON.parse(dataEl.textContent || '[]');
       if (Array.isArray(parsed)) {
-        todoState = parsed.map((t) => ({
-          id: String(t.id || makeTodoId()),
-          text: String(t.text || ''),
-          done: !!t.done,
-        }));
+        todoState = parsed.map(normalizeTodo);
+        sortTodos();
       }
     } catch (e) {
       console.error('Failed to parse initial todos', e);
@@ -727,17 +962,23 @@ function showLoader(el, show) {
   el.setAttribute('aria-hidden', String(!show));
 }
 
+function chartDataFrom(d) {
+  // Colors are assigned by slice index downstream, so we only need label + minutes.
+  const cats = d.labels.map((label, i) => ({ label, minutes: d.data[i] }));
+  return { categories: cats, total: d.total_minutes || cats.reduce((a, b) => a + b.minutes, 0) };
+}
+
 async function fetchChartData() { 
+  // 首屏用快照里已存的分类；还有没分类的记录时才走 /api/visualize（它会把这些重新入队）
+  const cached = takeSnapshotPart('chart');
+  if (cached && !cached.pending) return chartDataFrom(cached);
   try {
     const res = await fetch('/api/visualize', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
     });
     if (!res.ok) throw new Error('No data');
-    const d = await res.json();
-    // Colors are assigned by slice index downstream, so we only need label + minutes.
-    const cats = d.labels.map((label, i) => ({ label, minutes: d.data[i] }));
-    return { categories: cats, total: d.total_minutes || cats.reduce((a, b) => a + b.minutes, 0) };
+    return chartDataFrom(await res.json());
   } catch {
     return null;
   }
@@ -797,6 +1038,8 @@ document.addEventListener('DOMContentLoaded', async () => {
     });
   }
 
+  window.addEventListener('onyx:categories-updated', () => loadVizChart(chart, refs));
+
   // Toggle buttons
   toggles.forEach((btn) => {
     btn.addEventListener('click', () => {
@@ -849,10 +1092,16 @@ async function runNeuralAudit() {
     const response = await fetch('/api/ai/audit', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ tone: selectedTone, client_time: clientTime }),
+      body: JSON.stringify({ tone: selectedTone, client_time: clientTime, stream: true }),
     });
     if (!response.ok) throw new Error('Connection Refused');
-    const data = await response.json();
+    const data = await readAuditStream(response, (event, payload) => {
+      if (event === 'progress' && payload.phase === 'thinking') {
+        statusText.innerText = `Thinking (${payload.chars})`;
+      } else if (event === 'delta') {
+        statusText.innerText = 'Writing';
+      }
+    });
 
     const scoreEl = document.getElementById('hud-score-val');
     scoreEl.innerText = data.score;
@@ -912,6 +1161,50 @@ async function runNeuralAudit() {
 }
 
 
+// 流式审计：逐帧解析 SSE，progress/delta 交给 onFrame 更新进度，返回最终的 result。
+// 浏览器不支持 ReadableStream 时退回整体读取再解析。
+async function readAuditStream(response, onFrame) {
+  const type = response.headers.get('Content-Type') || '';
+  if (!type.startsWith('text/event-stream')) return response.json();
+
+  let result = null;
+  const handleBlock = (block) => {
+    let event = 'message';
+    let data = '';
+    block.split('\n').forEach((line) => {
+      if (line.startsWith('event: ')) event = line.slice(7);
+      else if (line.startsWith('data: ')) data += line.slice(6);
+    });
+    if (!data) return;
+    const payload = JSON.parse(data);
+    if (event === 'result') result = payload;
+    else onFrame(event, payload);
+  };
+
+  if (!response.body || !window.TextDecoder) {
+    (await response.text()).split('\n\n').forEach(handleBlock);
+  } else {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let idx;
+      while ((idx = buffer.indexOf('\n\n')) !== -1) {
+        handleBlock(buffer.slice(0, idx));
+        buffer = buffer.slice(idx + 2);
+      }
+    }
+    if (buffer.trim()) handleBlock(buffer);
+  }
+
+  if (!result) throw new Error('Audit stream ended early');
+  return result;
+}
+
+
 function renderRubric(dimensions, container) {
   const grid = document.getElementById('hud-rubric-grid');
   if (!grid) return;
@@ -1148,6 +1441,8 @@ let isPomoRunning = false;
 let currentPhase = 'WORK';
 let cycleCount = 0;
 let autosaveHandle = null;
+// 本标签页的 id：服务端推送 pomodoro_updated 时带回来，自己发起的就不再应用
+const POMO_TAB_ID = Math.random().toString(36).slice(2) + Date.now().toString(36);
 
 const _phaseDuration = (p) => PHASE_DURATIONS[p] || WORK_TIME;
 
@@ -1156,6 +1451,7 @@ const _pomoSnapshot = () => ({
   phase: currentPhase,
   cycle_count: cycleCount,
   running: isPomoRunning,
+  source: POMO_TAB_ID,
 });
 
 const _saveToBackend = () => {
@@ -1219,33 +1515,73 @@ const _updatePomoButtonToPaused = () => {
   btn.style.borderColor = 'rgba(255,255,255,0.2)';
 };
 
+const _stopPomoTicker = () => {
+  if (pomoTimer) { clearInterval(pomoTimer); pomoTimer = null; }
+};
+
+const _startPomoTicker = () => {
+  _stopPomoTicker();
+  pomoTimer = setInterval(() => {
+    if (pomoLeft > 0) {
+      pomoLeft--;
+      updatePomoDisplay();
+    } else {
+      handlePhaseComplete();
+    }
+  }, 1000);
+};
+
+const _updatePomoButtonToRunning = () => {
+  const btn = document.getElementById('pomo-btn');
+  if (!btn) return;
+  btn.innerText = currentPhase === 'WORK' ? 'PAUSE FOCUS' : 'PAUSE BREAK';
+  btn.style.borderColor = 'rgba(255,255,255,0.5)';
+};
+
+// 应用服务端状态；elapsed 是 paused_at 之后已经过去的秒数。
+// 别的设备正在计时就跟着计时，否则停在它暂停的位置
+const _applyPomodoroState = (s, elapsed) => {
+  _stopPomoTicker();
+  pomoLeft = s.remaining_seconds;
+  currentPhase = s.phase;
+  cycleCount = s.cycle_count;
+  isPomoRunning = false;
+
+  if (s.running && elapsed > 0) {
+    pomoLeft = pomoLeft - Math.floor(elapsed);
+    if (pomoLeft <= 0) _advancePhase(-pomoLeft);
+  }
+
+  _updateStatusText();
+  updateDots();
+  if (s.running) {
+    isPomoRunning = true;
+    _updatePomoButtonToRunning();
+    _startPomoTicker();
+    updatePomoDisplay();
+  } else {
+    updatePomoDisplay();
+    _updatePomoButtonToPaused();
+  }
+};
+
 const loadPomodoroState = () => {
-  fetch('/api/pomodoro')
-    .then(r => r.json())
+  const cached = takeSnapshotPart('pomodoro');
+  (cached ? Promise.resolve(cached) : fetch('/api/pomodoro').then(r => r.json()))
     .then(data => {
       if (!data.state) return;
       const s = data.state;
-      pomoLeft = s.remaining_seconds;
-      currentPhase = s.phase;
-      cycleCount = s.cycle_count;
-      isPomoRunning = false;
-
-      if (s.running && s.paused_at) {
-        const elapsed = data.server_now - s.paused_at;
-        if (elapsed > 0) {
-          pomoLeft = pomoLeft - Math.floor(elapsed);
-          if (pomoLeft <= 0) _advancePhase(-pomoLeft);
-        }
-      }
-
-      _updateStatusText();
-      updateDots();
-      updatePomoDisplay();
-      _updatePomoButtonToPaused();
+      _applyPomodoroState(s, s.paused_at ? data.server_now - s.paused_at : 0);
     })
     .catch(() => {});
 };
 
+// 其它设备开始/暂停/换阶段时服务端推过来的状态（刚发生，不用再推算时间）
+function applyRemotePomodoro(payload) {
+  if (!payload || payload.source === POMO_TAB_ID) return;
+  _applyPomodoroState(payload, 0);
+}
+
 window.addEventListener('beforeunload', () => {
   _stopAutosave();
   _saveToBackend();
@@ -1256,21 +1592,11 @@ function togglePomodoro() {
 
   if (!isPomoRunning) {
     isPomoRunning = true;
-    btn.innerText = currentPhase === 'WORK' ? 'PAUSE FOCUS' : 'PAUSE BREAK';
-    btn.style.borderColor = 'rgba(255,255,255,0.5)';
-
-    pomoTimer = setInterval(() => {
-      if (pomoLeft > 0) {
-        pomoLeft--;
-        updatePomoDisplay();
-      } else {
-        handlePhaseComplete();
-      }
-    }, 1000);
+    _updatePomoButtonToRunning();
+    _startPomoTicker();
     _saveToBackend();
   } else {
-    clearInterval(pomoTimer);
-    pomoTimer = null;
+    _stopPomoTicker();
     isPomoRunning = false;
     btn.innerText = 'RESUME';
     btn.style.borderColor = 'rgba(255,255,255,0.2)';
@@ -1280,8 +1606,7 @@ function togglePomodoro() {
 }
 
 function handlePhaseComplete() {
-  clearInterval(pomoTimer);
-  pomoTimer = null;
+  _stopPomoTicker();
   isPomoRunning = false;
 
   const btn = document.getElementById('pomo-btn');
@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 import sys
@@ -17,50 +18,72 @@ os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'test.db').rep
 os.environ['SECRET_KEY'] = 'test-secret-key'
 os.environ['REDIS_URL'] = 'redis://127.0.0.1:1/0'
 os.environ['DEEPSEEK_API_KEY'] = 'test-deepseek-key'
+os.environ['ARCHIVE_SWEEPER'] = '0'  # 测试里不起后台归档 greenlet
 
 import pytest
+import redis
 
 from app import app as flask_app
-from model import db, User, UserProfile, AlignmentSignal, TimeEntry
+from model import db, User, UserProfile, AlignmentSignal, TimeEntry, Todo
+from services.categorize import forget_user_model
 
 
 # --- Fake Redis（用于测试 SSE 发布和限流，不依赖真实 Redis） ---
 
 class FakePipeline:
+    """把调用先记下来，execute() 时按顺序在 FakeRedis 上执行并返回结果列表。
+    watch() 之后、multi() 之前的命令立即执行；execute() 时被 watch 的 key 变了就抛 WatchError。"""
+
     def __init__(self, fake_redis):
         self._redis = fake_redis
         self._ops = []
+        self._watched = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
+        self.reset()
         return False
 
-    def incr(self, key):
-        self._ops.append(('incr', key))
-        return self
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            if self._watched is not None and self._ops is None:
+                return getattr(self._redis, name)(*args, **kwargs)
+            self._ops.append((name, args, kwargs))
+            return self
+        return record
 
-    def expire(self, key, ttl, nx=False):
-        self._ops.append(('expire', key))
-        return self
+    def watch(self, *keys):
+        self._watched = {key: self._redis.snapshot(key) for key in keys}
+        self._ops = None
 
-    def execute(self):
-        results = []
-        for op, key in self._ops:
-            if op == 'incr':
-                self._redis.counters[key] = self._redis.counters.get(key, 0) + 1
-                results.append(self._redis.counters[key])
-            else:
-                results.append(True)
+    def multi(self):
         self._ops = []
-        return results
+
+    def reset(self):
+        self._ops = []
+        self._watched = None
+
+    def execute(self):
+        watched = self._watched
+        ops = self._ops or []
+        self.reset()
+        if watched and any(self._redis.snapshot(key) != value for key, value in watched.items()):
+            raise redis.WatchError('Watched variable changed.')
+        return [getattr(self._redis, name)(*args, **kwargs) for name, args, kwargs in ops]
 
 
 class FakeRedis:
     def __init__(self):
         self.published = []   # [(channel, message_json_str), ...]
         self.counters = {}
+        self.streams = {}     # key -> [(id, fields), ...]
+        self.kv = {}          # key -> (value, ttl)
+        self.lists = {}
+        self.sets = {}
+        self.hashes = {}
+        self._stream_seq = 0
 
     def publish(self, channel, message):
         self.published.append((channel, message))
@@ -69,6 +92,124 @@ class FakeRedis:
     def pipeline(self):
         return FakePipeline(self)
 
+    def snapshot(self, key):
+        """WATCH 用：key 当前的值（各种类型一起看）"""
+        return copy.deepcopy([store.get(key) for store in (self.kv, self.hashes, self.sets, self.lists)])
+
+    def incr(self, key):
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+    def expire(self, key, ttl, nx=False):
+        return True
+
+    def get(self, key):
+        item = self.kv.get(key)
+        return item[0] if item else None
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.kv:
+            return None
+        self.kv[key] = (value, ex)
+        return True
+
+    def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            for store in (self.kv, self.hashes):
+                if key in store:
+                    del store[key]
+                    removed += 1
+        return removed
+
+    def hincrby(self, key, field, amount=1):
+        h = self.hashes.setdefault(key, {})
+        h[field] = str(int(h.get(field, 0)) + amount)
+        return int(h[field])
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        h = self.hashes.setdefault(key, {})
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        added = len(set(items) - set(h))
+        h.update({k: str(v) for k, v in items.items()})
+        return added
+
+    def hsetnx(self, key, field, value):
+        h = self.hashes.setdefault(key, {})
+        if field in h:
+            return 0
+        h[field] = str(value)
+        return 1
+
+    def hdel(self, key, *fields):
+        h = self.hashes.get(key, {})
+        return sum(1 for f in fields if h.pop(f, None) is not None)
+
+    def hmget(self, key, *fields):
+        h = self.hashes.get(key, {})
+        return [h.get(f) for f in fields]
+
+    def sadd(self, key, *members):
+        members = {str(m) for m in members}
+        target = self.sets.setdefault(key, set())
+        added = len(members - target)
+        target |= members
+        return added
+
+    def srem(self, key, *members):
+        target = self.sets.setdefault(key, set())
+        removed = {str(m) for m in members} & target
+        target -= removed
+        return len(removed)
+
+    def spop(self, key, count=None):
+        target = self.sets.setdefault(key, set())
+        n = 1 if count is None else count
+        popped = [target.pop() for _ in range(min(n, len(target)))]
+        if count is None:
+            return popped[0] if popped else None
+        return popped
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(str(v) for v in values)
+        return len(self.lists[key])
+
+    def lpop(self, key, count=None):
+        items = self.lists.get(key, [])
+        n = 1 if count is None else count
+        popped, self.lists[key] = items[:n], items[n:]
+        if count is None:
+            return popped[0] if popped else None
+        return popped or None
+
+    def blpop(self, key, timeout=0):
+        value = self.lpop(key)
+        return (key, value) if value is not None else None
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        self._stream_seq += 1
+        entry_id = f'1700000000000-{self._stream_seq}'
+        entries = self.streams.setdefault(key, [])
+        entries.append((entry_id, dict(fields)))
+        if maxlen is not None:
+            del entries[:-maxlen]
+        return entry_id
+
+    def xrange(self, key, min='-', max='+', count=None):
+        def k(entry_id):
+            return tuple(int(x) for x in entry_id.split('-'))
+        entries = [e for e in self.streams.get(key, [])
+                   if min == '-' or k(e[0]) >= k(min)]
+        return entries[:count] if count else entries
+
 
 # --- Fixtures ---
 
@@ -79,6 +220,7 @@ def app():
     ctx.push()
     db.drop_all()
     db.create_all()
+    forget_user_model()  # 每个测试重建库后 id 会复用，进程内的分类模型也要清掉
     yield flask_app
     db.session.remove()
     ctx.pop()
@@ -139,7 +281,7 @@ def make_entry(user_id, desc='coding session', start='10:00', end='11:00',
 
 
 class DummyDeepSeekResponse:
-    """模拟 requests.post 返回的 DeepSeek 响应。"""
+    """模拟 DeepSeek /chat/completions 的 HTTP 响应。"""
 
     def __init__(self, content_obj):
         self._content = content_obj
@@ -149,3 +291,41 @@ class DummyDeepSeekResponse:
 
     def json(self):
         return {'choices': [{'message': {'content': json.dumps(self._content)}}]}
+
+
+class DummyDeepSeekStream:
+    """stream=true 时的 DeepSeek 响应：按 OpenAI 格式逐行吐出 data: 块。"""
+
+    def __init__(self, content_obj, reasoning='thinking...', chunk_size=8):
+        text = json.dumps(content_obj)
+        deltas = [{'reasoning_content': reasoning}] if reasoning else []
+        deltas += [{'content': text[i:i + chunk_size]} for i in range(0, len(text), chunk_size)]
+        self.lines = [f"data: {json.dumps({'choices': [{'delta': d}]})}" for d in deltas]
+        self.lines.append('data: [DONE]')
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, decode_unicode=False):
+        for line in self.lines:
+            yield line
+            yield ''
+
+    def close(self):
+        self.closed = True
+
+
+def mock_deepseek(monkeypatch, content):
+    """让共享 LLM 客户端的连接池直接返回给定内容，返回记录了每次调用参数的列表"""
+    from app import app as flask_app
+    calls = []
+
+    def fake_post(url, **kwargs):
+        calls.append((url, kwargs))
+        if kwargs.get('stream'):
+            return DummyDeepSeekStream(content)
+        return DummyDeepSeekResponse(content)
+
+    monkeypatch.setattr(flask_app.llm_client.session, 'post', fake_post)
+    return calls
@@ -2,7 +2,7 @@ import json
 from datetime import date, timedelta
 
 from conftest import (
-    TimeEntry, register, make_entry, DummyDeepSeekResponse,
+    TimeEntry, register, make_entry, mock_deepseek, DummyDeepSeekResponse,
 )
 
 AUDIT_CONTENT = {
@@ -13,15 +13,8 @@ AUDIT_CONTENT = {
 }
 
 
-def _mock_deepseek(monkeypatch, content):
-    monkeypatch.setattr(
-        'routes.ai.requests.post',
-        lambda *args, **kwargs: DummyDeepSeekResponse(content),
-    )
-
-
 def test_audit_success(auth_client, monkeypatch):
-    _mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    mock_deepseek(monkeypatch, AUDIT_CONTENT)
     resp = auth_client.post('/api/ai/audit', json={
         'tone': 'strict', 'client_time': '2026-07-16 12:00',
     })
@@ -33,7 +26,7 @@ def test_audit_success(auth_client, monkeypatch):
 
 
 def test_audit_session_cooldown_429(auth_client, monkeypatch):
-    _mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    mock_deepseek(monkeypatch, AUDIT_CONTENT)
     body = {'tone': 'strict', 'client_time': '2026-07-16 12:00'}
     assert auth_client.post('/api/ai/audit', json=body).status_code == 200
     # 15 秒冷却内的第二次调用应被拒绝
@@ -43,7 +36,7 @@ def test_audit_session_cooldown_429(auth_client, monkeypatch):
 
 def test_audit_owner_exempt_from_cooldown(client, monkeypatch):
     register(client, 'juncheng', 'password123')
-    _mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    mock_deepseek(monkeypatch, AUDIT_CONTENT)
     body = {'tone': 'strict', 'client_time': '2026-07-16 12:00'}
     assert client.post('/api/ai/audit', json=body).status_code == 200
     assert client.post('/api/ai/audit', json=body).status_code == 200
@@ -66,7 +59,7 @@ def test_visualize_assigns_categories(auth_client, monkeypatch):
                     start='10:00', end='11:00')
     e2 = make_entry(auth_client.user_id, desc='lunch',
                     start='12:00', end='12:30')
-    _mock_deepseek(monkeypatch, {f'ID_{e1.id}': 'Coding', f'ID_{e2.id}': 'Break'})
+    mock_deepseek(monkeypatch, {f'ID_{e1.id}': 'Coding', f'ID_{e2.id}': 'Break'})
 
     resp = auth_client.post('/api/visualize')
     assert resp.status_code == 200
@@ -93,3 +86,287 @@ def test_weekly_insight_with_logs(auth_client, monkeypatch):
     data = resp.get_json()
     assert 'week_label' in data
     assert 'neural_phase' in data
+
+
+def test_ai_calls_share_pooled_client(auth_client, monkeypatch):
+    calls = mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    auth_client.post('/api/ai/audit', json={'tone': 'strict', 'client_time': '2026-07-16 12:00'})
+    make_entry(auth_client.user_id, desc='write code')
+    auth_client.post('/api/visualize')
+
+    assert [url for url, _kw in calls] == ['https://api.deepseek.com/chat/completions'] * 2
+    # 连接超时固定，读超时按调用类型区分
+    assert [kw['timeout'] for _url, kw in calls] == [(5.0, 45.0), (5.0, 30)]
+
+
+def test_llm_client_records_latency_and_outcome(monkeypatch):
+    import pytest
+    import requests
+    from services import metrics
+    from services.llm_client import LLMClient
+
+    metrics.reset()
+    client = LLMClient('key', base_url='https://llm.test/')
+    adapter = client.session.get_adapter('https://llm.test/')
+    assert adapter._pool_maxsize == 64
+
+    monkeypatch.setattr(client.session, 'post',
+                        lambda url, **kw: DummyDeepSeekResponse({'ok': True}))
+    assert json.loads(client.chat({'model': 'm'}, call='audit')) == {'ok': True}
+
+    def boom(url, **kw):
+        raise requests.ConnectTimeout('slow handshake')
+    monkeypatch.setattr(client.session, 'post', boom)
+    with pytest.raises(requests.ConnectTimeout):
+        client.chat({'model': 'm'}, call='audit')
+
+    assert metrics.get('llm_requests', call='audit', outcome='ok') == 1
+    assert metrics.get('llm_requests', call='audit', outcome='error') == 1
+    assert metrics.get('llm_request_seconds_count', call='audit') == 2
+    assert metrics.get('llm_request_seconds_sum', call='audit') >= 0
+
+
+def _sse_frames(body):
+    frames = []
+    for block in body.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n'))
+        frames.append((fields['event'], json.loads(fields['data'])))
+    return frames
+
+
+def test_audit_stream_relays_chunks_then_scores(auth_client, monkeypatch):
+    calls = mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    resp = auth_client.post('/api/ai/audit', json={
+        'tone': 'strict', 'client_time': '2026-07-16 12:00', 'stream': True,
+    })
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+    frames = _sse_frames(resp.get_data(as_text=True))
+
+    assert calls[0][1]['json']['stream'] is True
+    assert frames[0] == ('progress', {'phase': 'connecting'})
+    assert frames[1] == ('progress', {'phase': 'thinking', 'chars': len('thinking...')})
+    deltas = [data['text'] for event, data in frames if event == 'delta']
+    assert json.loads(''.join(deltas)) == AUDIT_CONTENT
+    event, result = frames[-1]
+    assert event == 'result'
+    assert result['score'] == 100
+    assert result['status'] == 'green'
+
+
+def test_audit_stream_failure_ends_with_error_result(auth_client, monkeypatch):
+    from app import app as flask_app
+
+    def boom(url, **kwargs):
+        raise ConnectionError('upstream down')
+    monkeypatch.setattr(flask_app.llm_client.session, 'post', boom)
+
+    resp = auth_client.post('/api/ai/audit', json={'tone': 'strict', 'stream': True})
+    event, result = _sse_frames(resp.get_data(as_text=True))[-1]
+    assert event == 'result'
+    assert result['score'] == 0
+    assert result['insight'] == 'DeepSeek Connection Failed'
+
+
+def test_repeat_audit_served_from_cache(auth_client, fake_redis, monkeypatch):
+    from services import metrics
+    metrics.reset()
+    calls = mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    body = {'tone': 'strict', 'client_time': '2026-07-16 12:00 (Thursday)'}
+    make_entry(auth_client.user_id, desc='write code')
+
+    first = auth_client.post('/api/ai/audit', json=body).get_json()
+    assert 'cached' not in first
+    rate_counters = dict(fake_redis.counters)
+
+    # 同一小时内输入没变：15 秒冷却内也直接命中，不调模型、不计入限流
+    body['client_time'] = '2026-07-16 12:05 (Thursday)'
+    resp = auth_client.post('/api/ai/audit', json=body)
+    assert resp.status_code == 200
+    second = resp.get_json()
+    assert second['cached'] is True
+    assert second['score'] == first['score']
+    assert len(calls) == 1
+    assert fake_redis.counters == rate_counters
+    assert [ttl for _v, ttl in fake_redis.kv.values()] == [1800]
+    assert metrics.get('audit_cache', result='hit') == 1
+    assert metrics.get('audit_cache', result='miss') == 1
+
+
+def test_audit_cache_key_tracks_inputs():
+    from services.audit import audit_cache_key
+    base = dict(user_id=1, tone='strict', client_time='2026-07-16 12:00 (Thursday)',
+                logs_data=['10:00-11:00: code'], notebook='goal', quick_note='[ ] a',
+                profile_text='Rhythm')
+    key = audit_cache_key(**base)
+    assert audit_cache_key(**dict(base, client_time='2026-07-16 12:59', notebook=' goal ')) == key
+    for change in ({'tone': 'roast'}, {'client_time': '2026-07-16 13:00'},
+                   {'logs_data': ['10:00-11:30: code']}, {'quick_note': '[x] a'},
+                   {'profile_text': 'Rhythm2'}, {'user_id': 2}):
+        assert audit_cache_key(**dict(base, **change)) != key
+
+
+def test_visualize_only_sends_new_or_edited_entries(auth_client, monkeypatch):
+    from model import db
+    e1 = make_entry(auth_client.user_id, desc='write code', start='10:00', end='11:00')
+    e2 = make_entry(auth_client.user_id, desc='lunch', start='12:00', end='12:30')
+    calls = mock_deepseek(monkeypatch, {f'ID_{e1.id}': 'Coding', f'ID_{e2.id}': 'Break'})
+    auth_client.post('/api/visualize')
+    assert len(calls) == 1
+
+    # 没有变化：不再调用模型，图表直接来自已存分类
+    data = auth_client.post('/api/visualize').get_json()
+    assert len(calls) == 1
+    assert dict(zip(data['labels'], data['data'])) == {'Coding': 60, 'Break': 30}
+
+    # 新记录 + 改过 desc 的记录才会被发送
+    e3 = make_entry(auth_client.user_id, desc='gym', start='18:00', end='19:00')
+    db.session.get(TimeEntry, e2.id).desc = 'nap'
+    db.session.commit()
+    calls = mock_deepseek(monkeypatch, {f'ID_{e2.id}': 'Rest', f'ID_{e3.id}': 'Exercise'})
+    data = auth_client.post('/api/visualize').get_json()
+    prompt = calls[0][1]['json']['messages'][1]['content']
+    assert f'ID_{e1.id}:' not in prompt
+    assert f'ID_{e2.id}:' in prompt and f'ID_{e3.id}:' in prompt
+    assert dict(zip(data['labels'], data['data'])) == {'Coding': 60, 'Rest': 30, 'Exercise': 60}
+
+
+def test_visualize_keeps_legacy_categories(auth_client, monkeypatch):
+    from model import db
+    e = make_entry(auth_client.user_id, desc='write code', start='10:00', end='11:00')
+    db.session.get(TimeEntry, e.id).category = 'Coding'  # 加 categorized_desc 之前分好的
+    db.session.commit()
+    calls = mock_deepseek(monkeypatch, {})
+    data = auth_client.post('/api/visualize').get_json()
+    assert calls == []
+    assert data['labels'] == ['Coding']
+
+
+def test_audit_prompt_has_static_prefix():
+    from services.prompts import AUDIT_SYSTEM_PREFIX, get_audit_prompt
+    sys_a, user_a = get_audit_prompt('goal', '[ ] a', ['10:00-11:00: code'], tone='roast',
+                                     current_time='2026-07-16 12:00 (Thursday)')
+    sys_b, _ = get_audit_prompt('', '', ['(none)'], tone='gentle')
+    assert sys_a.startswith(AUDIT_SYSTEM_PREFIX) and sys_b.startswith(AUDIT_SYSTEM_PREFIX)
+    assert '2026-07-16' not in sys_a
+    # 每分钟都变的当前时间放在最后
+    assert user_a.rstrip().endswith('Anchor every time-based judgement to THIS time.')
+    assert user_a.index('[CURRENT TIME]') > user_a.index("[TODAY'S ACTIVITY LOGS]")
+
+
+def test_profile_section_memoized_on_updated_at(auth_client):
+    from datetime import timedelta
+    from model import db, UserProfile
+    from services import prompts
+    from routes.common import load_user_profile
+    from conftest import get_user
+
+    profile = load_user_profile(get_user('alice'))
+    first = prompts.build_profile_section(profile)
+    calls = []
+    original = prompts._render_profile_section
+    prompts_render = lambda p: calls.append(p) or original(p)
+    import pytest
+    mp = pytest.MonkeyPatch()
+    mp.setattr(prompts, '_render_profile_section', prompts_render)
+    try:
+        assert prompts.build_profile_section(profile) == first
+        assert calls == []
+        profile.primary_goal = 'ship v2'
+        profile.updated_at = profile.updated_at + timedelta(seconds=1)
+        db.session.commit()
+        assert 'ship v2' in prompts.build_profile_section(db.session.get(UserProfile, profile.id))
+        assert len(calls) == 1
+    finally:
+        mp.undo()
+
+
+def test_llm_client_records_prompt_size_and_cache_hits(monkeypatch):
+    from services import metrics
+    from services.llm_client import LLMClient
+
+    class UsageResponse(DummyDeepSeekResponse):
+        def json(self):
+            body = super().json()
+            body['usage'] = {'prompt_tokens': 1000, 'prompt_cache_hit_tokens': 900}
+            return body
+
+    metrics.reset()
+    client = LLMClient('key')
+    monkeypatch.setattr(client.session, 'post', lambda url, **kw: UsageResponse({}))
+    client.chat({'messages': [{'role': 'system', 'content': 'x' * 40},
+                              {'role': 'user', 'content': 'y' * 2}]}, call='audit')
+    assert metrics.get('llm_prompt_chars_sum', call='audit') == 42
+    assert metrics.get('llm_prompt_tokens', call='audit') == 1000
+    assert metrics.get('llm_prompt_cached_tokens', call='audit') == 900
+    assert metrics.get('llm_prompt_cache_hit_ratio_sum', call='audit') == 0.9
+
+
+def test_budget_keeps_recent_logs_and_open_todos():
+    from services.prompts import budget_audit_inputs, estimate_tokens
+
+    logs = [f'{h:02d}:00-{h:02d}:30: task number {h} ' + 'x' * 80 for h in range(24)]
+    todos = [{'text': f'done {i} ' + 'y' * 60, 'done': True} for i in range(20)]
+    todos.append({'text': 'ship the release', 'done': False})
+    notebook = '# Goals\n' + '\n\n'.join(f'Paragraph {i}. ' + 'z' * 400 for i in range(100))
+
+    nb, todo_text, kept_logs, stats = budget_audit_inputs(notebook, todos, logs, budget=1000)
+
+    assert kept_logs[-1] == logs[-1]
+    assert kept_logs[0].startswith('(earlier today:') and logs[0] not in kept_logs
+    assert todo_text.startswith('[ ] ship the release')
+    assert 'done tasks omitted' in todo_text
+    assert nb.startswith('# Goals') and 'condensed from' in nb
+    assert sum(sent for _total, sent in stats.values()) <= 1000
+    assert stats['notebook'][0] == estimate_tokens(notebook)
+
+
+def test_budget_leaves_small_inputs_alone():
+    from services.prompts import budget_audit_inputs
+
+    todos = [{'text': 'a', 'done': True}, {'text': 'b', 'done': False}]
+    nb, todo_text, logs, stats = budget_audit_inputs('goal', todos, ['10:00-11:00: code'], budget=6000)
+    assert (nb, todo_text, logs) == ('goal', '[x] a\n[ ] b', ['10:00-11:00: code'])
+    assert all(total == sent for total, sent in stats.values())
+
+
+def test_audit_trims_oversized_notebook(auth_client, monkeypatch):
+    from conftest import get_user
+    from model import db
+
+    user = get_user('alice')
+    user.notebook = 'Ship v2.\n\n' + 'filler ' * 10000
+    db.session.commit()
+    calls = mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    resp = auth_client.post('/api/ai/audit', json={'tone': 'strict', 'client_time': '2026-07-16 12:00'})
+
+    assert resp.status_code == 200
+    user_prompt = calls[0][1]['json']['messages'][1]['content']
+    assert 'Ship v2.' in user_prompt and 'condensed from' in user_prompt
+    assert len(user_prompt) < 20000
+
+
+def test_audit_keeps_newest_logs_when_rows_arrive_out_of_order(auth_client, monkeypatch):
+    from datetime import datetime
+    from app import app as flask_app
+
+    from routes.common import get_logical_date
+
+    # 较早的一半今天已归档，较新的一半还没归档（archive_date 为空）。
+    # SQLite 走 (user_id, archive_date, timestamp) 索引，空值排在前面；
+    # 不加 ORDER BY 时最新的记录就排在列表前面，会被裁掉
+    now = datetime.now()
+    today = get_logical_date(now)
+    for h in reversed(range(30)):
+        make_entry(auth_client.user_id, desc=f'task-{h:02d} ' + 'x' * 80,
+                   timestamp=now - timedelta(minutes=30 - h),
+                   archived=h < 15, archive_date=today if h < 15 else None)
+    monkeypatch.setitem(flask_app.config, 'AUDIT_TOKEN_BUDGET', 600)
+    calls = mock_deepseek(monkeypatch, AUDIT_CONTENT)
+
+    resp = auth_client.post('/api/ai/audit', json={'tone': 'strict', 'client_time': '2026-07-16 12:00'})
+    assert resp.status_code == 200
+    user_prompt = calls[0][1]['json']['messages'][1]['content']
+    # 最新的记录原样保留，最早的只出现在摘要行里
+    assert '10:00-11:00: task-29 ' in user_prompt and '10:00-11:00: task-28 ' in user_prompt
+    assert '10:00-11:00: task-00 ' not in user_prompt
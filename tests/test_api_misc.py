@@ -1,7 +1,7 @@
 import json
 from datetime import date
 
-from model import AlignmentSignal
+from model import db, AlignmentSignal
 from routes.common import _check_rate_limit
 
 from conftest import make_entry, get_user
@@ -68,6 +68,53 @@ def test_pomodoro_save_bad_payload_uses_defaults(auth_client):
     assert state['phase'] == 'WORK'
 
 
+def _pomodoro_events(fake_redis):
+    messages = [json.loads(m) for _, m in fake_redis.published]
+    return [m['data'] for m in messages if m['event'] == 'pomodoro_updated']
+
+
+def test_pomodoro_ticks_stay_in_redis(auth_client, fake_redis):
+    running = {'remaining_seconds': 1500, 'phase': 'WORK', 'cycle_count': 0,
+               'running': True, 'source': 'tab-a'}
+    auth_client.post('/api/pomodoro', json=running)
+    assert json.loads(get_user('alice').pomodoro_state)['running'] is True
+    assert len(_pomodoro_events(fake_redis)) == 1
+
+    # 计时中的 tick：热状态更新了，库里还是开始时那一份，也不推送
+    db.session.expire_all()
+    auth_client.post('/api/pomodoro', json=dict(running, remaining_seconds=1499))
+    assert json.loads(get_user('alice').pomodoro_state)['remaining_seconds'] == 1500
+    assert auth_client.get('/api/pomodoro').get_json()['state']['remaining_seconds'] == 1499
+    assert len(_pomodoro_events(fake_redis)) == 1
+
+    # 暂停是状态变化：写库并推给其它设备
+    db.session.expire_all()
+    auth_client.post('/api/pomodoro', json=dict(running, remaining_seconds=1490, running=False))
+    saved = json.loads(get_user('alice').pomodoro_state)
+    assert (saved['remaining_seconds'], saved['running']) == (1490, False)
+    event = _pomodoro_events(fake_redis)[-1]
+    assert (event['remaining_seconds'], event['running'], event['source']) == (1490, False, 'tab-a')
+
+
+def test_pomodoro_phase_change_and_reset_are_transitions(auth_client, fake_redis):
+    base = {'remaining_seconds': 3, 'phase': 'WORK', 'cycle_count': 0, 'running': True}
+    auth_client.post('/api/pomodoro', json=base)
+    auth_client.post('/api/pomodoro', json=dict(base, phase='SHORT', remaining_seconds=180, cycle_count=1))
+    # 同一阶段里剩余时间被改过（和推算值差得多）也算变化
+    auth_client.post('/api/pomodoro', json=dict(base, phase='SHORT', remaining_seconds=10, cycle_count=1))
+    events = _pomodoro_events(fake_redis)
+    assert [(e['phase'], e['remaining_seconds']) for e in events] == [('WORK', 3), ('SHORT', 180), ('SHORT', 10)]
+    db.session.expire_all()
+    assert json.loads(get_user('alice').pomodoro_state)['remaining_seconds'] == 10
+
+
+def test_pomodoro_falls_back_to_db_when_live_state_expired(auth_client, fake_redis):
+    auth_client.post('/api/pomodoro', json={'remaining_seconds': 600, 'phase': 'LONG', 'running': False})
+    fake_redis.kv.clear()
+    state = auth_client.get('/api/pomodoro').get_json()['state']
+    assert (state['remaining_seconds'], state['phase']) == (600, 'LONG')
+
+
 # --- /api/notes ---
 
 def test_save_notebook(auth_client):
@@ -85,6 +132,70 @@ def test_save_quick_note(auth_client):
     assert get_user('alice').quick_note == 'temp note'
 
 
+def test_notebook_patch_applies_and_broadcasts_only_patch(auth_client, fake_redis):
+    auth_client.post('/api/notes', json={'type': 'notebook', 'content': 'hello world'})
+    version = auth_client.get('/api/notes').get_json()['version']
+    fake_redis.published.clear()
+
+    patch = [{'pos': 6, 'del': 5, 'ins': 'there 😀'}, {'pos': 0, 'del': 0, 'ins': '> '}]
+    resp = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': version, 'patch': patch,
+    })
+    assert resp.status_code == 200
+    assert resp.get_json()['version'] == version + 1
+    assert auth_client.get('/api/notes').get_json()['notebook'] == '> hello there 😀'
+    from model import db
+    from services.note_buffer import flush_dirty
+    flush_dirty(auth_client.application)
+    db.session.expire_all()
+    assert get_user('alice').notebook == '> hello there 😀'
+
+    event = json.loads(fake_redis.published[-1][1])
+    assert event['event'] == 'notebook_updated'
+    assert event['data']['patch'] == patch
+    assert event['data']['base_version'] == version
+    assert 'content' not in event['data']
+
+
+def test_notebook_patch_positions_are_utf16(auth_client):
+    auth_client.post('/api/notes', json={'type': 'notebook', 'content': '😀b'})
+    version = auth_client.get('/api/notes').get_json()['version']
+    # JS 里 '😀'.length === 2
+    resp = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': version, 'patch': [{'pos': 2, 'del': 1, 'ins': 'c'}],
+    })
+    assert resp.status_code == 200
+    assert get_user('alice').notebook == '😀c'
+
+    resp = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': version + 1, 'patch': [{'pos': 1, 'del': 0, 'ins': 'x'}],
+    })
+    assert resp.status_code == 400
+
+
+def test_notebook_patch_stale_base_conflicts(auth_client):
+    auth_client.post('/api/notes', json={'type': 'notebook', 'content': 'v1'})
+    version = auth_client.get('/api/notes').get_json()['version']
+    auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': version, 'patch': [{'pos': 2, 'del': 0, 'ins': '!'}],
+    })
+
+    resp = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': version, 'patch': [{'pos': 0, 'del': 2, 'ins': 'v2'}],
+    })
+    assert resp.status_code == 409
+    body = resp.get_json()
+    assert body['version'] == version + 1 and body['notebook'] == 'v1!'
+    assert get_user('alice').notebook == 'v1!'
+
+
+def test_notebook_patch_rejects_out_of_range(auth_client):
+    resp = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': 0, 'patch': [{'pos': 5, 'del': 1, 'ins': ''}],
+    })
+    assert resp.status_code == 400
+
+
 # --- /history ---
 
 def test_history_day_mode_shows_archived(auth_client):
@@ -0,0 +1,226 @@
+from services import metrics
+from services.categorize import CategoryModel, normalize_desc, get_user_model
+
+from conftest import TimeEntry, make_entry, mock_deepseek
+
+
+def _labelled(user_id, desc, category, **kwargs):
+    from model import db
+    entry = make_entry(user_id, desc=desc, **kwargs)
+    entry.category = category
+    entry.categorized_desc = desc
+    db.session.commit()
+    return entry
+
+
+def test_normalize_desc():
+    assert normalize_desc('LeetCode #42 (2h)') == 'leetcode h'
+    assert normalize_desc('  Gym!! ') == 'gym'
+    assert normalize_desc('') == ''
+
+
+def test_exact_match_needs_repeated_agreement():
+    model = CategoryModel()
+    model.learn('Gym', 'Exercise')
+    assert model.classify('gym') is None        # 只见过一次，不够有把握
+    model.learn('gym!', 'Exercise')
+    assert model.classify('GYM') == ('Exercise', 1.0)
+
+
+def test_ngram_vote_and_ambiguity():
+    model = CategoryModel()
+    for desc in ('leetcode easy', 'leetcode medium', 'leetcode hard'):
+        model.learn(desc, 'Coding')
+    assert model.classify('leetcode contest')[0] == 'Coding'
+
+    model.learn('review notes', 'Study')
+    model.learn('review code', 'Coding')
+    model.learn('review pr', 'Coding')
+    assert model.classify('review slides') is None  # review 两边都有，不够确定
+
+
+def test_user_model_learns_incrementally(auth_client):
+    uid = auth_client.user_id
+    _labelled(uid, 'gym', 'Exercise')
+    model = get_user_model(uid)
+    assert model.classify('gym') is None
+    _labelled(uid, 'gym', 'Exercise')
+    assert get_user_model(uid) is model         # 同一个对象，只补学新行
+    assert model.classify('gym') == ('Exercise', 1.0)
+
+
+
+def test_user_model_follows_late_labels_and_relabels(auth_client):
+    from model import db
+    uid = auth_client.user_id
+    early = make_entry(uid, desc='gym')            # 先建、后打标签的低 id 行
+    _labelled(uid, 'gym', 'Exercise')
+    model = get_user_model(uid)
+    assert model.exact['gym'] == {'Exercise': 1}
+
+    early.category, early.categorized_desc = 'Exercise', 'gym'
+    db.session.commit()
+    assert get_user_model(uid).exact['gym'] == {'Exercise': 2}
+
+    early.category = 'Health'                      # 改分类：旧的一票换成新的，不叠加
+    db.session.commit()
+    get_user_model(uid)
+    assert model.exact['gym'] == {'Exercise': 1, 'Health': 1}
+    get_user_model(uid)                            # 重叠窗口里再读到同一行也不重复算
+    assert model.exact['gym'] == {'Exercise': 1, 'Health': 1}
+
+
+def test_concurrent_catch_up_learns_each_row_once(auth_client, app):
+    import threading
+    uid = auth_client.user_id
+    model = get_user_model(uid)
+    for _ in range(3):
+        _labelled(uid, 'gym', 'Exercise')
+
+    def catch_up():
+        with app.app_context():
+            get_user_model(uid)
+
+    threads = [threading.Thread(target=catch_up) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert model.exact['gym'] == {'Exercise': 3}
+
+
+def test_visualize_uses_local_classifier_first(auth_client, monkeypatch):
+    metrics.reset()
+    uid = auth_client.user_id
+    for _ in range(2):
+        _labelled(uid, 'gym', 'Exercise', archived=True)
+    known = make_entry(uid, desc='Gym', start='18:00', end='19:00')
+    novel = make_entry(uid, desc='piano practice', start='20:00', end='20:30')
+    calls = mock_deepseek(monkeypatch, {f'ID_{novel.id}': 'Music'})
+
+    data = auth_client.post('/api/visualize').get_json()
+    prompt = calls[0][1]['json']['messages'][1]['content']
+    assert f'ID_{novel.id}:' in prompt
+    assert f'ID_{known.id}:' not in prompt
+    assert dict(zip(data['labels'], data['data'])) == {'Exercise': 60, 'Music': 30}
+    assert metrics.get('category_classifier', result='local') == 1
+    assert metrics.get('category_classifier', result='llm') == 1
+
+    from model import db
+    assert db.session.get(TimeEntry, known.id).categorized_desc == 'Gym'
+
+
+def test_visualize_counts_entries_not_yet_backfilled(auth_client):
+    from model import db
+    uid = auth_client.user_id
+    _labelled(uid, 'write code', 'Coding', start='10:00', end='11:00')
+    legacy_id = _labelled(uid, 'read', 'Study', start='12:00', end='12:45').id
+    # 加列之前的老数据，还没跑 backfill-entry-minutes
+    db.session.execute(TimeEntry.__table__.update().where(TimeEntry.id == legacy_id).values(
+        start_minute=None, end_minute=None, duration_minutes=None))
+    db.session.commit()
+    db.session.expire_all()
+
+    data = auth_client.post('/api/visualize').get_json()
+    assert dict(zip(data['labels'], data['data'])) == {'Coding': 60, 'Study': 45}
+    assert data['total_minutes'] == auth_client.get('/api/dashboard').get_json()['stats']['total_minutes'] == 105
+
+
+def test_single_llm_label_is_learned_once(auth_client, app, monkeypatch):
+    from services.categorize import categorize_entries
+    uid = auth_client.user_id
+    model = get_user_model(uid)                 # 模型先建好，LLM 的结果只能靠按 labelled_at 补学
+    entry = make_entry(uid, desc='piano practice', start='20:00', end='20:30')
+    mock_deepseek(monkeypatch, {f'ID_{entry.id}': 'Music'})
+    categorize_entries(uid, [entry], app.llm_client)
+
+    assert get_user_model(uid) is model
+    assert model.exact['piano practice'] == {'Music': 1}
+    assert model.classify('piano practice') is None
+
+
+def test_local_guesses_are_not_learned_back(auth_client):
+    from services.categorize import classify_locally
+    from model import db
+    uid = auth_client.user_id
+    for _ in range(2):
+        _labelled(uid, 'gym', 'Exercise', archived=True)
+    guessed = make_entry(uid, desc='gym', start='18:00', end='19:00')
+    assert classify_locally(uid, [guessed]) == []
+    db.session.commit()
+    assert guessed.category_source == 'local'
+
+    assert get_user_model(uid).exact['gym'] == {'Exercise': 2}
+
+# --- 写入时分类队列 ---
+
+def test_new_entry_is_queued_once(auth_client, fake_redis):
+    from services.categorize_queue import QUEUE_KEY, PENDING_TTL_SECONDS, enqueue_entries, pending_key
+    auth_client.post('/', data={'desc': 'gym', 'start_time': '18:00', 'end_time': '19:00'})
+    entry_id = TimeEntry.query.filter_by(user_id=auth_client.user_id).one().id
+    assert fake_redis.lists[QUEUE_KEY] == [str(entry_id)]
+
+    # 图表接口只读：发现未分类记录只会重新入队（已在队列里的不重复），不调用模型
+    data = auth_client.post('/api/visualize').get_json()
+    assert data['pending'] == 1
+    assert data['labels'] == ['Uncategorized']
+    assert fake_redis.lists[QUEUE_KEY] == [str(entry_id)]
+    assert enqueue_entries(fake_redis, [entry_id]) == 0
+    assert fake_redis.kv[pending_key(entry_id)] == (1, PENDING_TTL_SECONDS)
+
+
+def test_worker_categorizes_and_publishes(app, auth_client, fake_redis, monkeypatch):
+    import json
+    from model import db
+    from services.categorize_queue import pending_key, run_categorize_worker
+
+    for desc in ('write code', 'lunch'):
+        auth_client.post('/', data={'desc': desc, 'start_time': '10:00', 'end_time': '11:00'})
+    e1, e2 = TimeEntry.query.filter_by(user_id=auth_client.user_id).order_by(TimeEntry.id).all()
+    calls = mock_deepseek(monkeypatch, {f'ID_{e1.id}': 'Coding', f'ID_{e2.id}': 'Break'})
+
+    assert run_categorize_worker(app, batch_size=10, concurrency=2, poll_timeout=0, drain=True) == 1
+    assert len(calls) == 1  # 同一用户的两条合成一次调用
+
+    db.session.expire_all()
+    assert db.session.get(TimeEntry, e1.id).category == 'Coding'
+    assert db.session.get(TimeEntry, e2.id).category == 'Break'
+    assert pending_key(e1.id) not in fake_redis.kv and pending_key(e2.id) not in fake_redis.kv
+
+    event = json.loads(fake_redis.published[-1][1])
+    assert event['event'] == 'entries_categorized'
+    assert sorted(e['category'] for e in event['data']['entries']) == ['Break', 'Coding']
+
+    data = auth_client.post('/api/visualize').get_json()
+    assert data['pending'] == 0
+    assert sorted(data['labels']) == ['Break', 'Coding']
+
+
+def test_worker_failure_releases_ids(app, auth_client, fake_redis, monkeypatch):
+    from services.categorize_queue import pending_key, run_categorize_worker
+    metrics.reset()
+
+    def boom(url, **kwargs):
+        raise ConnectionError('upstream down')
+    monkeypatch.setattr(app.llm_client.session, 'post', boom)
+
+    auth_client.post('/', data={'desc': 'piano', 'start_time': '10:00', 'end_time': '11:00'})
+    run_categorize_worker(app, poll_timeout=0, drain=True)
+    assert metrics.get('categorize_jobs', outcome='error') == 1
+    # pending 标记已删，下次打开图表会重新入队
+    assert not [key for key in fake_redis.kv if key.startswith('categorize:pending:')]
+    assert auth_client.post('/api/visualize').get_json()['pending'] == 1
+
+
+def test_failed_push_releases_pending_marker(fake_redis):
+    from services.categorize_queue import QUEUE_KEY, enqueue_entries, pending_key
+
+    def broken_rpush(key, *values):
+        raise ConnectionError('redis went away')
+    fake_redis.rpush = broken_rpush
+    assert enqueue_entries(fake_redis, [7]) == 0
+    assert pending_key(7) not in fake_redis.kv
+
+    del fake_redis.rpush
+    assert enqueue_entries(fake_redis, [7]) == 1
+    assert fake_redis.lists[QUEUE_KEY] == ['7']
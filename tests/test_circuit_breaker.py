@@ -0,0 +1,161 @@
+import pytest
+
+from services import metrics
+from services.circuit_breaker import (
+    CircuitBreaker, CircuitOpenError, PERMIT_CLOSED, PERMIT_PROBE,
+)
+
+from conftest import DummyDeepSeekStream, FakeRedis, mock_deepseek
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('services.circuit_breaker.time.time', clock)
+    return clock
+
+
+def _breaker(redis_client, **kwargs):
+    options = dict(failure_ratio=0.5, min_calls=4, window_seconds=60,
+                   open_seconds=30, slow_call_seconds=10)
+    options.update(kwargs)
+    return CircuitBreaker('test', lambda: redis_client, **options)
+
+
+def test_opens_when_failure_ratio_reached(clock):
+    metrics.reset()
+    breaker = _breaker(FakeRedis())
+    for ok in (True, False, True):
+        breaker.record(breaker.allow(), ok, 0.1)
+    assert breaker.allow() == PERMIT_CLOSED      # 3 次调用还不够 min_calls
+
+    breaker.record(PERMIT_CLOSED, False, 0.1)    # 2/4 失败 -> 跳闸
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    assert metrics.get('llm_circuit_open', breaker='test') == 1
+    assert metrics.get('llm_circuit_trips', breaker='test') == 1
+    assert metrics.get('llm_circuit_rejected', breaker='test') == 1
+
+
+def test_slow_calls_count_as_failures(clock):
+    breaker = _breaker(FakeRedis(), min_calls=2)
+    breaker.record(PERMIT_CLOSED, True, 11)
+    breaker.record(PERMIT_CLOSED, True, 12)
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_old_failures_leave_the_window(clock):
+    breaker = _breaker(FakeRedis(), min_calls=2)
+    breaker.record(PERMIT_CLOSED, False, 0.1)
+    clock.now += 120
+    breaker.record(PERMIT_CLOSED, False, 0.1)
+    assert breaker.allow() == PERMIT_CLOSED
+
+
+def test_half_open_probe_closes_on_success(clock):
+    metrics.reset()
+    breaker = _breaker(FakeRedis(), min_calls=1)
+    breaker.record(PERMIT_CLOSED, False, 0.1)
+    clock.now += 31
+
+    assert breaker.allow() == PERMIT_PROBE
+    with pytest.raises(CircuitOpenError):        # 只放行一个探测请求（跨 worker 共享）
+        breaker.allow()
+    breaker.record(PERMIT_PROBE, True, 0.1)
+
+    assert breaker.allow() == PERMIT_CLOSED
+    assert metrics.get('llm_circuit_open', breaker='test') == 0
+
+
+def test_half_open_probe_failure_reopens(clock):
+    breaker = _breaker(FakeRedis(), min_calls=1)
+    breaker.record(PERMIT_CLOSED, False, 0.1)
+    clock.now += 31
+    breaker.record(breaker.allow(), False, 0.1)
+    clock.now += 10
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    clock.now += 25
+    assert breaker.allow() == PERMIT_PROBE
+
+
+def test_without_redis_breaker_is_inert():
+    breaker = _breaker(None, min_calls=1)
+    breaker.record(PERMIT_CLOSED, False, 0.1)
+    assert breaker.allow() == PERMIT_CLOSED
+
+
+def test_audit_fails_fast_while_open(app, auth_client, fake_redis, monkeypatch):
+    calls = mock_deepseek(monkeypatch, {})
+    fake_redis.set('breaker:deepseek:open', repr(9e18))
+    resp = auth_client.post('/api/ai/audit', json={'tone': 'strict', 'client_time': '2026-07-16 12:00'})
+    data = resp.get_json()
+    assert calls == []
+    assert data['score'] == 0
+    assert data['status'] == 'red'
+    assert 'circuit open' in data['warning']
+
+
+class _RecordingBreaker:
+    def __init__(self):
+        self.records = []
+
+    def allow(self):
+        return PERMIT_CLOSED
+
+    def record(self, permit, ok, elapsed):
+        self.records.append((ok, elapsed))
+
+    def release(self, permit):
+        pass
+
+
+def test_stream_is_timed_to_first_chunk(monkeypatch):
+    from services.llm_client import LLMClient
+    now = [0.0]
+    monkeypatch.setattr('services.llm_client.time.perf_counter', lambda: now[0])
+
+    stream = DummyDeepSeekStream({'score': 80}, reasoning=None)
+    lines = stream.lines
+
+    def slow_lines(decode_unicode=False):
+        now[0] += 1                               # 首块 1 秒到
+        for line in lines:
+            yield line
+            now[0] += 30                          # 之后是很长的回答
+    stream.iter_lines = slow_lines
+
+    breaker = _RecordingBreaker()
+    client = LLMClient('key', breaker=breaker)
+    monkeypatch.setattr(client.session, 'post', lambda url, **kwargs: stream)
+    assert ''.join(text for _kind, text in client.chat_stream({'messages': []})) == '{"score": 80}'
+    assert breaker.records == [(True, 1.0)]
+
+
+def test_client_errors_do_not_count_against_upstream(monkeypatch):
+    import requests
+    from services.llm_client import LLMClient
+
+    class Rejected:
+        def __init__(self, status):
+            self.status_code = status
+
+        def raise_for_status(self):
+            raise requests.HTTPError(f'{self.status_code}', response=self)
+
+    breaker = _RecordingBreaker()
+    client = LLMClient('key', breaker=breaker)
+    for status in (400, 429, 503):
+        monkeypatch.setattr(client.session, 'post', lambda url, status=status, **kwargs: Rejected(status))
+        with pytest.raises(requests.HTTPError):
+            client.chat({'messages': []})
+    assert [ok for ok, _elapsed in breaker.records] == [True, False, False]
@@ -1,9 +1,11 @@
 from datetime import datetime, timedelta
 
-from model import db
+from sqlalchemy import event
+
+from model import db, AlignmentSignal
 from routes.common import get_logical_date
 
-from conftest import TimeEntry, register, get_user, make_entry
+from conftest import TimeEntry, Todo, register, get_user, make_entry
 
 AJAX = {'X-Requested-With': 'XMLHttpRequest'}
 
@@ -78,8 +80,8 @@ def test_delete_nonexistent_entry_404(auth_client):
 def test_end_day_archives_and_clears_todos(auth_client):
     make_entry(auth_client.user_id)
     make_entry(auth_client.user_id, desc='second')
+    auth_client.post('/api/todos', json={'text': 'task'})
     user = get_user('alice')
-    user.todos = '[{"id":"1","text":"task","done":false}]'
     user.quick_note = 'note'
     db.session.commit()
 
@@ -90,20 +92,83 @@ def test_end_day_archives_and_clears_todos(auth_client):
     assert all(e.is_archived for e in entries)
     assert all(e.archive_date == get_logical_date(datetime.now()) for e in entries)
     user = get_user('alice')
-    assert user.todos == '[]'
+    assert Todo.query.filter_by(user_id=auth_client.user_id).count() == 0
     assert user.quick_note == ''
 
 
-def test_homepage_auto_archives_stale_entries(auth_client):
+def test_homepage_get_does_not_archive(auth_client):
+    # 归档改由 sweep 统一完成，首页 GET 只读
     stale_ts = datetime.now() - timedelta(days=2)
     entry = make_entry(auth_client.user_id, timestamp=stale_ts)
 
     auth_client.get('/')
 
-    entry = db.session.get(TimeEntry, entry.id)
-    assert entry.is_archived is True
-    assert entry.archive_date == get_logical_date(stale_ts)
+    assert db.session.get(TimeEntry, entry.id).is_archived is False
+
+
+def test_archive_sweep_archives_stale_entries(auth_client, app):
+    stale_ts = datetime.now() - timedelta(days=2)
+    stale = make_entry(auth_client.user_id, timestamp=stale_ts)
+    other_user = make_entry(auth_client.user_id + 1, timestamp=stale_ts)
+    fresh = make_entry(auth_client.user_id)
+    ids = (stale.id, other_user.id, fresh.id)
+
+    result = app.test_cli_runner().invoke(args=['archive-sweep'])
+    assert result.exit_code == 0
+    assert 'Archived 2 entries' in result.output
+
+    stale, other_user, fresh = (db.session.get(TimeEntry, i) for i in ids)
+    assert stale.is_archived is True
+    assert stale.archive_date == get_logical_date(stale_ts)
+    assert other_user.is_archived is True
+    assert fresh.is_archived is False
+
+
+def test_archive_derives_logical_date_in_sql(app):
+    from services.archive import archive_stale_entries
+    before_six = datetime.now().replace(hour=5, minute=0) - timedelta(days=1)
+    entry = make_entry(1, timestamp=before_six)
+    assert archive_stale_entries(user_id=1) == 1
+    db.session.commit()
+    # 凌晨 5 点的记录属于再前一天
+    assert db.session.get(TimeEntry, entry.id).archive_date == (before_six - timedelta(days=1)).date()
+
+
+def test_end_day_files_leftovers_under_their_own_day(auth_client):
+    stale_ts = datetime.now() - timedelta(days=3)
+    stale = make_entry(auth_client.user_id, timestamp=stale_ts)
+    auth_client.post('/end_day')
+    assert db.session.get(TimeEntry, stale.id).archive_date == get_logical_date(stale_ts)
+
+
 
+def test_end_day_archives_in_one_transaction(auth_client, monkeypatch):
+    import pytest
+    import routes.main as main_routes
+    stale = make_entry(auth_client.user_id, timestamp=datetime.now() - timedelta(days=3)).id
+
+    def fail(user_id):
+        raise RuntimeError('boom')
+    monkeypatch.setattr(main_routes, 'clear_todos', fail)
+    with pytest.raises(RuntimeError):
+        auth_client.post('/end_day')
+    db.session.rollback()
+    # 跨天遗留的归档没有在半路单独提交
+    assert db.session.get(TimeEntry, stale).is_archived is False
+
+
+def test_archive_sweeper_starts_on_first_request_only(client, app, monkeypatch):
+    import app as app_module
+    spawned = []
+    monkeypatch.setattr(app_module.gevent, 'spawn', lambda func, *args: spawned.append(func))
+    monkeypatch.setattr(app_module, '_archive_sweeper_started', False)
+    monkeypatch.setitem(app.config, 'ARCHIVE_SWEEPER', True)
+
+    app.test_cli_runner().invoke(args=['archive-sweep'])   # CLI 命令不起 greenlet
+    assert spawned == []
+    client.get('/login')
+    client.get('/login')
+    assert spawned == [app_module.run_archive_sweeper]
 
 def test_archived_entry_not_on_homepage(auth_client):
     make_entry(auth_client.user_id, desc='archived-marker-abc',
@@ -115,3 +180,77 @@ def test_archived_entry_not_on_homepage(auth_client):
 def test_streak_set_after_first_visit(auth_client):
     auth_client.get('/')
     assert get_user('alice').streak == 1
+
+
+def test_minute_columns_filled_on_write(auth_client):
+    _create(auth_client, start='23:30', end='01:00')
+    entry = TimeEntry.query.filter_by(user_id=auth_client.user_id).first()
+    assert (entry.start_minute, entry.end_minute, entry.duration_minutes) == (1410, 60, 90)
+
+    entry.end_time = '23:45'
+    db.session.commit()
+    assert db.session.get(TimeEntry, entry.id).duration_minutes == 15
+
+
+def test_backfill_entry_minutes_command(app):
+    entry_id = make_entry(1, start='10:00', end='11:15').id
+    # 模拟加列之前写入的老数据
+    db.session.execute(TimeEntry.__table__.update().values(
+        start_minute=None, end_minute=None, duration_minutes=None))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['backfill-entry-minutes', '--batch-size', '1'])
+    assert result.exit_code == 0
+    assert '1 entries backfilled' in result.output
+    assert db.session.get(TimeEntry, entry_id).duration_minutes == 75
+
+
+def test_dashboard_snapshot_contents(auth_client):
+    make_entry(auth_client.user_id, desc='write code', start='10:00', end='11:30')
+    auth_client.post('/api/todos', json={'text': 'task'})
+    auth_client.post('/api/pomodoro', json={'remaining_seconds': 600, 'phase': 'SHORT'})
+
+    data = auth_client.get('/api/dashboard').get_json()
+    assert [e['desc'] for e in data['entries']] == ['write code']
+    assert data['stats'] == {'total_minutes': 90, 'total_hours': 1.5, 'deep_hours': 1.5}
+    assert data['chart']['total_minutes'] == 90 and data['chart']['pending'] == 1
+    assert [t['text'] for t in data['todos']] == ['task']
+    assert data['streak'] == 1
+    assert data['pomodoro']['state']['remaining_seconds'] == 600
+
+
+
+def test_dashboard_chart_counts_entries_not_yet_backfilled(auth_client):
+    make_entry(auth_client.user_id, desc='write code', start='10:00', end='11:00')
+    legacy_id = make_entry(auth_client.user_id, desc='read', start='12:00', end='12:45').id
+    # 加列之前的老数据，还没跑 backfill-entry-minutes
+    db.session.execute(TimeEntry.__table__.update().where(TimeEntry.id == legacy_id).values(
+        start_minute=None, end_minute=None, duration_minutes=None))
+    db.session.commit()
+    db.session.expire_all()
+
+    data = auth_client.get('/api/dashboard').get_json()
+    assert data['stats']['total_minutes'] == 105
+    assert data['chart']['total_minutes'] == 105
+
+def test_dashboard_snapshot_query_count(auth_client):
+    for i in range(20):
+        make_entry(auth_client.user_id, desc=f'entry {i}')
+    db.session.add(AlignmentSignal(user_id=auth_client.user_id, input_context='x', ai_response='y', reward_score=5))
+    db.session.commit()
+    auth_client.post('/api/todos', json={'text': 'task'})
+    auth_client.get('/')   # 当天的 streak 提交、profile 创建都在第一次打开时完成
+    db.session.expire_all()
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        resp = auth_client.get('/api/dashboard')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    assert resp.status_code == 200
+    assert resp.get_json()['rlhf_count'] == 1
+    # load_user、记录、profile+反馈计数、待办、番茄钟状态列；记录条数多少都一样
+    assert len(statements) == 5, statements
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from conftest import TimeEntry, register, make_entry, mock_deepseek
+from test_ai import AUDIT_CONTENT
+
+AUDIT_BODY = {'tone': 'strict', 'client_time': '2026-07-16 12:00', 'async': True}
+
+
+def test_async_audit_returns_job_then_result(app, auth_client, fake_redis, monkeypatch):
+    mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    resp = auth_client.post('/api/ai/audit', json=AUDIT_BODY)
+    assert resp.status_code == 202
+    job = resp.get_json()
+    assert job['status'] == 'queued'
+    assert job['kind'] == 'audit'
+
+    app.job_runner.join(timeout=5)
+    data = auth_client.get(f"/api/jobs/{job['id']}").get_json()
+    assert data['status'] == 'done'
+    assert data['result']['score'] == 100
+    assert data['result']['status'] == 'green'
+
+    event = json.loads(fake_redis.published[-1][1])
+    assert event['event'] == 'job_finished'
+    assert event['data']['id'] == job['id']
+    assert event['data']['result']['score'] == 100
+
+
+def test_job_is_private_to_its_owner(app, client, monkeypatch):
+    mock_deepseek(monkeypatch, AUDIT_CONTENT)
+    register(client, 'alice', 'password123')
+    job_id = client.post('/api/ai/audit', json=AUDIT_BODY).get_json()['id']
+    app.job_runner.join(timeout=5)
+    client.get('/logout')
+
+    register(client, 'bob', 'password123')
+    assert client.get(f'/api/jobs/{job_id}').status_code == 404
+    assert client.get('/api/jobs/does-not-exist').status_code == 404
+
+
+def test_async_audit_upstream_failure_without_redis(app, auth_client, monkeypatch):
+    def boom(url, **kwargs):
+        raise ConnectionError('upstream down')
+    monkeypatch.setattr(app.llm_client.session, 'post', boom)
+
+    job_id = auth_client.post('/api/ai/audit', json=AUDIT_BODY).get_json()['id']
+    app.job_runner.join(timeout=5)
+    data = auth_client.get(f'/api/jobs/{job_id}').get_json()
+    assert data['status'] == 'done'
+    assert data['result']['insight'] == 'DeepSeek Connection Failed'
+
+
+def test_async_visualize_categorizes_in_background(app, auth_client, monkeypatch):
+    from model import db
+    e = make_entry(auth_client.user_id, desc='write code', start='10:00', end='11:00')
+    mock_deepseek(monkeypatch, {f'ID_{e.id}': 'Coding'})
+
+    resp = auth_client.post('/api/visualize', json={'async': True})
+    assert resp.status_code == 202
+    app.job_runner.join(timeout=5)
+
+    data = auth_client.get(f"/api/jobs/{resp.get_json()['id']}").get_json()
+    assert data['result']['labels'] == ['Coding']
+    db.session.expire_all()
+    assert db.session.get(TimeEntry, e.id).category == 'Coding'
+
+
+def test_job_queue_rejects_when_full(app):
+    from services.jobs import JobRunner, JobQueueFull
+    runner = JobRunner(app, concurrency=1, max_queued=1)
+    runner.submit(1, 'audit', lambda: None)
+    with pytest.raises(JobQueueFull):
+        runner.submit(1, 'audit', lambda: None)
+    runner.join(timeout=5)
+
+
+def test_local_job_records_expire_and_are_capped(app, monkeypatch):
+    from services import jobs
+    monkeypatch.setattr(app, 'redis_client', None)
+    clock = [1000.0]
+    monkeypatch.setattr(jobs.time, 'monotonic', lambda: clock[0])
+    runner = jobs.JobRunner(app, ttl_seconds=60, max_local=2)
+
+    for job_id in ('a', 'b', 'c'):
+        runner._save({'id': job_id, 'status': jobs.JOB_DONE})
+    assert runner.get('a') is None          # 超过 max_local，最早的先丢
+    assert runner.get('c')['status'] == jobs.JOB_DONE
+
+    clock[0] += 61
+    assert runner.get('c') is None          # 和 Redis 一样按 TTL 过期
+    runner._save({'id': 'd', 'status': jobs.JOB_QUEUED})
+    assert list(runner._local) == ['d']
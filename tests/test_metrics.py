@@ -0,0 +1,130 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from gevent.queue import Queue
+
+from routes.common import _check_rate_limit
+from routes.sse import iter_stream_frames
+from services import metrics
+
+
+def test_metrics_endpoint_exposes_request_histograms(auth_client):
+    metrics.reset()
+    auth_client.get('/api/stats')
+
+    resp = auth_client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/plain'
+    body = resp.get_data(as_text=True)
+    assert '# TYPE onyx_http_request_seconds histogram' in body
+    labels = 'blueprint="data",endpoint="data.get_stats"'
+    assert f'onyx_http_request_seconds_bucket{{{labels},le="+Inf"}} 1' in body
+    # 空桶也要有
+    assert f'onyx_http_request_seconds_bucket{{{labels},le="0.005"}}' in body
+    assert f'onyx_http_request_seconds_count{{{labels}}} 1' in body
+
+
+def test_metrics_endpoint_access(app, client, monkeypatch):
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code == 404
+    # 经 Nginx 转发的外部请求 remote_addr 也是 127.0.0.1
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.9'}).status_code == 404
+
+    # Docker 里宿主机的抓取来自网桥网关：可以把网段加进白名单
+    monkeypatch.setitem(app.config, 'METRICS_ALLOW_CIDRS', '127.0.0.1/32, 172.16.0.0/12')
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '172.18.0.1'}).status_code == 200
+
+    # 或者用 token，来源不限
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 's3cret')
+    remote = {'REMOTE_ADDR': '203.0.113.9'}
+    assert client.get('/metrics', environ_base=remote,
+                      headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+    assert client.get('/metrics', environ_base=remote,
+                      headers={'Authorization': 'Bearer wrong'}).status_code == 404
+
+
+def test_collect_merges_workers(tmp_path):
+    metrics.reset()
+    metrics.inc('llm_requests', 2, call='audit', outcome='ok')
+    metrics.set_gauge('sse_connected_streams', 3)
+    metrics.set_gauge('llm_circuit_open', 1, breaker='deepseek')
+
+    def worker_file(pid, requests, streams, circuit):
+        return {
+            'pid': pid,
+            'counters': [['llm_requests', [['call', 'audit'], ['outcome', 'ok']], requests]],
+            'gauges': [['sse_connected_streams', [], streams],
+                       ['llm_circuit_open', [['breaker', 'deepseek']], circuit]],
+            'kinds': {'llm_requests': 'counter', 'sse_connected_streams': 'gauge',
+                      'llm_circuit_open': 'gauge'},
+        }
+
+    # 另一个活着的 worker（用父进程的 pid）和一个已经退出的 worker
+    (tmp_path / 'other.json').write_text(json.dumps(worker_file(os.getppid(), 5, 4, 1)))
+    (tmp_path / 'dead.json').write_text(json.dumps(worker_file(2 ** 22 + 1, 7, 9, 0)))
+
+    counters, gauges, kinds = metrics.collect(str(tmp_path))
+    assert counters[('llm_requests', (('call', 'audit'), ('outcome', 'ok')))] == 2 + 5 + 7
+    # gauge 只算活着的 worker；连接数相加，熔断状态取最大
+    assert gauges[('sse_connected_streams', ())] == 3 + 4
+    assert gauges[('llm_circuit_open', (('breaker', 'deepseek'),))] == 1
+    assert len(list(tmp_path.glob(f'{os.getpid()}-*.json'))) == 1
+
+
+def test_counters_never_go_down_when_workers_go_away(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    key = ('sse_broker_reconnects', ())
+    metrics.reset()
+    metrics.inc('sse_broker_reconnects')
+
+    def worker_file(name, pid, reconnects, streams):
+        path = tmp_path / name
+        path.write_text(json.dumps({'pid': pid, 'counters': [['sse_broker_reconnects', [], reconnects]],
+                                    'gauges': [['sse_connected_streams', [], streams]], 'kinds': {}}))
+        return path
+
+    # 活着但 dumper 卡住了的 worker（文件很旧）：计数照算，gauge 不算，文件不动
+    starved = worker_file(f'{os.getppid()}-aaaaaaaa.json', os.getppid(), 7, 5)
+    old = time.time() - 60
+    os.utime(starved, (old, old))
+    # 被 kill -9 的 worker：pid 已经不在
+    killed = worker_file('4194305-bbbbbbbb.json', 2 ** 22 + 1, 4, 9)
+
+    totals = []
+    counters, gauges, _kinds = metrics.collect(directory, max_age_seconds=15)
+    totals.append(counters[key])
+    assert ('sse_connected_streams', ()) not in gauges
+    assert starved.exists() and not killed.exists()
+    assert (tmp_path / metrics.ARCHIVE_FILE).exists()
+
+    totals.append(metrics.collect(directory, max_age_seconds=15)[0][key])
+
+    # 本进程正常退出：计数并入 archive，自己的文件删掉，之后不再写
+    monkeypatch.setattr(metrics, '_retired', False)
+    metrics.retire_dump(directory)
+    assert not list(tmp_path.glob(f'{os.getpid()}-*.json'))
+    totals.append(metrics.collect(directory, max_age_seconds=15)[0][key])
+
+    assert totals == [1 + 7 + 4] * 3
+
+
+def test_rate_limit_rejections_counted(app, fake_redis):
+    metrics.reset()
+    for _ in range(5):
+        _check_rate_limit(1)
+    assert metrics.get('audit_rate_limited', window='minute') == 2
+
+
+def test_sse_delivery_latency_from_sent_at():
+    metrics.reset()
+    queue = Queue()
+    sent_at = (datetime.utcnow() - timedelta(seconds=0.2)).isoformat() + 'Z'
+    queue.put({'event': 'entry_deleted', 'data': {'id': 3}, 'sent_at': sent_at})
+    frames = iter_stream_frames(queue, heartbeat_seconds=5)
+    assert next(frames).startswith('event: entry_deleted\n')
+
+    assert metrics.get('sse_delivery_seconds_count', event='entry_deleted') == 1
+    assert 0.2 <= metrics.get('sse_delivery_seconds_sum', event='entry_deleted') < 5
+    assert metrics.get('sse_delivery_seconds_bucket', event='entry_deleted', le='0.1') == 0
+    assert metrics.get('sse_delivery_seconds_bucket', event='entry_deleted', le='0.25') == 1
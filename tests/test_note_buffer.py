@@ -0,0 +1,169 @@
+import json
+import os
+import subprocess
+import sys
+
+from model import db
+from services.note_buffer import DIRTY_KEY, buffer_key, flush_dirty
+
+from conftest import get_user
+
+
+def _db_row(username='alice'):
+    db.session.expire_all()
+    return get_user(username)
+
+
+_OTHER_WORKER = """
+import json, sys
+from app import app                      # 全新的 app、会话和 flusher
+from conftest import FakeRedis
+from services.note_buffer import flush_dirty
+
+state = json.load(sys.stdin)
+redis_client = FakeRedis()
+redis_client.hashes = state['hashes']
+redis_client.sets = {key: set(members) for key, members in state['sets'].items()}
+app.redis_client = redis_client
+print(flush_dirty(app))
+"""
+
+
+def _flush_in_other_process(app, fake_redis):
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ,
+               DATABASE_URL=app.config['SQLALCHEMY_DATABASE_URI'],
+               PYTHONPATH=os.pathsep.join([os.path.dirname(tests_dir), tests_dir]))
+    redis_state = {'hashes': fake_redis.hashes,
+                   'sets': {key: sorted(members) for key, members in fake_redis.sets.items()}}
+    result = subprocess.run([sys.executable, '-c', _OTHER_WORKER], input=json.dumps(redis_state),
+                            env=env, cwd=os.path.dirname(tests_dir), capture_output=True, text=True,
+                            timeout=120)
+    assert result.returncode == 0, result.stderr
+    return int(result.stdout.strip().splitlines()[-1])
+
+
+def test_saves_are_buffered_until_flush(auth_client, fake_redis):
+    auth_client.post('/api/notes', json={'type': 'notebook', 'content': 'draft 1'})
+    auth_client.post('/api/notes', json={'type': 'notebook', 'content': 'draft 2'})
+
+    # 数据库还没写，但读接口和页面已经看到最新值
+    assert _db_row().notebook == ''
+    assert auth_client.get('/api/notes').get_json() == {'notebook': 'draft 2', 'version': 2}
+    assert 'draft 2' in auth_client.get('/').get_data(as_text=True)
+    auth_client.post('/api/notes', json={'type': 'quick_note', 'content': 'scratch'})
+    assert fake_redis.sets[DIRTY_KEY] == {str(auth_client.user_id)}
+
+    assert flush_dirty(auth_client.application) == 1
+    row = _db_row()
+    assert (row.notebook, row.notebook_version, row.quick_note) == ('draft 2', 2, 'scratch')
+    assert not fake_redis.sets[DIRTY_KEY]
+    assert flush_dirty(auth_client.application) == 0
+
+
+def test_acknowledged_saves_survive_worker_crash(auth_client, fake_redis):
+    """worker 在两次刷盘之间挂掉：缓冲在 Redis 里，下一轮任何 worker 的 flusher 都能写回"""
+    acked = []
+    for i in range(5):
+        resp = auth_client.post('/api/notes', json={'type': 'notebook', 'content': f'line {i}'})
+        assert resp.status_code == 200
+        acked.append(f'line {i}')
+    version = auth_client.get('/api/notes').get_json()['version']
+    resp = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': version, 'patch': [{'pos': 6, 'del': 0, 'ins': '!'}],
+    })
+    assert resp.status_code == 200
+
+    # 模拟崩溃：另起一个进程当作别的 worker，它和这里共享的只有 Redis 里的数据和数据库文件
+    db.session.remove()
+    assert _flush_in_other_process(auth_client.application, fake_redis) == 1
+
+    row = _db_row()
+    assert row.notebook == 'line 4!'
+    assert row.notebook_version == version + 1
+
+
+def test_flush_failure_keeps_users_dirty(auth_client, fake_redis, monkeypatch):
+    auth_client.post('/api/notes', json={'type': 'quick_note', 'content': 'a'})
+
+    def broken_commit():
+        raise RuntimeError('db down')
+    with monkeypatch.context() as m:
+        m.setattr(db.session, 'commit', broken_commit)
+        try:
+            flush_dirty(auth_client.application)
+        except RuntimeError:
+            pass
+    assert fake_redis.sets[DIRTY_KEY] == {str(auth_client.user_id)}
+
+    assert flush_dirty(auth_client.application) == 1
+    assert _db_row().quick_note == 'a'
+
+
+def test_patch_conflicts_use_buffered_version(auth_client, fake_redis):
+    auth_client.post('/api/notes', json={'type': 'notebook', 'content': 'abc'})
+    ok = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': 1, 'patch': [{'pos': 3, 'del': 0, 'ins': 'd'}],
+    })
+    stale = auth_client.post('/api/notes', json={
+        'type': 'notebook', 'base_version': 1, 'patch': [{'pos': 0, 'del': 1, 'ins': 'A'}],
+    })
+    assert ok.status_code == 200 and ok.get_json()['version'] == 2
+    assert stale.status_code == 409
+    assert stale.get_json() == {
+        'status': 'conflict', 'message': 'Notebook changed since base_version',
+        'version': 2, 'notebook': 'abcd',
+    }
+
+
+
+def test_losing_patch_leaves_version_alone(auth_client, fake_redis, monkeypatch):
+    """两个补丁基于同一版本并发：输的那个不能把版本号再加一，否则别的标签页会被误判冲突"""
+    import services.note_buffer as note_buffer
+    user = get_user('alice')
+    note_buffer.save_fields(fake_redis, user, notebook='abc')
+    real_apply = note_buffer.apply_patch
+
+    def racing_apply(text, patch):
+        # 这个补丁算完、写回之前，另一个请求抢先提交了同一 base 的补丁
+        monkeypatch.setattr(note_buffer, 'apply_patch', real_apply)
+        assert note_buffer.patch_notebook(fake_redis, user, 1, [{'pos': 3, 'del': 0, 'ins': 'd'}])[0]
+        return real_apply(text, patch)
+    monkeypatch.setattr(note_buffer, 'apply_patch', racing_apply)
+
+    ok, version, notebook = note_buffer.patch_notebook(fake_redis, user, 1, [{'pos': 0, 'del': 1, 'ins': 'A'}])
+    assert (ok, version, notebook) == (False, 2, 'abcd')
+    assert fake_redis.hmget(buffer_key(user.id), 'notebook', 'notebook_version') == ['abcd', '2']
+
+
+def test_notebook_write_retries_when_buffer_changes(auth_client, fake_redis, monkeypatch):
+    import services.note_buffer as note_buffer
+    user = get_user('alice')
+    note_buffer.save_fields(fake_redis, user, notebook='abc')
+    real_hget = fake_redis.hget
+    interleaved = []
+
+    def hget(key, field):
+        # WATCH 之后、EXEC 之前另一个请求存了速记：事务作废，重读后再写
+        if not interleaved:
+            interleaved.append(True)
+            note_buffer.save_fields(fake_redis, user, quick_note='scratch')
+        return real_hget(key, field)
+    monkeypatch.setattr(fake_redis, 'hget', hget)
+
+    assert note_buffer.patch_notebook(fake_redis, user, 1, [{'pos': 3, 'del': 0, 'ins': 'd'}]) == (True, 2, None)
+    assert fake_redis.hmget(buffer_key(user.id), 'notebook', 'notebook_version', 'quick_note') == \
+        ['abcd', '2', 'scratch']
+
+def test_end_day_clears_buffered_quick_note(auth_client, fake_redis):
+    auth_client.post('/api/notes', json={'type': 'quick_note', 'content': 'a'})
+    auth_client.post('/end_day')
+    assert fake_redis.hgetall(buffer_key(auth_client.user_id))['quick_note'] == ''
+    flush_dirty(auth_client.application)
+    assert _db_row().quick_note == ''
+
+
+def test_without_redis_saves_write_through(auth_client):
+    auth_client.post('/api/notes', json={'type': 'notebook', 'content': 'direct'})
+    row = _db_row()
+    assert (row.notebook, row.notebook_version) == ('direct', 1)
@@ -0,0 +1,85 @@
+import logging
+import re
+
+import pytest
+import redis
+from flask import g
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from model import db
+
+from services import metrics
+from services.request_timing import RequestTiming, TimedRedis, record
+
+
+def test_server_timing_header_counts_queries(auth_client):
+    header = auth_client.get('/api/dashboard').headers['Server-Timing']
+    queries = re.match(r'db;dur=[\d.]+;desc="(\d+) queries"', header)
+    assert queries and int(queries.group(1)) > 0
+    assert 'redis;dur=' in header and 'total;dur=' in header
+    # 没有 LLM 调用时不出现 llm 段
+    assert 'llm;' not in header
+
+
+def test_access_log_line(auth_client, app, caplog):
+    caplog.set_level(logging.INFO, logger=app.logger.name)
+    auth_client.get('/api/stats')
+    lines = [r.getMessage() for r in caplog.records if r.getMessage().startswith('access ')]
+    assert len(lines) == 1
+    line = lines[0]
+    assert 'method=GET path=/api/stats endpoint=data.get_stats status=200' in line
+    assert f'user_id={auth_client.user_id}' in line
+    assert 'db_queries=' in line and 'redis_calls=0' in line and 'llm_calls=0' in line
+
+
+def test_repeated_statement_flags_n_plus_one(auth_client, app, caplog, monkeypatch):
+    caplog.set_level(logging.INFO, logger=app.logger.name)
+    metrics.reset()
+    monkeypatch.setitem(app.config, 'N_PLUS_ONE_THRESHOLD', 0)
+    auth_client.get('/api/stats')
+    assert not [r for r in caplog.records if 'Possible N+1' in r.getMessage()]
+
+    # /history 这类页面如果在循环里懒加载，同一条 SELECT 会重复很多次；这里用低阈值模拟
+    monkeypatch.setitem(app.config, 'N_PLUS_ONE_THRESHOLD', 1)
+    auth_client.get('/api/stats')
+    warnings = [r.getMessage() for r in caplog.records if 'Possible N+1' in r.getMessage()]
+    assert len(warnings) == 1
+    assert 'endpoint=data.get_stats' in warnings[0] and 'statement=SELECT' in warnings[0]
+    assert metrics.get('http_n_plus_one', endpoint='data.get_stats') == 1
+
+
+def test_timed_redis_reports_commands_and_pipelines(app, monkeypatch):
+    monkeypatch.setattr(redis.Redis, 'execute_command', lambda self, *args, **options: 'PONG')
+    monkeypatch.setattr(redis.client.Pipeline, 'execute', lambda self, raise_on_error=True: [1, 2])
+    client = TimedRedis()
+
+    with app.test_request_context('/'):
+        g.request_timing = RequestTiming()
+        client.ping()
+        with client.pipeline() as pipe:
+            pipe.incr('a')
+            pipe.incr('b')
+            pipe.execute()
+        record('llm', 0.25)
+        timing = g.request_timing
+
+    assert timing.redis_calls == 2
+    assert (timing.llm_calls, timing.llm_seconds) == (1, 0.25)
+    assert 'llm;dur=250.0;desc="1 calls"' in timing.server_timing()
+
+    # 请求之外（后台 greenlet）不记
+    assert client.ping() == 'PONG'
+
+
+def test_failed_statement_is_counted_once(app):
+    with app.test_request_context('/'):
+        g.request_timing = RequestTiming()
+        with pytest.raises(OperationalError):
+            db.session.execute(text('SELECT * FROM no_such_table'))
+        db.session.rollback()
+        db.session.execute(text('SELECT 1'))
+        timing = g.request_timing
+
+    assert timing.statements == {'SELECT * FROM no_such_table': 1, 'SELECT 1': 1}
+    assert timing.db_queries == 2
@@ -0,0 +1,89 @@
+from datetime import date, datetime
+
+from model import db, DailyRollup
+from services.rollup import rebuild_rollups
+
+from conftest import TimeEntry, make_entry, mock_deepseek
+
+DAY = date(2026, 7, 14)
+
+
+def _rollups(user_id):
+    rows = DailyRollup.query.filter_by(user_id=user_id).all()
+    return {(r.logical_date, r.category): (r.total_minutes, r.deep_minutes, r.entry_count)
+            for r in rows}
+
+
+def test_create_and_delete_update_rollup(app):
+    a = make_entry(1, desc='coding', start='10:00', end='11:00', archive_date=DAY)
+    make_entry(1, desc='lunch', start='12:00', end='12:30', archive_date=DAY)
+    assert _rollups(1) == {(DAY, 'Uncategorized'): (90, 60, 2)}
+
+    db.session.delete(a)
+    db.session.commit()
+    assert _rollups(1) == {(DAY, 'Uncategorized'): (30, 0, 1)}
+
+
+def test_last_delete_removes_row(app):
+    e = make_entry(1, archive_date=DAY)
+    db.session.delete(e)
+    db.session.commit()
+    assert _rollups(1) == {}
+
+
+def test_recategorize_moves_minutes(app):
+    e = make_entry(1, desc='coding', start='10:00', end='11:00', archive_date=DAY)
+    e.category = 'Deep Work'
+    db.session.commit()
+    assert _rollups(1) == {(DAY, 'Deep Work'): (60, 60, 1)}
+
+
+def test_rollup_rolls_back_with_entry(app):
+    db.session.add(TimeEntry(desc='x', start_time='10:00', end_time='11:00',
+                             user_id=1, archive_date=DAY))
+    db.session.flush()
+    db.session.rollback()
+    assert _rollups(1) == {}
+
+
+def test_null_archive_date_uses_logical_date_of_timestamp(app):
+    make_entry(1, desc='gym', timestamp=datetime(2026, 7, 15, 2, 0))  # 凌晨两点算前一天
+    assert _rollups(1) == {(DAY, 'Uncategorized'): (60, 0, 1)}
+
+
+def test_rebuild_matches_incremental(app):
+    make_entry(1, desc='coding', start='10:00', end='11:00', archive_date=DAY)
+    make_entry(1, desc='gym', start='18:00', end='19:00', archive_date=DAY)
+    make_entry(2, desc='study', start='09:00', end='09:45', archive_date=DAY)
+    expected = {1: _rollups(1), 2: _rollups(2)}
+
+    db.session.execute(DailyRollup.__table__.delete())
+    db.session.commit()
+    assert rebuild_rollups(user_id=1) == 1
+    assert _rollups(1) == expected[1]
+    assert _rollups(2) == {}
+
+    result = app.test_cli_runner().invoke(args=['rebuild-rollups'])
+    assert result.exit_code == 0
+    assert _rollups(2) == expected[2]
+
+
+def test_visualize_recategorization_updates_rollup(auth_client, monkeypatch):
+    e = make_entry(auth_client.user_id, desc='write code', start='10:00', end='11:00')
+    mock_deepseek(monkeypatch, {f'ID_{e.id}': 'Coding'})
+    auth_client.post('/api/visualize')
+    rows = _rollups(auth_client.user_id)
+    assert list(rows.values()) == [(60, 60, 1)]
+    assert [cat for _day, cat in rows] == ['Coding']
+
+
+def test_history_stats_come_from_rollups(auth_client):
+    make_entry(auth_client.user_id, desc='rollup-marker', start='10:00', end='12:00',
+               archived=True, archive_date=date.today())
+    # 只改汇总表，页面上的统计应随之变化，证明读的是汇总而不是逐条重算
+    row = DailyRollup.query.filter_by(user_id=auth_client.user_id).one()
+    row.total_minutes = 600
+    db.session.commit()
+    html = auth_client.get('/history').get_data(as_text=True)
+    assert 'rollup-marker' in html
+    assert '10.0h' in html
@@ -0,0 +1,61 @@
+from sqlalchemy import text as sa_text
+
+from model import db
+
+from conftest import TimeEntry
+
+HOT_INDEXES = {'ix_expenses_user_archived_ts', 'ix_expenses_user_archive_date_ts'}
+
+
+def _index_names():
+    return {ix['name'] for ix in db.inspect(db.engine).get_indexes(TimeEntry.__tablename__)}
+
+
+def test_create_all_builds_entry_indexes(app):
+    assert HOT_INDEXES <= _index_names()
+
+
+def test_ensure_indexes_backfills_missing_index(app):
+    # 模拟没有这些索引的老库：create_all 不会再补，只能靠启动时的 ensure_indexes
+    with db.engine.begin() as conn:
+        conn.execute(sa_text('DROP INDEX ix_expenses_user_archived_ts'))
+    assert 'ix_expenses_user_archived_ts' not in _index_names()
+
+    from app import ensure_indexes
+    ensure_indexes()
+    ensure_indexes()  # 幂等：重复执行不报错
+    assert HOT_INDEXES <= _index_names()
+
+
+def test_active_entry_query_uses_index(app):
+    sql = str(TimeEntry.query.filter_by(user_id=1, is_archived=False)
+              .order_by(TimeEntry.timestamp.desc())
+              .statement.compile(compile_kwargs={'literal_binds': True}))
+    with db.engine.connect() as conn:
+        plan = ' '.join(str(row[-1]) for row in conn.execute(sa_text('EXPLAIN QUERY PLAN ' + sql)))
+    assert 'ix_expenses_user_archived_ts' in plan
+
+
+def test_load_user_skips_large_text_columns(app):
+    from sqlalchemy import event
+    from model import User
+    from app import load_user
+
+    with app.app_context():
+        db.session.add(User(id=1, username='big', password='x', notebook='n' * 100000))
+        db.session.commit()
+        db.session.expunge_all()
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            user = load_user('1')
+            assert user.username == 'big'
+            assert len(statements) == 1
+            assert 'user.notebook AS' not in statements[0] and 'pomodoro_state' not in statements[0]
+
+            assert len(user.notebook) == 100000  # 访问时才加载
+            assert len(statements) == 2 and 'todos' not in statements[1]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
@@ -67,3 +67,218 @@ def test_sse_stream_degrades_without_redis(auth_client):
     assert resp.status_code == 200
     assert resp.mimetype == 'text/event-stream'
     assert 'redis_unavailable' in resp.get_data(as_text=True)
+
+
+# --- 每进程一个订阅的 SSE broker ---
+
+def _broker():
+    from services.sse_broker import SSEBroker
+    return SSEBroker(None, 'onyx:user', queue_size=2)
+
+
+def test_broker_fans_out_to_all_streams_of_user():
+    broker = _broker()
+    q1, q2 = broker.subscribe(42), broker.subscribe(42)
+    other = broker.subscribe(7)
+
+    broker.dispatch('onyx:user:42', json.dumps({'event': 'entry_deleted', 'data': {'id': 1}}))
+
+    assert q1.get_nowait() == {'event': 'entry_deleted', 'data': {'id': 1}}
+    assert q2.get_nowait()['data'] == {'id': 1}
+    assert other.empty()
+
+
+def test_broker_bookkeeping_and_metrics():
+    from services import metrics
+    broker = _broker()
+    q1, q2 = broker.subscribe(1), broker.subscribe(2)
+    assert broker.stats() == {'streams': 2, 'users': 2, 'running': False}
+    assert metrics.get('sse_connected_streams') == 2
+
+    broker.unsubscribe(1, q1)
+    broker.unsubscribe(2, q2)
+    assert broker.stats()['streams'] == 0
+    assert metrics.get('sse_connected_users') == 0
+    # 没有订阅者的消息直接丢弃，不报错
+    broker.dispatch('onyx:user:1', '{}')
+
+
+def test_broker_closes_stream_when_queue_full():
+    from services import metrics
+    from services.sse_broker import OVERFLOW
+    from routes.sse import iter_stream_frames
+    broker = _broker()
+    q = broker.subscribe(1)
+    kept = broker.subscribe(2)
+    before = metrics.get('sse_messages_dropped')
+    for i in range(3):
+        broker.dispatch('onyx:user:1', json.dumps({'event': 'entry_deleted', 'data': {'id': i}}))
+    broker.dispatch('onyx:user:2', json.dumps({'event': 'entry_deleted', 'data': {'id': 9}}))
+
+    # 不是丢一条留两条：整条流让出去，客户端重连后从 Redis Stream 补齐
+    assert q.qsize() == 1 and q.peek() is OVERFLOW
+    assert metrics.get('sse_messages_dropped') == before + 3
+    assert broker.stats()['streams'] == 1 and kept.qsize() == 1
+    assert list(iter_stream_frames(q, heartbeat_seconds=5)) == []
+
+
+def test_broker_subscribe_waits_for_confirmation():
+    import gevent
+    import time
+    from services.sse_broker import SSEBroker
+
+    class FakePubSub:
+        def psubscribe(self, pattern):
+            self.pattern = pattern
+
+        def get_message(self, timeout=None):
+            gevent.sleep(0.05)
+            return {'type': 'psubscribe', 'channel': self.pattern, 'data': 1}
+
+        def listen(self):
+            gevent.sleep(60)
+            yield from ()
+
+        def close(self):
+            pass
+
+    class FakeClient:
+        def pubsub(self):
+            return FakePubSub()
+
+    broker = SSEBroker(FakeClient(), 'onyx:user')
+    t0 = time.monotonic()
+    broker.subscribe(1)
+    try:
+        assert time.monotonic() - t0 >= 0.04
+        assert broker.running and broker._ready.is_set()
+    finally:
+        broker._greenlet.kill()
+
+
+def test_broker_consumes_pattern_messages():
+    class FakePubSub:
+        def listen(self):
+            yield {'type': 'psubscribe', 'channel': 'onyx:user:*', 'data': 1}
+            yield {'type': 'pmessage', 'channel': 'onyx:user:5',
+                   'data': json.dumps({'event': 'todos_updated', 'data': {}})}
+
+    broker = _broker()
+    q = broker.subscribe(5)
+    broker._consume(FakePubSub())
+    assert q.get_nowait()['event'] == 'todos_updated'
+
+
+def test_sse_stream_delivers_broker_messages(auth_client, fake_redis, monkeypatch):
+    import gevent
+    from app import app as flask_app
+
+    broker = _broker()
+    monkeypatch.setattr(flask_app, 'sse_broker', broker)
+
+    def publish_when_connected():
+        while broker.stats()['streams'] == 0:
+            gevent.sleep(0.01)
+        broker.dispatch(f'onyx:user:{auth_client.user_id}',
+                        json.dumps({'event': 'entry_deleted', 'data': {'id': 9}}))
+
+    publisher = gevent.spawn(publish_when_connected)
+    resp = auth_client.get('/api/events', buffered=False)
+    chunks = iter(resp.response)
+    first = next(chunks)
+    publisher.join()
+    assert (first.decode() if isinstance(first, bytes) else first) == \
+        'event: entry_deleted\ndata: {"id": 9}\n\n'
+    resp.close()
+    assert broker.stats()['streams'] == 0
+
+
+def test_stream_frames_heartbeat_comes_from_timer():
+    import time
+    from gevent.queue import Queue
+    from routes.sse import iter_stream_frames
+
+    queue = Queue()
+    frames = iter_stream_frames(queue, heartbeat_seconds=0.05)
+    t0 = time.monotonic()
+    assert next(frames).startswith('event: heartbeat\n')
+    assert time.monotonic() - t0 >= 0.04
+
+    queue.put({'event': 'entry_deleted', 'data': {'id': 3}})
+    queue.put({'event': 'not_a_real_event', 'data': {}})
+    assert next(frames) == 'event: entry_deleted\ndata: {"id": 3}\n\n'
+    # 未知事件被忽略，下一帧是心跳
+    assert next(frames).startswith('event: heartbeat\n')
+
+
+# --- Last-Event-ID 断线续传 ---
+
+def _publish_n(n, user_id=42):
+    for i in range(n):
+        publish_user_event(user_id, 'entry_deleted', {'id': i})
+
+
+def test_publish_appends_to_replay_stream(app, fake_redis):
+    _publish_n(2)
+    entries = fake_redis.streams['onyx:user:42:stream']
+    assert [json.loads(f['data']) for _id, f in entries] == [{'id': 0}, {'id': 1}]
+    # 广播出去的消息带着 Stream id，SSE 帧里会写成 id: 字段
+    published = json.loads(fake_redis.published[-1][1])
+    assert published['id'] == entries[-1][0]
+
+
+def test_format_sse_with_event_id():
+    assert format_sse('entry_deleted', {'id': 1}, event_id='5-0') == \
+        'id: 5-0\nevent: entry_deleted\ndata: {"id": 1}\n\n'
+
+
+def test_replay_returns_events_after_last_id(app, fake_redis):
+    from routes.sse import replay_missed_events
+    _publish_n(3)
+    ids = [entry_id for entry_id, _f in fake_redis.streams['onyx:user:42:stream']]
+
+    frames, last = replay_missed_events(fake_redis, 42, ids[0])
+    assert frames == [format_sse('entry_deleted', {'id': 1}, event_id=ids[1]),
+                      format_sse('entry_deleted', {'id': 2}, event_id=ids[2])]
+    assert last == ids[2]
+
+
+def test_replay_asks_for_resync_when_history_trimmed(app, fake_redis):
+    from routes.sse import replay_missed_events
+    app.config['SSE_REPLAY_MAXLEN'] = 2
+    try:
+        _publish_n(4)
+    finally:
+        app.config['SSE_REPLAY_MAXLEN'] = 200
+    frames, last = replay_missed_events(fake_redis, 42, '1700000000000-1')
+    assert last is None
+    assert frames[0].startswith('event: resync\n')
+
+
+def test_sse_stream_resumes_from_last_event_id(auth_client, fake_redis, monkeypatch):
+    import gevent
+    from app import app as flask_app
+
+    broker = _broker()
+    monkeypatch.setattr(flask_app, 'sse_broker', broker)
+    _publish_n(3, user_id=auth_client.user_id)
+    ids = [entry_id for entry_id, _f in
+           fake_redis.streams[f'onyx:user:{auth_client.user_id}:stream']]
+    channel = f'onyx:user:{auth_client.user_id}'
+
+    def publish_when_connected():
+        while broker.stats()['streams'] == 0:
+            gevent.sleep(0.01)
+        # 订阅后回放前到达的重复事件应被去重，只有新事件会再发一次
+        broker.dispatch(channel, json.dumps({'event': 'entry_deleted', 'data': {'id': 2}, 'id': ids[2]}))
+        broker.dispatch(channel, json.dumps({'event': 'entry_deleted', 'data': {'id': 3}, 'id': '1700000000000-99'}))
+
+    publisher = gevent.spawn(publish_when_connected)
+    resp = auth_client.get('/api/events', headers={'Last-Event-ID': ids[0]}, buffered=False)
+    chunks = iter(resp.response)
+    frames = [next(chunks) for _ in range(3)]
+    publisher.join()
+    resp.close()
+
+    frames = [f.decode() if isinstance(f, bytes) else f for f in frames]
+    assert [f.split('\n')[0] for f in frames] == [f'id: {ids[1]}', f'id: {ids[2]}', 'id: 1700000000000-99']
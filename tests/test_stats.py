@@ -1,6 +1,6 @@
 from types import SimpleNamespace
 
-from services.stats import calculate_duration, calculate_stats_from_logs
+from services.stats import calculate_duration, calculate_stats_from_logs, parse_clock_minutes
 from services.history_helper import calculate_duration_minutes, build_day_stats
 
 
@@ -84,3 +84,20 @@ def test_build_day_stats_empty():
     assert stats['focus_pct'] == 0
     assert stats['top_category'] == '—'
     assert stats['entry_count'] == 0
+
+
+# --- 整数分钟列 ---
+
+def test_parse_clock_minutes():
+    assert parse_clock_minutes('00:00') == 0
+    assert parse_clock_minutes('10:30') == 630
+    assert parse_clock_minutes('23:59:59') == 1439
+    assert parse_clock_minutes('garbage') is None
+    assert parse_clock_minutes(None) is None
+
+
+def test_stats_prefer_stored_duration():
+    log = _log('coding', 'bad', 'time')
+    log.duration_minutes = 90  # 已写入整数列时不再解析字符串
+    assert calculate_stats_from_logs([log]) == (1.5, 1.5)
+    assert build_day_stats([log])['total_minutes'] == 90
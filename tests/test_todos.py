@@ -5,7 +5,9 @@ from routes.common import (
     sanitize_todos, load_todos, migrate_quick_note_to_todos, todos_to_text,
 )
 
-from conftest import get_user
+from model import db
+
+from conftest import Todo, get_user
 
 
 # --- sanitize_todos ---
@@ -113,10 +115,119 @@ def test_save_todos_persists_and_sanitizes(auth_client):
     assert data['status'] == 'success'
     assert [t['text'] for t in data['todos']] == ['valid']
 
-    user = get_user('alice')
-    assert json.loads(user.todos) == data['todos']
+    assert auth_client.get('/api/todos').get_json()['todos'] == data['todos']
+    assert data['todos'][0]['id'] == Todo.query.one().id
 
 
 def test_save_todos_requires_login(client):
     resp = client.post('/api/todos', json={'todos': []})
     assert resp.status_code == 302
+
+
+# --- item-level /api/todos ---
+
+def test_todo_item_lifecycle(auth_client):
+    first = auth_client.post('/api/todos', json={'text': '  buy milk '})
+    second = auth_client.post('/api/todos', json={'text': 'write code'})
+    assert first.status_code == 201
+    a, b = first.get_json()['todo'], second.get_json()['todo']
+    assert (a['text'], a['done'], a['position']) == ('buy milk', False, 0)
+    assert b['position'] == 1
+
+    resp = auth_client.patch(f"/api/todos/{a['id']}", json={'done': True})
+    assert resp.get_json()['todo'] == dict(a, done=True)
+
+    resp = auth_client.patch(f"/api/todos/{b['id']}", json={'text': 'review PR'})
+    assert resp.get_json()['todo']['text'] == 'review PR'
+
+    assert auth_client.delete(f"/api/todos/{a['id']}").status_code == 200
+    assert [t['text'] for t in auth_client.get('/api/todos').get_json()['todos']] == ['review PR']
+
+
+def test_todo_item_validation_and_ownership(auth_client, client):
+    assert auth_client.post('/api/todos', json={'text': '   '}).status_code == 400
+    todo_id = auth_client.post('/api/todos', json={'text': 'mine'}).get_json()['todo']['id']
+    assert auth_client.patch(f'/api/todos/{todo_id}', json={}).status_code == 400
+    assert auth_client.patch(f'/api/todos/{todo_id}', json={'text': ''}).status_code == 400
+    assert auth_client.patch('/api/todos/9999', json={'done': True}).status_code == 404
+
+    auth_client.get('/logout')
+    from conftest import register
+    register(client, 'bob')
+    assert client.patch(f'/api/todos/{todo_id}', json={'done': True}).status_code == 404
+    assert client.delete(f'/api/todos/{todo_id}').status_code == 404
+    assert db.session.get(Todo, todo_id).done is False
+
+
+
+def test_add_computes_position_and_limit_in_one_insert(auth_client):
+    from sqlalchemy import event
+
+    for i in range(199):
+        db.session.add(Todo(user_id=auth_client.user_id, text=f'task {i}', position=i))
+    db.session.commit()
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        resp = auth_client.post('/api/todos', json={'text': 'last one'})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    assert resp.get_json()['todo']['position'] == 199
+    # 没有先单独 SELECT count / max 再 INSERT 的窗口
+    todo_sql = [s for s in statements if 'todo' in s.lower().split('from user')[0]]
+    assert len(todo_sql) == 1 and todo_sql[0].startswith('INSERT INTO todo')
+    assert 'HAVING count(todo.id) <' in todo_sql[0]
+
+    resp = auth_client.post('/api/todos', json={'text': 'one too many'})
+    assert resp.status_code == 400
+    assert Todo.query.filter_by(user_id=auth_client.user_id).count() == 200
+
+
+def test_toggle_is_one_update_of_one_row(auth_client):
+    from sqlalchemy import event
+
+    for i in range(200):
+        db.session.add(Todo(user_id=auth_client.user_id, text=f'task {i}', position=i))
+    db.session.commit()
+    target = Todo.query.filter_by(position=150).one().id
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        resp = auth_client.patch(f'/api/todos/{target}', json={'done': True})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    assert resp.status_code == 200
+    todo_sql = [s for s in statements if 'todo' in s.lower().split('from user')[0]]
+    assert len(todo_sql) == 1 and todo_sql[0].startswith('UPDATE todo SET done')
+
+
+def test_todo_events_carry_only_the_item(auth_client, fake_redis):
+    created = auth_client.post('/api/todos', json={'text': 'a'}).get_json()['todo']
+    auth_client.patch(f"/api/todos/{created['id']}", json={'done': True})
+    auth_client.delete(f"/api/todos/{created['id']}")
+
+    events = [json.loads(message) for _channel, message in fake_redis.published]
+    assert [e['event'] for e in events] == ['todo_created', 'todo_updated', 'todo_deleted']
+    assert events[1]['data']['done'] is True and events[1]['data']['id'] == created['id']
+    assert set(events[2]['data']) == {'id', 'saved_at'}
+
+
+def test_json_todos_migrate_once(auth_client):
+    from services.todos import migrate_json_todos
+
+    user = get_user('alice')
+    user.todos = '[{"id": "t1", "text": "old task", "done": true}, {"id": "t2", "text": "next"}]'
+    db.session.commit()
+
+    assert migrate_json_todos() == 1
+    assert migrate_json_todos() == 0
+    todos = auth_client.get('/api/todos').get_json()['todos']
+    assert [(t['text'], t['done']) for t in todos] == [('old task', True), ('next', False)]
+    db.session.expire_all()
+    assert get_user('alice').todos == '[]'